@@ -1,2 +1,4 @@
 from .index import *
 from .region import Region
+from .region_set import RegionSet
+from .algebra import *
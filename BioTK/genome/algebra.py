@@ -0,0 +1,363 @@
+"""
+Set operations on genomic regions (merge, intersect, subtract, complement,
+closest, and coverage), implemented as sweeps over sorted region arrays.
+
+Each operation accepts either a :py:class:`RegionSet`, in which case a
+RegionSet is returned, or an iterable of RegionSet chunks (such as those
+read from a large, sorted BED file), in which case an iterator over the
+results for each contig is returned, so that only one contig needs to be
+held in memory at a time. The chunks must be grouped by contig and sorted
+by start within each contig.
+
+Contigs are processed independently, with the given number of threads.
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+
+from BioTK.genome.region_set import RegionSet
+
+__all__ = ["contig_groups", "merge", "intersect", "subtract", "complement",
+           "closest", "coverage", "coverage_histogram"]
+
+#########
+# Helpers
+#########
+
+def contig_runs(regions):
+    # Split a RegionSet into runs of consecutive regions on the same contig,
+    # yielding the contig and bounds of each run
+    codes = regions.codes
+    bounds = numpy.concatenate([[0], numpy.flatnonzero(codes[1:] != codes[:-1])
+                                + 1, [len(codes)]])
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        if end > start:
+            yield regions.contig_names[codes[start]], start, end
+
+def numbered_chunks(chunks):
+    # Pair each chunk of a stream with the positions of its regions in
+    # the stream
+    offset = 0
+    for chunk in chunks:
+        yield chunk, numpy.arange(offset, offset + len(chunk))
+        offset += len(chunk)
+
+def indexed_groups(regions):
+    """
+    Yield (contig, RegionSet, positions) triples with all the regions on
+    each contig, sorted by start, from a RegionSet or a stream of RegionSet
+    chunks, where positions are the indices of the regions in the input
+    (counting across all the chunks of a stream).
+    """
+    if isinstance(regions, RegionSet):
+        if regions.is_sorted():
+            chunks = [(regions, numpy.arange(len(regions)))]
+        else:
+            order = regions.argsort()
+            chunks = [(regions[order], order)]
+    else:
+        chunks = numbered_chunks(regions)
+    current, parts, done = None, [], set()
+    for chunk, positions in chunks:
+        for contig, start, end in contig_runs(chunk):
+            if contig != current:
+                if parts:
+                    yield (current,) + sorted_group(current, parts)
+                if contig in done:
+                    raise ValueError("Regions are not grouped by contig: %s"
+                                     % contig)
+                done.add(contig)
+                current, parts = contig, []
+            parts.append((chunk[start:end], positions[start:end]))
+    if parts:
+        yield (current,) + sorted_group(current, parts)
+
+def contig_groups(regions):
+    """
+    Yield (contig, RegionSet) pairs with all the regions on each contig,
+    sorted by start, from a RegionSet or a stream of RegionSet chunks.
+    """
+    for contig, group, _ in indexed_groups(regions):
+        yield contig, group
+
+def sorted_group(contig, parts):
+    runs, positions = zip(*parts)
+    if len(runs) == 1:
+        group, positions = runs[0], positions[0]
+    else:
+        group = RegionSet.concatenate(runs)
+        positions = numpy.concatenate(positions)
+    if not group.is_sorted():
+        raise ValueError("Regions on %s are not sorted by start" % contig)
+    return group, positions
+
+def map_contigs(fn, groups, threads):
+    # Apply fn to each (contig, regions) pair, in order, with a bounded
+    # number of groups in flight
+    if threads == 1:
+        yield from (fn(*group) for group in groups)
+        return
+    with ThreadPoolExecutor(threads) as executor:
+        pending = deque()
+        for group in groups:
+            pending.append(executor.submit(fn, *group))
+            if len(pending) > 2 * threads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def collect(regions, results):
+    # Return results in the same form as the input regions
+    if isinstance(regions, RegionSet):
+        return RegionSet.concatenate(list(results))
+    return results
+
+def new_regions(contig, starts, ends, scores=None):
+    return RegionSet._new([contig], numpy.zeros(len(starts), dtype="i4"),
+                          starts, ends, scores=scores)
+
+def with_bounds(regions, starts, ends):
+    return RegionSet._new(regions.contig_names, regions.codes, starts, ends,
+                          regions.names, regions.scores, regions.strand_codes)
+
+def merge_arrays(starts, ends, distance=0):
+    """
+    Merge overlapping (or book-ended) intervals, sorted by start, and
+    intervals separated by at most distance bases. Returns the starts, ends,
+    and number of intervals of each merged interval.
+    """
+    if not len(starts):
+        return starts, ends, numpy.empty(0, dtype="i8")
+    reach = numpy.maximum.accumulate(ends)
+    first = numpy.flatnonzero(numpy.concatenate(
+        [[True], starts[1:] > reach[:-1] + distance]))
+    counts = numpy.diff(numpy.append(first, len(starts)))
+    return starts[first], numpy.maximum.reduceat(ends, first), counts
+
+def overlapping_blocks(starts, ends, b_starts, b_ends):
+    """
+    For intervals (starts, ends) and sorted, disjoint blocks, return
+    the index of the first block overlapping each interval, and the
+    number of overlapping blocks.
+    """
+    lo = numpy.searchsorted(b_ends, starts, side="right")
+    hi = numpy.searchsorted(b_starts, ends, side="left")
+    return lo, numpy.maximum(hi - lo, 0)
+
+def expand(counts):
+    # The index of each item, repeated counts times, and the position
+    # of each repetition within its item
+    ix = numpy.repeat(numpy.arange(len(counts)), counts)
+    offsets = numpy.arange(len(ix)) - \
+            numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    return ix, offsets
+
+def merged_blocks(regions):
+    return dict((contig, merge_arrays(group.starts, group.ends)[:2])
+                for contig, group in contig_groups(regions))
+
+############
+# Operations
+############
+
+def merge(regions, distance=0, threads=1):
+    """
+    Merge overlapping or book-ended regions (and regions separated by at
+    most distance bases). The score of each merged region is the number
+    of regions it contains.
+    """
+    def fn(contig, group):
+        starts, ends, counts = merge_arrays(group.starts, group.ends,
+                                            distance)
+        return new_regions(contig, starts, ends, counts.astype("f8"))
+    return collect(regions, map_contigs(fn, contig_groups(regions), threads))
+
+def intersect(a, b, threads=1):
+    """
+    Return the parts of the regions in a that overlap any region in b,
+    keeping the names, scores and strands from a. A region of a that
+    overlaps several separate regions of b is split into several parts.
+    """
+    blocks = merged_blocks(b)
+
+    def fn(contig, group):
+        if contig not in blocks:
+            return group[:0]
+        b_starts, b_ends = blocks[contig]
+        lo, counts = overlapping_blocks(group.starts, group.ends,
+                                        b_starts, b_ends)
+        ix, offsets = expand(counts)
+        block = lo[ix] + offsets
+        parts = group[ix]
+        return with_bounds(parts,
+                           numpy.maximum(parts.starts, b_starts[block]),
+                           numpy.minimum(parts.ends, b_ends[block]))
+    return collect(a, map_contigs(fn, contig_groups(a), threads))
+
+def subtract(a, b, threads=1):
+    """
+    Return the parts of the regions in a that do not overlap any region
+    in b, keeping the names, scores and strands from a.
+    """
+    blocks = merged_blocks(b)
+
+    def fn(contig, group):
+        if contig not in blocks or not len(blocks[contig][0]):
+            return group
+        b_starts, b_ends = blocks[contig]
+        lo, counts = overlapping_blocks(group.starts, group.ends,
+                                        b_starts, b_ends)
+        # A region overlapping k blocks leaves up to k+1 parts: before the
+        # first block, between consecutive blocks, and after the last one
+        ix, j = expand(counts + 1)
+        parts = group[ix]
+        block = lo[ix] + j
+        last = len(b_starts) - 1
+        starts = numpy.where(j == 0, parts.starts,
+                             b_ends[numpy.clip(block - 1, 0, last)])
+        ends = numpy.where(j == counts[ix], parts.ends,
+                           b_starts[numpy.clip(block, 0, last)])
+        starts = numpy.maximum(starts, parts.starts)
+        ends = numpy.minimum(ends, parts.ends)
+        keep = (ends > starts) | (counts[ix] == 0)
+        return with_bounds(parts, starts, ends)[keep]
+    return collect(a, map_contigs(fn, contig_groups(a), threads))
+
+def complement(regions, sizes, threads=1):
+    """
+    Return the regions of the genome not covered by any of the given
+    regions, where sizes maps each contig name to its size. Contigs not
+    in sizes are ignored.
+    """
+    def fn(contig, group):
+        size = sizes[contig]
+        starts, ends, _ = merge_arrays(group.starts, group.ends)
+        gap_starts = numpy.minimum(numpy.concatenate([[0], ends]), size)
+        gap_ends = numpy.minimum(numpy.concatenate([starts, [size]]), size)
+        keep = gap_ends > gap_starts
+        return new_regions(contig, gap_starts[keep], gap_ends[keep])
+
+    def groups():
+        seen = set()
+        for contig, group in contig_groups(regions):
+            seen.add(contig)
+            if contig in sizes:
+                yield contig, group
+        for contig in sorted(set(sizes) - seen):
+            yield contig, new_regions(contig, numpy.empty(0, "i8"),
+                                      numpy.empty(0, "i8"))
+
+    return collect(regions, map_contigs(fn, groups(), threads))
+
+def closest(a, b, threads=1):
+    """
+    Find the closest region in b to each region in a.
+
+    Returns arrays (a_idx, b_idx, distance), with one element for each
+    region of a on a contig with any regions in b, where the indices are
+    positions in a and b (counting across all the chunks of a stream), 
+    and the distance is the number of bases between the regions (0 if 
+    they overlap). Ties are broken in favor of overlapping, then upstream
+    regions. If a is a stream of chunks, an iterator over such arrays 
+    for each contig is returned instead.
+    """
+    b_groups = dict((contig, (group.starts, group.ends, positions))
+                    for contig, group, positions in indexed_groups(b))
+    empty = numpy.empty(0, dtype="i8")
+
+    def fn(contig, group, positions):
+        if contig not in b_groups:
+            return empty, empty, empty
+        b_starts, b_ends, b_positions = b_groups[contig]
+        hits, distance = closest_arrays(group.starts, group.ends,
+                                        b_starts, b_ends)
+        return positions.astype("i8"), b_positions[hits].astype("i8"), \
+                distance
+
+    results = map_contigs(fn, indexed_groups(a), threads)
+    if not isinstance(a, RegionSet):
+        return results
+    results = list(results) or [(empty, empty, empty)]
+    return tuple(numpy.concatenate(column) for column in zip(*results))
+
+def closest_arrays(starts, ends, b_starts, b_ends):
+    """
+    For each interval, return the index of the closest of the intervals 
+    (b_starts, b_ends), sorted by start, and its distance.
+    """
+    n = len(b_starts)
+    # Overlaps: of the b intervals starting before the end of the query,
+    # the one with the greatest end overlaps it, if any does
+    reach = numpy.maximum.accumulate(b_ends)
+    reach_ix = numpy.maximum.accumulate(
+        numpy.where(b_ends == reach, numpy.arange(n), 0))
+    before = numpy.searchsorted(b_starts, ends, side="left") - 1
+    # Zero-length queries overlap intervals containing their position
+    before = numpy.where(ends == starts, 
+                         numpy.searchsorted(b_starts, ends, side="right") - 1,
+                         before)
+    overlap_ix = reach_ix[numpy.maximum(before, 0)]
+    overlaps = (before >= 0) & (reach[numpy.maximum(before, 0)] > starts)
+
+    # Upstream: the b interval with the greatest end <= the query start
+    end_order = numpy.argsort(b_ends, kind="stable")
+    up = numpy.searchsorted(b_ends[end_order], starts, side="right") - 1
+    up_ix = end_order[numpy.maximum(up, 0)]
+    up_distance = numpy.where(up >= 0, starts - b_ends[up_ix], numpy.inf)
+
+    # Downstream: the b interval with the least start >= the query end
+    down = numpy.searchsorted(b_starts, ends, side="left")
+    down_ix = numpy.minimum(down, n - 1)
+    down_distance = numpy.where(down < n, b_starts[down_ix] - ends, numpy.inf)
+
+    hits = numpy.where(up_distance <= down_distance, up_ix, down_ix)
+    distance = numpy.minimum(up_distance, down_distance)
+    hits = numpy.where(overlaps, overlap_ix, hits)
+    distance = numpy.where(overlaps, 0, distance)
+    return hits, distance.astype("i8")
+
+def coverage_arrays(starts, ends):
+    """
+    Return the starts, ends, and depths of the segments covered by 
+    one or more of the given intervals.
+    """
+    positions, inverse = numpy.unique(numpy.concatenate([starts, ends]),
+                                      return_inverse=True)
+    deltas = numpy.bincount(inverse, minlength=len(positions),
+                            weights=numpy.repeat([1, -1], len(starts)))
+    changes = deltas != 0
+    positions, deltas = positions[changes], deltas[changes]
+    depth = numpy.cumsum(deltas)[:-1].astype("i8")
+    covered = depth > 0
+    return positions[:-1][covered], positions[1:][covered], depth[covered]
+
+def coverage(regions, threads=1):
+    """
+    Return the segments of constant, non-zero coverage by the given
+    regions, with the depth of coverage as the score of each segment.
+    """
+    def fn(contig, group):
+        starts, ends, depth = coverage_arrays(group.starts, group.ends)
+        return new_regions(contig, starts, ends, depth.astype("f8"))
+    return collect(regions, map_contigs(fn, contig_groups(regions), threads))
+
+def coverage_histogram(regions, sizes=None, threads=1):
+    """
+    Return an array of the number of bases covered by each number of 
+    regions (the number of bases at depth 0 is only counted if sizes, 
+    mapping contig names to sizes, is given). 
+    """
+    def fn(contig, group):
+        starts, ends, depth = coverage_arrays(group.starts, group.ends)
+        return numpy.bincount(depth, weights=ends - starts)
+
+    histogram = numpy.zeros(1)
+    for counts in map_contigs(fn, contig_groups(regions), threads):
+        if len(counts) > len(histogram):
+            counts, histogram = histogram, counts
+        histogram[:len(counts)] += counts
+    if sizes is not None:
+        histogram[0] = sum(sizes.values()) - histogram[1:].sum()
+    return histogram.astype("i8")
@@ -2,97 +2,932 @@
 Various types of indices for genomic regions, both RAM and disk-based.
 """
 
-from itertools import groupby
-from operator import attrgetter
+import mmap
+import os
+from struct import Struct
 
+import numpy
+
+cimport cython
 from cpython cimport bool
+from libc.stdint cimport int64_t
+from libc.stdlib cimport malloc, realloc, free
 
 from BioTK.genome.region cimport Region
 
-cdef class Node:
-    cdef Region payload
-    cdef Node left, right
-    cdef int max_end
-
-    def __init__(self, list regions):
-        midpoint = int(len(regions) / 2)
-        self.payload = regions[midpoint]
-        self.max_end = self.payload.end
-        if midpoint > 0:
-            self.left = Node(regions[:midpoint])
-            self.max_end = max(self.max_end, self.left.max_end)
-        if midpoint < len(regions) - 1:
-            self.right = Node(regions[(midpoint+1):])
-            self.max_end = max(self.max_end, self.right.max_end)
-
-    def search(self, list result, int start, int end):
-        if start > self.max_end:
-            return
-        if self.left:
-            self.left.search(result, start, end)
-        if (start < self.payload.end) and (end > self.payload.start):
-            result.append(self.payload)
-        if end < self.payload.start:
-            return
-        if self.right:
-            self.right.search(result, start, end)
+#########################
+# Implicit interval trees
+#########################
+
+# Each contig's intervals are stored sorted by start, and the sorted array
+# is itself an implicit augmented binary tree (as in Heng Li's cgranges):
+# the node at position i is at level k, where k is the number of trailing
+# one bits of i, and its children are at i -/+ 2^(k-1). Each node stores
+# the maximum end of its subtree in max_ends, so no pointers are needed.
+
+ctypedef struct Hits:
+    int64_t* data
+    int64_t size
+    int64_t capacity
+
+cdef int hits_init(Hits* hits) except -1:
+    hits.size = 0
+    hits.capacity = 64
+    hits.data = <int64_t*> malloc(hits.capacity * sizeof(int64_t))
+    if hits.data == NULL:
+        raise MemoryError()
+    return 0
+
+cdef int hits_append(Hits* hits, int64_t value) except -1 nogil:
+    cdef int64_t* data
+    if hits.size == hits.capacity:
+        data = <int64_t*> realloc(hits.data,
+                                  2 * hits.capacity * sizeof(int64_t))
+        if data == NULL:
+            with gil:
+                raise MemoryError()
+        hits.data = data
+        hits.capacity *= 2
+    hits.data[hits.size] = value
+    hits.size += 1
+    return 0
+
+cdef object hits_array(Hits* hits):
+    result = numpy.empty(hits.size, dtype=numpy.int64)
+    cdef int64_t[:] view = result
+    cdef int64_t i
+    for i in range(hits.size):
+        view[i] = hits.data[i]
+    return result
+
+cdef int max_level(int64_t n) nogil:
+    cdef int k = 0
+    while (<int64_t> 1 << (k + 1)) <= n:
+        k += 1
+    return k
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void index_max_ends(const int64_t[:] ends, int64_t[:] max_ends,
+                         int64_t lo, int64_t n) noexcept nogil:
+    """
+    Compute the subtree max ends of the implicit tree over
+    the (sorted) intervals lo...lo+n.
+    """
+    cdef int64_t i, x, step, last_i, last, e, el, er
+    cdef int k
+    if n == 0:
+        return
+    # Leaves (even positions)
+    last_i = 0
+    last = 0
+    for i in range(0, n, 2):
+        last_i = i
+        last = max_ends[lo+i] = ends[lo+i]
+    k = 1
+    while (<int64_t> 1 << k) <= n:
+        x = <int64_t> 1 << (k - 1)
+        step = x << 2
+        i = (x << 1) - 1
+        while i < n:
+            el = max_ends[lo+i-x]
+            er = max_ends[lo+i+x] if i + x < n else last
+            e = ends[lo+i]
+            if el > e:
+                e = el
+            if er > e:
+                e = er
+            max_ends[lo+i] = e
+            i += step
+        # The max end of the rightmost (possibly incomplete) subtree at
+        # this level, used for nodes whose right child is past the end
+        last_i = last_i - x if (last_i >> k) & 1 else last_i + x
+        if last_i < n and max_ends[lo+last_i] > last:
+            last = max_ends[lo+last_i]
+        k += 1
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int64_t overlap(const int64_t[:] starts, const int64_t[:] ends,
+                     const int64_t[:] max_ends, int64_t lo, int64_t n,
+                     int64_t start, int64_t end, Hits* hits,
+                     int64_t limit) except -1 nogil:
+    """
+    Find the intervals in lo...lo+n overlapping [start, end), appending
+    their positions (in increasing order) to hits, if it is not NULL,
+    and stopping after limit hits if limit is non-negative. Returns the
+    number of hits.
+    """
+    cdef int64_t stack_x[128]
+    cdef int stack_k[128]
+    cdef bint stack_w[128]
+    cdef int64_t x, y, i, i0, i1, count = 0
+    cdef int k, t = 0
+    cdef bint w
+
+    if n == 0 or limit == 0:
+        return 0
+    k = max_level(n)
+    stack_x[0] = (<int64_t> 1 << k) - 1
+    stack_k[0] = k
+    stack_w[0] = False
+    t = 1
+    while t > 0:
+        t -= 1
+        x, k, w = stack_x[t], stack_k[t], stack_w[t]
+        if k <= 3:
+            # Small subtrees are scanned linearly
+            i0 = x >> k << k
+            i1 = i0 + (<int64_t> 1 << (k + 1)) - 1
+            if i1 > n:
+                i1 = n
+            i = i0
+            while i < i1 and starts[lo+i] < end:
+                if start < ends[lo+i]:
+                    if hits != NULL:
+                        hits_append(hits, lo + i)
+                    count += 1
+                    if count == limit:
+                        return count
+                i += 1
+        elif not w:
+            # Revisit this node after its left child
+            stack_x[t], stack_k[t], stack_w[t] = x, k, True
+            t += 1
+            y = x - (<int64_t> 1 << (k - 1))
+            if y >= n or max_ends[lo+y] > start:
+                stack_x[t], stack_k[t], stack_w[t] = y, k - 1, False
+                t += 1
+        elif x < n and starts[lo+x] < end:
+            if start < ends[lo+x]:
+                if hits != NULL:
+                    hits_append(hits, lo + x)
+                count += 1
+                if count == limit:
+                    return count
+            stack_x[t] = x + (<int64_t> 1 << (k - 1))
+            stack_k[t], stack_w[t] = k - 1, False
+            t += 1
+    return count
+
+cdef inline int64_t bisect_left(const int64_t[:] a, int64_t lo, int64_t hi,
+                                int64_t x) noexcept nogil:
+    cdef int64_t mid
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if a[mid] < x:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+cdef inline int64_t bisect_right(const int64_t[:] a, int64_t lo, int64_t hi,
+                                 int64_t x) noexcept nogil:
+    cdef int64_t mid
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if x < a[mid]:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+# Directions of nearest intervals to search, relative to the genome
+cdef enum:
+    UPSTREAM = 1
+    DOWNSTREAM = 2
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int64_t nearest(const int64_t[:] starts, const int64_t[:] ends,
+                     const int64_t[:] max_ends, const int64_t[:] end_order,
+                     const int64_t[:] sorted_ends, int64_t lo, int64_t n,
+                     int64_t start, int64_t end, int64_t k, int directions,
+                     Hits* hits, Hits* distances) except -1 nogil:
+    """
+    Find the k intervals in lo...lo+n nearest to [start, end), appending
+    their positions to hits and their distances to distances, which are
+    negative for intervals before the query and positive for intervals
+    after it (0 for overlapping intervals). Returns the number of hits.
+    """
+    cdef int64_t i, count, up, down, up_gap, down_gap
+    cdef int64_t first = hits.size
+    count = overlap(starts, ends, max_ends, lo, n, start, end, hits, k)
+    for i in range(count):
+        hits_append(distances, 0)
+
+    # Walk outwards from the query: upstream in order of decreasing end,
+    # and downstream in order of increasing start
+    up = bisect_right(sorted_ends, lo, lo + n, start) - 1
+    down = bisect_left(starts, lo, lo + n, end)
+    while count < k:
+        # Zero-length intervals at a zero-length query are both upstream
+        # and downstream, so they are only found upstream
+        while down < lo + n and ends[down] <= start:
+            down += 1
+        up_gap = start - sorted_ends[up] if (up >= lo) and \
+                (directions & UPSTREAM) else -1
+        down_gap = starts[down] - end if (down < lo + n) and \
+                (directions & DOWNSTREAM) else -1
+        if up_gap < 0 and down_gap < 0:
+            break
+        if up_gap >= 0 and (down_gap < 0 or up_gap <= down_gap):
+            hits_append(hits, end_order[up])
+            hits_append(distances, -up_gap)
+            up -= 1
+        else:
+            hits_append(hits, down)
+            hits_append(distances, down_gap)
+            down += 1
+        count += 1
+    return count
+
+cdef class ArrayIndex:
+    """
+    An index for intervals on multiple contigs, stored in flat numpy
+    arrays rather than as objects.
+
+    The intervals are sorted by (contig, start, end) with a single sort,
+    and each contig's slice of the sorted arrays forms an implicit
+    augmented interval tree, which is searched iteratively without the
+    GIL. Query results are arrays of the original indices of the matching
+    intervals, in order of start position.
+    """
+    cdef readonly:
+        object contigs, starts, ends, max_ends, ids, offsets
+    cdef object _contig_ix, _end_order, _sorted_ends
+
+    def __init__(self, contigs, starts, ends):
+        """
+        Build an index from parallel sequences of contig names, and
+        start and end positions.
+        """
+        # Sorting fixed-width strings is much faster than sorting objects
+        contigs = numpy.asarray(contigs)
+        if contigs.dtype.kind != "U":
+            contigs = contigs.astype(str)
+        names, codes = numpy.unique(contigs, return_inverse=True)
+        starts = numpy.asarray(starts, dtype=numpy.int64)
+        ends = numpy.asarray(ends, dtype=numpy.int64)
+        assert(len(codes) == len(starts) == len(ends))
+        assert((starts <= ends).all())
+
+        ids = numpy.lexsort((ends, starts, codes))
+        offsets = numpy.searchsorted(codes[ids],
+                                     numpy.arange(len(names) + 1))
+        self._set([str(c) for c in names], offsets, starts[ids], ends[ids], None, ids)
+
+    cdef _set(self, list contigs, offsets, starts, ends, max_ends, ids):
+        self.contigs = contigs
+        self._contig_ix = dict((c, i) for i, c in enumerate(contigs))
+        self.offsets = numpy.asarray(offsets, dtype=numpy.int64)
+        self.starts = starts
+        self.ends = ends
+        self.ids = numpy.asarray(ids, dtype=numpy.int64)
+        if max_ends is None:
+            max_ends = numpy.empty(len(ends), dtype=numpy.int64)
+            for i in range(len(contigs)):
+                lo, hi = self.offsets[i], self.offsets[i+1]
+                index_max_ends(self.ends, max_ends, lo, hi - lo)
+        self.max_ends = max_ends
+        self._end_order = None
+        self._sorted_ends = None
+
+    def _by_end(self):
+        # The sorted positions of the intervals in order of end within each
+        # contig, and their ends, for nearest upstream searches
+        if self._end_order is None:
+            codes = numpy.repeat(numpy.arange(len(self.contigs)), 
+                                 numpy.diff(self.offsets))
+            order = numpy.lexsort((self.ends, codes))
+            self._sorted_ends = numpy.asarray(self.ends)[order]
+            self._end_order = order
+        return self._end_order, self._sorted_ends
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, contig, int64_t start, int64_t end):
+        """
+        Return the indices of the intervals overlapping the given
+        contig, start, and end.
+        """
+        cdef Hits hits
+        cdef int64_t lo, n
+        ix = self._contig_ix.get(contig)
+        if ix is None:
+            return numpy.empty(0, dtype=numpy.int64)
+        if start > end:
+            start, end = end, start
+        lo = self.offsets[ix]
+        n = self.offsets[ix+1] - lo
+        hits_init(&hits)
+        try:
+            overlap(self.starts, self.ends, self.max_ends, lo, n,
+                    start, end, &hits, -1)
+            return self.ids[hits_array(&hits)]
+        finally:
+            free(hits.data)
+
+    def find(self, contig, int64_t start, int64_t end):
+        """
+        Return the indices of the intervals with exactly the given
+        contig, start, and end.
+        """
+        ix = self._contig_ix.get(contig)
+        if ix is None:
+            return numpy.empty(0, dtype=numpy.int64)
+        lo, hi = self.offsets[ix], self.offsets[ix+1]
+        starts = self.starts[lo:hi]
+        lo, hi = lo + numpy.searchsorted(starts, start), \
+                lo + numpy.searchsorted(starts, start, side="right")
+        ends = self.ends[lo:hi]
+        lo, hi = lo + numpy.searchsorted(ends, end), \
+                lo + numpy.searchsorted(ends, end, side="right")
+        return self.ids[lo:hi]
+
+    def _query_codes(self, contigs):
+        # The position of each query contig in self.contigs, or -1
+        contigs = numpy.asarray(contigs)
+        if contigs.dtype.kind != "U":
+            contigs = contigs.astype(str)
+        names, inverse = numpy.unique(contigs, return_inverse=True)
+        codes = numpy.array([self._contig_ix.get(str(c), -1) for c in names],
+                            dtype=numpy.int64)
+        return codes[inverse].reshape(-1)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def _search_many(self, contigs, starts, ends, int mode):
+        # mode 0: (query, hit) pairs, 1: counts, 2: any overlap
+        cdef const int64_t[:] c_starts = self.starts, c_ends = self.ends
+        cdef const int64_t[:] c_max_ends = self.max_ends, c_ids = self.ids
+        cdef const int64_t[:] offsets = self.offsets
+        cdef const int64_t[:] codes = self._query_codes(contigs)
+        cdef const int64_t[:] q_starts = numpy.asarray(starts, 
+                                                       dtype=numpy.int64)
+        cdef const int64_t[:] q_ends = numpy.asarray(ends, dtype=numpy.int64)
+        cdef int64_t i, j, n = codes.shape[0], lo, start, end, limit
+        cdef Hits hits, queries
+        assert(q_starts.shape[0] == n and q_ends.shape[0] == n)
+        counts = numpy.zeros(n, dtype=numpy.int64)
+        cdef int64_t[:] c_counts = counts
+        limit = 1 if mode == 2 else -1
+
+        hits_init(&hits)
+        try:
+            hits_init(&queries)
+        except MemoryError:
+            free(hits.data)
+            raise
+        try:
+            with nogil:
+                for i in range(n):
+                    if codes[i] < 0:
+                        continue
+                    start, end = q_starts[i], q_ends[i]
+                    if start > end:
+                        start, end = end, start
+                    lo = offsets[codes[i]]
+                    j = hits.size
+                    c_counts[i] = overlap(c_starts, c_ends, c_max_ends, 
+                                          lo, offsets[codes[i]+1] - lo,
+                                          start, end,
+                                          &hits if mode == 0 else NULL,
+                                          limit)
+                    while j < hits.size:
+                        hits.data[j] = c_ids[hits.data[j]]
+                        hits_append(&queries, i)
+                        j += 1
+            if mode == 0:
+                return hits_array(&queries), hits_array(&hits)
+            elif mode == 1:
+                return counts
+            else:
+                return counts.astype(bool)
+        finally:
+            free(hits.data)
+            free(queries.data)
+
+    def search_many(self, contigs, starts, ends):
+        """
+        Search for the intervals overlapping each of many queries, given
+        as parallel sequences of contigs, starts, and ends. Returns a pair 
+        of arrays (query_idx, hit_idx), with one element for each pair of 
+        overlapping query and indexed interval, ordered by query.
+        """
+        return self._search_many(contigs, starts, ends, 0)
+
+    def count_many(self, contigs, starts, ends):
+        """
+        Return the number of indexed intervals overlapping each query.
+        """
+        return self._search_many(contigs, starts, ends, 1)
+
+    def any_overlap(self, contigs, starts, ends):
+        """
+        Return a boolean array indicating whether each query overlaps 
+        any indexed interval.
+        """
+        return self._search_many(contigs, starts, ends, 2)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def nearest_many(self, contigs, starts, ends, int64_t k=1, strands=None,
+                     direction=None):
+        """
+        Find the k nearest intervals to each of many queries, given as
+        parallel sequences of contigs, starts, ends, and optionally strands.
+
+        Returns arrays (query_idx, hit_idx, distance), ordered by query and 
+        then by increasing distance, where overlapping intervals have 
+        distance 0, and otherwise the distance is the number of bases 
+        between the query and interval, negative if the interval is 
+        upstream of the query. Upstream is relative to the strand of the 
+        query if strands are given (so, before the query for "+" or 
+        unstranded queries, and after it for "-"). If direction is 
+        "upstream" or "downstream", only overlapping intervals and those 
+        in that direction are found.
+        """
+        assert(direction in (None, "upstream", "downstream"))
+        assert(k >= 0)
+        end_order, sorted_ends = self._by_end()
+        cdef const int64_t[:] c_starts = self.starts, c_ends = self.ends
+        cdef const int64_t[:] c_max_ends = self.max_ends, c_ids = self.ids
+        cdef const int64_t[:] c_end_order = end_order
+        cdef const int64_t[:] c_sorted_ends = sorted_ends
+        cdef const int64_t[:] offsets = self.offsets
+        cdef const int64_t[:] codes = self._query_codes(contigs)
+        cdef const int64_t[:] q_starts = numpy.asarray(starts, 
+                                                       dtype=numpy.int64)
+        cdef const int64_t[:] q_ends = numpy.asarray(ends, dtype=numpy.int64)
+        cdef int64_t i, j, n = codes.shape[0], lo, start, end
+        reverse = numpy.zeros(n, dtype=numpy.int8)
+        if strands is not None:
+            reverse[numpy.asarray(strands, dtype=object) == "-"] = 1
+        cdef const signed char[:] c_reverse = reverse
+        cdef int forward = UPSTREAM | DOWNSTREAM, backward
+        if direction == "upstream":
+            forward = UPSTREAM
+        elif direction == "downstream":
+            forward = DOWNSTREAM
+        backward = (UPSTREAM | DOWNSTREAM) ^ forward \
+                if forward != (UPSTREAM | DOWNSTREAM) else forward
+        cdef Hits hits, queries, distances
+        assert(q_starts.shape[0] == n and q_ends.shape[0] == n)
+
+        # Buffers which were never allocated are freed as NULL
+        hits.data = queries.data = distances.data = NULL
+        try:
+            hits_init(&hits)
+            hits_init(&queries)
+            hits_init(&distances)
+            with nogil:
+                for i in range(n):
+                    if codes[i] < 0:
+                        continue
+                    start, end = q_starts[i], q_ends[i]
+                    if start > end:
+                        start, end = end, start
+                    lo = offsets[codes[i]]
+                    j = hits.size
+                    nearest(c_starts, c_ends, c_max_ends, c_end_order,
+                            c_sorted_ends, lo, offsets[codes[i]+1] - lo,
+                            start, end, k, 
+                            backward if c_reverse[i] else forward,
+                            &hits, &distances)
+                    while j < hits.size:
+                        hits.data[j] = c_ids[hits.data[j]]
+                        if c_reverse[i]:
+                            distances.data[j] = -distances.data[j]
+                        hits_append(&queries, i)
+                        j += 1
+            return hits_array(&queries), hits_array(&hits), \
+                    hits_array(&distances)
+        finally:
+            free(hits.data)
+            free(queries.data)
+            free(distances.data)
+
+    def nearest(self, contig, int64_t start, int64_t end, int64_t k=1, 
+                strand=".", direction=None):
+        """
+        Find the k nearest intervals to the given contig, start, and end,
+        returning arrays of their indices and distances (as described
+        for :py:meth:`nearest_many`).
+        """
+        _, hits, distances = self.nearest_many([contig], [start], [end], k=k,
+                                               strands=[strand], 
+                                               direction=direction)
+        return hits, distances
+
+    def save(self, path, append=False):
+        """
+        Write this index to path in the format read by 
+        :py:class:`DiskIndex`. If append is True and path exists, the 
+        index is appended to it as a new version, and earlier versions 
+        remain readable. Returns the version number.
+        """
+        return write_index(self, path, append=append)
+
+####################
+# Disk-based indices
+####################
+
+# A disk index file is a header followed by any number of versions, each
+# of which is a complete index: its arrays (8-byte aligned), a directory
+# of their offsets, and a footer pointing to the directory. Versions are
+# only ever appended, and the footer at the end of the file points to 
+# the latest one, so appending never rewrites existing data.
+
+INDEX_MAGIC = b"BTKRIDX1"
+FOOTER_MAGIC = b"BTKRIDXF"
+IndexHeader = Struct("=8sI4x")
+IndexDirectory = Struct("=10Q")
+IndexFooter = Struct("=Q8s")
+
+def write_index(ArrayIndex index, path, append=False):
+    """
+    Write (or append) an ArrayIndex to a disk index file, returning 
+    the version number of the written index.
+    """
+    version, previous = 0, 0
+    exists = append and os.path.exists(path)
+    with open(path, "r+b" if exists else "wb") as h:
+        if exists:
+            version, previous = len(index_versions(h)), footer_offset(h)
+            h.seek(0, os.SEEK_END)
+        else:
+            h.write(IndexHeader.pack(INDEX_MAGIC, 1))
+
+        def write_array(data):
+            h.write(b"\0" * (-h.tell() % 8))
+            offset = h.tell()
+            h.write(data)
+            return offset
+
+        names = "\0".join(index.contigs).encode("utf-8")
+        offsets = [write_array(numpy.ascontiguousarray(a, dtype="<i8"))
+                   for a in (index.starts, index.ends, index.max_ends,
+                             index.ids, index.offsets)]
+        names_offset = write_array(names)
+        directory = write_array(IndexDirectory.pack(
+            len(index), len(index.contigs), names_offset, len(names), 
+            *offsets, previous))
+        h.write(IndexFooter.pack(directory, FOOTER_MAGIC))
+        h.flush()
+        os.fsync(h.fileno())
+    return version
+
+def footer_offset(h):
+    # The offset of the latest directory in an open index file
+    h.seek(0)
+    magic, _ = IndexHeader.unpack(h.read(IndexHeader.size))
+    h.seek(-IndexFooter.size, os.SEEK_END)
+    directory, footer_magic = IndexFooter.unpack(h.read(IndexFooter.size))
+    if (magic != INDEX_MAGIC) or (footer_magic != FOOTER_MAGIC):
+        raise IOError("Not a valid region index file: %s" % h.name)
+    return directory
+
+def index_versions(h):
+    # Directory offsets of all the versions in an index file, oldest first
+    versions = []
+    offset = footer_offset(h)
+    while offset:
+        versions.insert(0, offset)
+        h.seek(offset)
+        offset = IndexDirectory.unpack(h.read(IndexDirectory.size))[-1]
+    return versions
+
+cdef class DiskIndex(ArrayIndex):
+    """
+    A region index stored in a file written by :py:meth:`ArrayIndex.save`. 
+
+    The file is memory-mapped read-only, and queries run directly on the
+    mapped arrays with the same engine as :py:class:`ArrayIndex`, so
+    opening an index takes near-constant time, and the pages are shared 
+    by all processes using the same file.
+    """
+    cdef readonly:
+        object path, version, versions
+
+    def __init__(self, path, version=None):
+        """
+        Open the given version of an index file (by default, the latest).
+        """
+        self.path = path
+        with open(path, "rb") as h:
+            directories = index_versions(h)
+            self.versions = len(directories)
+            if version is None:
+                version = self.versions - 1
+            if not (0 <= version < self.versions):
+                raise IndexError("No version %s in %s" % (version, path))
+            self.version = version
+            h.seek(directories[version])
+            (n, n_contigs, names_offset, names_size, starts, ends, 
+                    max_ends, ids, offsets, _) = \
+                    IndexDirectory.unpack(h.read(IndexDirectory.size))
+            map = mmap.mmap(h.fileno(), 0, access=mmap.ACCESS_READ)
+
+        def array(offset, count):
+            return numpy.frombuffer(map, dtype="<i8", count=count, 
+                                    offset=offset)
+
+        names = map[names_offset:names_offset+names_size].decode("utf-8")
+        contigs = names.split("\0") if n_contigs else []
+        self._set(contigs, array(offsets, n_contigs + 1), 
+                  array(starts, n), array(ends, n), array(max_ends, n),
+                  array(ids, n))
+
+# The number of regions added to an incremental RAMIndex that are
+# searched linearly before they are indexed as a new segment
+BUFFER_SIZE = 64
 
 cdef class RAMIndex:
     """
     A RAM-based index for (generic) intervals.
-    
-    This is a simple augmented binary search tree as described
-    in CLRS 2001.
+
+    The intervals are stored in :py:class:`ArrayIndex` segments, each of
+    which is an implicit augmented binary search tree (as described in 
+    CLRS 2001) over sorted interval arrays.
+
+    Regions can also be added and removed after the index is built (or at
+    any time, if incremental is True), interleaved with searches. New 
+    regions are buffered, and then indexed as a segment, which is merged 
+    with the previous segment whenever they are of similar size, so there 
+    are O(log n) segments and each region is re-indexed O(log n) times. 
+    Removed regions are dropped from the segments when they are merged.
     """
     cdef readonly:
         object _regions
-        object _roots
+        object _segments
+        object _buffer
+        object _deleted
         bool _built
+        int64_t _size
 
-    def __init__(self):
+    def __init__(self, incremental=False):
         """
         A RAM-based index for genomic regions on multiple chromosomes/contigs.
+        If incremental is True, the index is searchable from the start, 
+        without calling build().
         """
         self._regions = []
-        self._roots = {}
-        self._built = False
+        self._segments = []
+        self._buffer = []
+        self._deleted = set()
+        self._built = incremental
+        self._size = 0
 
     def add(self, Region r):
         """
-        Add another region to the index. This method can only be
-        called if the index has not been built yet.
+        Add another region to the index, returning its position in the
+        order that regions were added. Regions added after the index is
+        built are immediately searchable.
         """
-        if self._built:
-            msg = "Can't currently mutate a constructed RAMIndex."
-            raise Exception(msg)
+        i = len(self._regions)
         self._regions.append(r)
+        self._size += 1
+        if self._built:
+            self._buffer.append(i)
+            if len(self._buffer) >= BUFFER_SIZE:
+                self._flush()
+        return i
+
+    def remove(self, Region r):
+        """
+        Remove a region (or, if it was not added, a region with the same
+        coordinates) from a built index.
+        """
+        self._check_built()
+        regions = self._regions
+        candidates = [i for i in self._buffer if regions[i] == r]
+        for index, ids in self._segments:
+            candidates.extend(i for i in ids[index.find(r.contig, r.start, 
+                                                        r.end)]
+                              if i not in self._deleted)
+        if not candidates:
+            raise ValueError("%s not in index" % r)
+        i = next((i for i in candidates if regions[i] is r), candidates[0])
+
+        if i in self._buffer:
+            self._buffer.remove(i)
+        else:
+            self._deleted.add(i)
+        regions[i] = None
+        self._size -= 1
+        if len(self._deleted) > max(self._size, BUFFER_SIZE):
+            self._compact()
 
     def build(self):
         """
-        Build the index. After this method is called, new intervals
-        cannot be added.
+        Build the index. Regions added before this method is called
+        are indexed together in a single segment.
         """
-        self._regions.sort()
-        for contig, regions in groupby(self._regions, attrgetter("contig")):
-            self._roots[contig] = Node(list(regions))
+        if self._built:
+            self._flush()
+            return
+        self._segments = [self._segment(numpy.arange(len(self._regions)))]
         self._built = True
 
+    def _segment(self, ids):
+        # Index the regions with the given positions
+        cdef Region r
+        cdef int64_t i, n = len(ids)
+        contigs = [self._regions[i].contig for i in ids]
+        starts = numpy.empty(n, dtype=numpy.int64)
+        ends = numpy.empty(n, dtype=numpy.int64)
+        cdef int64_t[:] starts_view = starts, ends_view = ends
+        for i in range(n):
+            r = self._regions[ids[i]]
+            starts_view[i] = r.start
+            ends_view[i] = r.end
+        return ArrayIndex(contigs, starts, ends), numpy.asarray(ids)
+
+    def _merge(self, segments):
+        # Index the live regions of several segments together
+        contigs, starts, ends, ids = [], [], [], []
+        for index, segment_ids in segments:
+            contigs.append(numpy.repeat(numpy.array(index.contigs, dtype=str),
+                                        numpy.diff(index.offsets)))
+            starts.append(index.starts)
+            ends.append(index.ends)
+            ids.append(segment_ids[index.ids])
+        ids = numpy.concatenate(ids).astype(numpy.int64)
+        live = numpy.ones(len(ids), dtype=bool)
+        if self._deleted:
+            live = ~numpy.isin(ids, list(self._deleted))
+            self._deleted.difference_update(ids[~live].tolist())
+        index = ArrayIndex(numpy.concatenate(contigs)[live], 
+                           numpy.concatenate(starts)[live], 
+                           numpy.concatenate(ends)[live])
+        return index, ids[live]
+
+    def _flush(self):
+        # Index the buffered regions as a new segment, and merge segments
+        # until each is at least twice the size of the next
+        if not self._buffer:
+            return
+        segments = self._segments
+        segments.append(self._segment(self._buffer))
+        self._buffer = []
+        while (len(segments) > 1) and \
+                (len(segments[-2][1]) < 2 * len(segments[-1][1])):
+            segments.append(self._merge([segments.pop(-2), segments.pop()]))
+
+    def _compact(self):
+        self._flush()
+        if self._segments:
+            self._segments = [self._merge(self._segments)]
+
+    def _check_built(self):
+        if not self._built:
+            raise Exception("Must call %s.build() before searching" % \
+                            str(type(self)))
+
+    def _parts(self):
+        # All segments, including the buffer, as (index, ids) pairs
+        if not self._buffer:
+            return self._segments
+        return self._segments + [self._segment(self._buffer)]
+
     def search(self, str contig, int start, int end):
         """
         Search the index for intervals overlapping the given 
         contig, start, and end.
         """
-        assert(self._built)
-        start, end = sorted([start, end])
-        if not self._built:
-            raise Exception("Must call %s.build() before using search()" % \
-                            str(type(self)))
-        root = self._roots.get(contig)
+        cdef Region r
+        self._check_built()
+        if start > end:
+            start, end = end, start
+        regions = self._regions
         result = []
-        if root is not None:
-            root.search(result, start, end)
+        for index, ids in self._segments:
+            result.extend(regions[i] 
+                          for i in ids[index.search(contig, start, end)]
+                          if i not in self._deleted)
+        sources = len(self._segments)
+        for i in self._buffer:
+            r = regions[i]
+            if (r.contig == contig) and (r.start < end) and (r.end > start):
+                result.append(r)
+                sources += 1
+        if sources > 1:
+            result.sort(key=lambda r: (r.start, r.end))
+        return result
+
+    def search_many(self, contigs, starts, ends):
+        """
+        Search the index for intervals overlapping each of many queries, 
+        given as parallel sequences of contigs, starts, and ends. 
+
+        Returns a pair of integer arrays (query_idx, hit_idx), with one
+        element for each overlapping pair, where hit_idx is the position
+        of the region in the order it was added.
+        """
+        self._check_built()
+        parts = self._parts()
+        query_idx, hit_idx = [numpy.empty(0, dtype=numpy.int64)], \
+                [numpy.empty(0, dtype=numpy.int64)]
+        for index, ids in parts:
+            queries, hits = index.search_many(contigs, starts, ends)
+            query_idx.append(queries)
+            hit_idx.append(ids[hits])
+        query_idx = numpy.concatenate(query_idx)
+        hit_idx = numpy.concatenate(hit_idx)
+        if self._deleted:
+            live = ~numpy.isin(hit_idx, list(self._deleted))
+            query_idx, hit_idx = query_idx[live], hit_idx[live]
+        if len(parts) > 1:
+            order = numpy.argsort(query_idx, kind="stable")
+            query_idx, hit_idx = query_idx[order], hit_idx[order]
+        return query_idx, hit_idx
+
+    def count_many(self, contigs, starts, ends):
+        """
+        Return the number of regions overlapping each query.
+        """
+        self._check_built()
+        n = len(starts)
+        if self._deleted:
+            query_idx, _ = self.search_many(contigs, starts, ends)
+            return numpy.bincount(query_idx, minlength=n)
+        counts = numpy.zeros(n, dtype=numpy.int64)
+        for index, _ in self._parts():
+            counts += index.count_many(contigs, starts, ends)
+        return counts
+
+    def any_overlap(self, contigs, starts, ends):
+        """
+        Return a boolean array indicating whether each query overlaps
+        any region in the index.
+        """
+        self._check_built()
+        if self._deleted:
+            return self.count_many(contigs, starts, ends) > 0
+        result = numpy.zeros(len(starts), dtype=bool)
+        for index, _ in self._parts():
+            result |= index.any_overlap(contigs, starts, ends)
         return result
 
+    def nearest_many(self, contigs, starts, ends, k=1, strands=None,
+                     direction=None):
+        """
+        Find the k nearest regions to each of many queries, returning
+        arrays (query_idx, hit_idx, distance) as described for 
+        :py:meth:`ArrayIndex.nearest_many`, where hit_idx is the position
+        of the region in the order it was added.
+        """
+        self._check_built()
+        parts = self._parts()
+        # Removed regions may be among the nearest in each segment
+        extra = len(self._deleted)
+        query_idx, hit_idx, distance = [], [], []
+        for index, ids in parts:
+            queries, hits, distances = index.nearest_many(
+                contigs, starts, ends, k=k + extra, strands=strands, 
+                direction=direction)
+            query_idx.append(queries)
+            hit_idx.append(ids[hits])
+            distance.append(distances)
+        if not parts:
+            return tuple(numpy.empty(0, dtype=numpy.int64) for _ in range(3))
+        query_idx = numpy.concatenate(query_idx)
+        hit_idx = numpy.concatenate(hit_idx)
+        distance = numpy.concatenate(distance)
+        if (len(parts) == 1) and not extra:
+            return query_idx, hit_idx, distance
+
+        keep = ~numpy.isin(hit_idx, list(self._deleted))
+        order = numpy.flatnonzero(keep)[numpy.lexsort(
+            (numpy.abs(distance[keep]), query_idx[keep]))]
+        query_idx = query_idx[order]
+        rank = numpy.arange(len(order)) - \
+                numpy.searchsorted(query_idx, query_idx)
+        order, query_idx = order[rank < k], query_idx[rank < k]
+        return query_idx, hit_idx[order], distance[order]
+
+    def nearest(self, str contig, int start, int end, k=1, strand=".",
+                direction=None):
+        """
+        Return a list of (region, distance) pairs for the k nearest regions
+        to the given contig, start, and end (see 
+        :py:meth:`ArrayIndex.nearest_many`).
+        """
+        _, hits, distances = self.nearest_many([contig], [start], [end], k=k,
+                                               strands=[strand],
+                                               direction=direction)
+        regions = self._regions
+        return [(regions[i], d) for i, d in zip(hits, distances.tolist())]
+
+    def __len__(self):
+        return self._size
+
     def __iter__(self):
         assert(self._built)
-        return iter(self._regions)
+        regions = self._regions
+        if (len(self._segments) == 1) and not (self._buffer or self._deleted):
+            index, ids = self._segments[0]
+            return (regions[i] for i in ids[index.ids])
+        return iter(sorted(r for r in regions if r is not None))
@@ -30,6 +30,7 @@ cdef class Region:
         self.start = start
         self.end = end
         self.name = sys.intern(name)
+        self.score = score
         self.strand = parse_strand(strand)
 
     cpdef long length(self) except *:
@@ -0,0 +1,231 @@
+"""
+Columnar storage for large sets of genomic regions.
+"""
+
+import numpy
+
+from BioTK.genome.region import Region
+
+__all__ = ["RegionSet"]
+
+# Strand codes, as in BioTK.genome.region
+STRANDS = numpy.array([".", "+", "-"], dtype=object)
+
+def parse_strands(strands):
+    strands = numpy.asarray(strands, dtype=object)
+    codes = numpy.zeros(len(strands), dtype="i1")
+    codes[strands == "+"] = 1
+    codes[strands == "-"] = 2
+    return codes
+
+class RegionSet(object):
+    """
+    A set of genomic regions, stored as parallel numpy arrays of contig
+    codes (indices into contig_names), starts, ends, and optionally names,
+    scores, and strands, rather than as :py:class:`Region` objects.
+
+    Selecting with a slice, an index array, or a boolean mask returns
+    another RegionSet sharing the contig names, and selecting with an
+    integer returns a :py:class:`Region`.
+    """
+    def __init__(self, contigs, starts, ends, names=None, scores=None,
+                 strands=None):
+        """
+        Create a RegionSet from parallel sequences of contig names, starts,
+        ends, and optionally names, scores, and strands ("+", "-", or ".").
+        """
+        contigs = numpy.asarray(contigs)
+        if contigs.dtype.kind != "U":
+            contigs = contigs.astype(str)
+        contig_names, codes = numpy.unique(contigs, return_inverse=True)
+        self._set([str(c) for c in contig_names],
+                  codes.reshape(-1).astype("i4"), starts, ends, names,
+                  scores, None if strands is None else parse_strands(strands))
+
+    def _set(self, contig_names, codes, starts, ends, names, scores,
+             strand_codes):
+        self.contig_names = contig_names
+        self.codes = codes
+        self.starts = numpy.asarray(starts, dtype="i8")
+        self.ends = numpy.asarray(ends, dtype="i8")
+        if names is not None:
+            # Strings are kept in a fixed-width numpy array, rather than as
+            # one Python object per region
+            names = numpy.asarray(names)
+            if names.dtype.kind != "U":
+                names = names.astype(object)
+        self.names = names
+        self.scores = None if scores is None else \
+                numpy.asarray(scores, dtype="f8")
+        self.strand_codes = strand_codes
+        n = len(self.codes)
+        assert(len(self.starts) == len(self.ends) == n)
+        for column in (self.names, self.scores, self.strand_codes):
+            assert((column is None) or (len(column) == n))
+
+    @classmethod
+    def _new(cls, contig_names, codes, starts, ends, names=None,
+             scores=None, strand_codes=None):
+        regions = cls.__new__(cls)
+        regions._set(contig_names, codes, starts, ends, names, scores,
+                     strand_codes)
+        return regions
+
+    @classmethod
+    def from_regions(cls, regions):
+        """
+        Create a RegionSet from an iterable of :py:class:`Region` objects.
+        """
+        regions = list(regions)
+        return cls([r.contig for r in regions],
+                   [r.start for r in regions], [r.end for r in regions],
+                   names=[r.name for r in regions],
+                   scores=[r.score for r in regions],
+                   strands=[r.strand for r in regions])
+
+    @classmethod
+    def from_frame(cls, df):
+        """
+        Create a RegionSet from a :py:class:`pandas.DataFrame` with "contig"
+        (or "chrom"), "start", and "end" columns, and optionally "name",
+        "score", and "strand" columns.
+        """
+        contig = "contig" if "contig" in df.columns else "chrom"
+        optional = dict((c, df[c].values) for c in ("name", "score", "strand")
+                        if c in df.columns)
+        return cls(df[contig].values, df["start"].values, df["end"].values,
+                   names=optional.get("name"), scores=optional.get("score"),
+                   strands=optional.get("strand"))
+
+    @classmethod
+    def concatenate(cls, sets):
+        """
+        Concatenate several RegionSets into one. Optional columns are kept
+        only if all the sets have them.
+        """
+        sets = list(sets)
+        contig_names = sorted(set(c for s in sets for c in s.contig_names))
+        ix = dict((c, i) for i, c in enumerate(contig_names))
+        codes = [numpy.array([ix[c] for c in s.contig_names],
+                             dtype="i4")[s.codes] for s in sets]
+
+        def column(name):
+            columns = [getattr(s, name) for s in sets]
+            if not columns or any(c is None for c in columns):
+                return None
+            return numpy.concatenate(columns)
+
+        return cls._new(contig_names,
+                        numpy.concatenate(codes or [numpy.empty(0, "i4")]),
+                        numpy.concatenate([s.starts for s in sets] or [[]]),
+                        numpy.concatenate([s.ends for s in sets] or [[]]),
+                        column("names"), column("scores"),
+                        column("strand_codes"))
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, ix):
+        if isinstance(ix, (int, numpy.integer)):
+            name = "" if self.names is None else self.names[ix]
+            return Region(self.contig_names[self.codes[ix]],
+                          int(self.starts[ix]), int(self.ends[ix]),
+                          name=str(name) if isinstance(name, numpy.str_)
+                          else name,
+                          score=0 if self.scores is None else self.scores[ix],
+                          strand="." if self.strand_codes is None else
+                          STRANDS[self.strand_codes[ix]])
+        select = lambda column: None if column is None else column[ix]
+        return self._new(self.contig_names, self.codes[ix], self.starts[ix],
+                         self.ends[ix], select(self.names),
+                         select(self.scores), select(self.strand_codes))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self):
+        return "<RegionSet with %s regions on %s contigs>" % \
+                (len(self), len(self.contig_names))
+
+    @property
+    def contigs(self):
+        """
+        The contig name of each region.
+        """
+        return numpy.array(self.contig_names, dtype=object)[self.codes]
+
+    @property
+    def strands(self):
+        """
+        The strand ("+", "-", or ".") of each region.
+        """
+        if self.strand_codes is None:
+            return numpy.full(len(self), ".", dtype=object)
+        return STRANDS[self.strand_codes]
+
+    def lengths(self):
+        """
+        The length of each region.
+        """
+        return self.ends - self.starts
+
+    def argsort(self):
+        """
+        Return the order of the regions by (contig, start, end).
+        """
+        return numpy.lexsort((self.ends, self.starts, self.codes))
+
+    def sort(self):
+        """
+        Return a copy of this RegionSet sorted by (contig, start, end).
+        """
+        return self[self.argsort()]
+
+    def is_sorted(self):
+        """
+        Return True if the regions are sorted by (contig, start, end).
+        """
+        c, s, e = self.codes, self.starts, self.ends
+        ordered = (c[1:] > c[:-1]) | ((c[1:] == c[:-1]) & 
+                ((s[1:] > s[:-1]) | ((s[1:] == s[:-1]) & (e[1:] >= e[:-1]))))
+        return bool(ordered.all())
+
+    def contig(self, name):
+        """
+        Return the regions on the given contig.
+        """
+        if name not in self.contig_names:
+            return self[:0]
+        return self[self.codes == self.contig_names.index(name)]
+
+    def to_regions(self):
+        """
+        Return a list of :py:class:`Region` objects.
+        """
+        return list(self)
+
+    def to_frame(self):
+        """
+        Return the regions as a :py:class:`pandas.DataFrame`.
+        """
+        import pandas
+        columns = [("contig", self.contigs), ("start", self.starts),
+                   ("end", self.ends)]
+        if self.names is not None:
+            columns.append(("name", self.names))
+        if self.scores is not None:
+            columns.append(("score", self.scores))
+        if self.strand_codes is not None:
+            columns.append(("strand", self.strands))
+        return pandas.DataFrame(dict(columns), 
+                                columns=[c for c, _ in columns])
+
+    def index(self):
+        """
+        Return an :py:class:`ArrayIndex` of these regions, whose search
+        results are positions in this RegionSet.
+        """
+        from BioTK.genome.index import ArrayIndex
+        contigs = numpy.array(self.contig_names, dtype=str)[self.codes]
+        return ArrayIndex(contigs, self.starts, self.ends)
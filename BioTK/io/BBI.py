@@ -1,5 +1,8 @@
 """
-BigWig and BigBED readers in pure Python.
+BigWig and BigBED readers, and a BigWig writer, in pure Python.
+
+BBI files can be read from local paths or from HTTP(S) URLs, using
+range requests (see :py:class:`HTTPSource`).
 
 The detailed (byte-level) BigWig and BigBED specifications 
 are described in the paper:
@@ -11,24 +14,34 @@ Bioinformatics (2010) 26 (17): 2204-2207.
 http://bioinformatics.oxfordjournals.org/content/26/17/2204.long
 """
 
+import hashlib
 import itertools
 import mmap
+import multiprocessing
 import operator
+import os
+import shutil
 import sys
+import tempfile
+import threading
+import urllib.request
 import zlib
 
-from collections import namedtuple
-from functools import lru_cache
+from collections import namedtuple, defaultdict, deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from struct import Struct, unpack
 
 import numpy
 
-from BioTK.genome import RAMIndex
+from BioTK.genome.region_set import RegionSet
+from BioTK.io.common import generic_open
+from BioTK.util import chunks
 
-__all__ = ["BigWigFile", "BigBEDFile"]
+__all__ = ["BigWigFile", "BigBEDFile", "BigWigWriter", "summarize_files",
+           "SectionCache", "SECTION_CACHE", "HTTPSource", "BBIPool", 
+           "open_bbi"]
 
 # FIXME: don't assume native endianness
-# TODO: (low priority) read from network
 
 def defstruct(name, format, fields):
     cls = namedtuple(name, fields)
@@ -43,12 +56,27 @@ BBIHeader = defstruct("BBIHeader", "=IHHQQQHHQQIQ",
                       fullDataOffset fullIndexOffset \
                       fieldCount definedFieldCount \
                       autoSqlOffset totalSummaryOffset \
-                      uncompressBufSize reserved")
+                      uncompressBufSize extensionOffset")
 
 TotalSummary = defstruct("TotalSummary", "=Qdddd",
                          "basesCovered minVal \
                          maxVal sumData sumSquares")
 
+ZoomHeader = defstruct("ZoomHeader", "=IIQQ",
+                       "reductionLevel reserved \
+                       dataOffset indexOffset")
+
+# Extended header (version 4+), located at the header's extensionOffset
+ExtensionHeader = defstruct("ExtensionHeader", "=HHQ",
+                            "extensionSize extraIndexCount \
+                            extraIndexListOffset")
+
+# Each extra index is followed by fieldCount (fieldId, reserved) pairs
+ExtraIndexHeader = defstruct("ExtraIndexHeader", "=HHQI",
+                             "type fieldCount fileOffset reserved")
+
+ExtraIndexField = defstruct("ExtraIndexField", "=HH", "fieldId reserved")
+
 Contig = namedtuple("Contig", "name id size")
 
 # Common Node metadata for BPTree and RTree
@@ -75,6 +103,18 @@ RLeafItem = defstruct("RLeafItem", "=IIIIQQ",
                       endChromIx endBase \
                       dataOffset dataSize")
 
+# The same RTree items, for reading whole nodes at once
+RNonLeafDatum = numpy.dtype([
+    ("startChromIx", "u4"), ("startBase", "u4"),
+    ("endChromIx", "u4"), ("endBase", "u4"), ("childOffset", "u8")
+])
+
+RLeafDatum = numpy.dtype([
+    ("startChromIx", "u4"), ("startBase", "u4"),
+    ("endChromIx", "u4"), ("endBase", "u4"), 
+    ("dataOffset", "u8"), ("dataSize", "u8")
+])
+
 # BigWig structures
 BigWigSectionHeader = defstruct("BigWigSectionHeader",
                                 "=IIIIIBBH",
@@ -92,24 +132,380 @@ VarStepDatum = numpy.dtype([
 
 BEDGraph = namedtuple("BEDGraph", "chrom start end value")
 
+# Zoom level structures
+ZoomDatum = numpy.dtype([
+    ("chromId", "u4"), ("start", "u4"), ("end", "u4"),
+    ("validCount", "u4"), ("minVal", "f4"), ("maxVal", "f4"),
+    ("sumData", "f4"), ("sumSquares", "f4")
+])
+
 # BigBED structure
 BED = namedtuple("BED", "chrom start end name score strand rest")
 
+# BED column number of the name field, as used by BigBED extra indices
+NAME_FIELD = 3
+
 # Region summary
 RegionSummary = namedtuple("RegionSummary", "size covered sum mean0 mean") 
 
-def read_struct(map, cls, count=None, offset=None):
-    if offset is not None:
-        map.seek(offset)
+# Per-bin accumulators for binned statistics
+BinStats = namedtuple("BinStats", "valid min max sum sumSquares")
+
+# Statistics supported by BigWigFile.stats
+STATS = ("mean", "min", "max", "coverage", "std")
 
+# Number of data sections decompressed and concatenated at a time
+# by the batch query methods
+BATCH_SECTIONS = 64
+
+# BigWigWriter defaults: the number of items per node of the index trees,
+# the number of items per data section, and the zoom level reductions
+# (each must be a multiple of the previous one)
+BLOCK_SIZE = 256
+ITEMS_PER_SLOT = 1024
+ZOOM_INCREMENT = 4
+ZOOM_REDUCTIONS = tuple(32 * ZOOM_INCREMENT ** i for i in range(10))
+
+# Size of the blocks fetched and cached by HTTPSource, and the number
+# of blocks it also keeps in memory
+HTTP_BLOCK_SIZE = 64 * 1024
+HTTP_MEMORY_BLOCKS = 64
+
+# Number of records converted to arrays at a time by BigWigWriter.write
+WRITE_CHUNK_SIZE = 100000
+
+def read_struct(map, cls, count=None, offset=0):
+    """
+    Read one (or count) structures at the given offset of a buffer.
+    The buffer's file position (if any) is neither used nor changed,
+    so a shared mmap can be read from many threads at once.
+    """
     _count = 1 if count is None else count
     size = cls._struct.size
-    data = map.read(size * _count)
-
+    data = map[offset:offset + size*_count]
     items = [cls._make(cls._struct.unpack_from(data, offset=o)) \
              for o in range(0, size*_count, size)]
     return items[0] if count is None else items
 
+def region_arrays(regions):
+    """
+    Convert a set of query regions into (contigs, starts, ends) arrays.
+
+    The regions can be a :py:class:`RegionSet`, a 
+    :py:class:`pandas.DataFrame` (with "contig" or "chrom", "start", and
+    "end" columns, or otherwise using the first three columns), a path to
+    a BED file, or a sequence of three sequences containing the contigs, 
+    starts, and ends.
+    """
+    if isinstance(regions, str):
+        from BioTK.io.BED import BEDFile
+        with BEDFile(regions) as h:
+            regions = h.read()
+    if isinstance(regions, RegionSet):
+        regions = (regions.contigs, regions.starts, regions.ends)
+    elif hasattr(regions, "columns"):
+        columns = list(regions.columns)
+        contig = "contig" if "contig" in columns else \
+                "chrom" if "chrom" in columns else columns[0]
+        start = "start" if "start" in columns else columns[1]
+        end = "end" if "end" in columns else columns[2]
+        regions = (regions[contig], regions[start], regions[end])
+
+    contigs, starts, ends = regions
+    contigs = numpy.asarray(contigs, dtype=object)
+    starts = numpy.asarray(starts, dtype="i8")
+    ends = numpy.asarray(ends, dtype="i8")
+    assert(len(contigs) == len(starts) == len(ends))
+    return contigs, starts, ends
+
+def summarize_sorted(starts, ends, valid, sums, q_start, q_end):
+    """
+    Sum the valid base counts and value sums of sorted, non-overlapping 
+    records over each query region, using cumulative sums. Records 
+    overlapping the edge of a query are weighted by the fraction of 
+    the record which overlaps it.
+
+    Returns a tuple of (covered, sum) arrays.
+    """
+    lo = numpy.searchsorted(ends, q_start, side="right")
+    hi = numpy.searchsorted(starts, q_end, side="left")
+    hi = numpy.maximum(lo, hi)
+
+    cum_valid = numpy.concatenate([[0], numpy.cumsum(valid, dtype="f8")])
+    cum_sums = numpy.concatenate([[0], numpy.cumsum(sums, dtype="f8")])
+    covered = cum_valid[hi] - cum_valid[lo]
+    total = cum_sums[hi] - cum_sums[lo]
+
+    # Remove the non-overlapping parts of the first and last records
+    for i, ix in ((lo, hi > lo), (hi - 1, hi - 1 > lo)):
+        i = i[ix]
+        overlap = numpy.minimum(ends[i], q_end[ix]) - \
+                numpy.maximum(starts[i], q_start[ix])
+        excess = 1 - overlap / (ends[i] - starts[i])
+        covered[ix] -= excess * valid[i]
+        total[ix] -= excess * sums[i]
+    return covered, total
+
+def collapse_runs(records, tolerance=1e-3):
+    """
+    Collapse runs of adjacent BedGraphDatum records (each starting where
+    the previous one ends) whose values are within tolerance of the first
+    value of the run into single records with that value, as the Kent
+    utilities do.
+
+    Returns a new record array.
+    """
+    if len(records) < 2:
+        return records
+    start, end = records["start"], records["end"]
+    value = records["value"].astype("f8")
+
+    # Records within a run can differ from their neighbors by less than
+    # twice the tolerance, so larger differences (or gaps) always start
+    # a new run
+    joined = (start[1:] == end[:-1]) & \
+            (numpy.abs(numpy.diff(value)) < 2 * tolerance)
+    run_start = numpy.concatenate([[True], ~joined])
+    group = numpy.cumsum(run_start) - 1
+    first = numpy.flatnonzero(run_start)
+
+    # Within the few groups whose values drift too far from their first
+    # value, find the runs sequentially
+    drift = numpy.abs(value - value[first][group]) >= tolerance
+    for g in numpy.unique(group[drift]).tolist():
+        lo = first[g]
+        hi = first[g + 1] if g + 1 < len(first) else len(value)
+        run_value = value[lo]
+        for i in range(lo + 1, hi):
+            if abs(value[i] - run_value) >= tolerance:
+                run_start[i] = True
+                run_value = value[i]
+
+    first = numpy.flatnonzero(run_start)
+    last = numpy.append(first[1:], len(records)) - 1
+    result = numpy.empty(len(first), dtype=BedGraphDatum)
+    result["start"] = start[first]
+    result["end"] = end[last]
+    result["value"] = records["value"][first]
+    return result
+
+def bin_records(records, edges):
+    """
+    Split sorted, non-overlapping summary records over the bins
+    delimited by the (sorted) edges array. The records are a tuple of
+    (start, end, valid, min, max, sum, sumSquares) arrays, and records
+    overlapping a bin boundary contribute to each bin in proportion
+    to the fraction of the record which overlaps it.
+
+    Returns a tuple of (bin, valid, min, max, sum, sumSquares) arrays,
+    with one entry per (record, bin) overlap.
+    """
+    start, end, valid, min_val, max_val, sums, sum_squares = records
+    nbins = len(edges) - 1
+    first = numpy.searchsorted(edges, start, side="right") - 1
+    last = numpy.searchsorted(edges, end, side="left") - 1
+    first = numpy.clip(first, 0, nbins - 1)
+    last = numpy.clip(last, 0, nbins - 1)
+
+    # Expand each record into one piece per bin it overlaps
+    counts = last - first + 1
+    rec = numpy.repeat(numpy.arange(len(start)), counts)
+    offset = numpy.arange(len(rec)) - \
+            numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    bin = first[rec] + offset
+
+    overlap = numpy.minimum(end[rec], edges[bin + 1]) - \
+            numpy.maximum(start[rec], edges[bin])
+    ix = overlap > 0
+    rec, bin = rec[ix], bin[ix]
+    fraction = overlap[ix] / (end[rec] - start[rec])
+    return (bin, valid[rec] * fraction, min_val[rec], max_val[rec],
+            sums[rec] * fraction, sum_squares[rec] * fraction)
+
+##############
+# Byte sources
+##############
+
+# BBI files are read through "byte sources", which support len() and
+# slicing (returning bytes), and have an identity (for the section 
+# cache), a prefetch method taking (offset, size) pairs, and a close
+# method.
+
+class FileSource(object):
+    """
+    A local file, read through a read-only memory map.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._handle = open(path, "rb")
+        self._map = mmap.mmap(self._handle.fileno(), 0, 
+                              access=mmap.ACCESS_READ)
+        stat = os.fstat(self._handle.fileno())
+        self.identity = (stat.st_dev, stat.st_ino, 
+                         stat.st_size, stat.st_mtime_ns)
+
+    def __len__(self):
+        return len(self._map)
+
+    def __str__(self):
+        return self.path
+
+    def __getitem__(self, ix):
+        return self._map[ix]
+
+    def prefetch(self, ranges):
+        pass
+
+    def close(self):
+        self._map.close()
+        self._handle.close()
+
+class HTTPSource(object):
+    """
+    A remote file, read with HTTP range requests.
+
+    The file is fetched in aligned blocks, which are cached on disk 
+    (by default, under BioTK.config.CACHE_DIR) and, for the most recently
+    used blocks, in memory. Reads of several missing blocks in a row are
+    coalesced into one request, and :py:meth:`prefetch` fetches the 
+    blocks for many byte ranges with parallel requests.
+    """
+    def __init__(self, url, block_size=HTTP_BLOCK_SIZE, cache_dir=None,
+                 threads=8):
+        self.url = url
+        self._block_size = block_size
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(threads)
+
+        # The first block also gives the total size and version of the file
+        response = self._request(0, block_size)
+        data = response.read()
+        self._size = int(response.headers["Content-Range"].split("/")[-1])
+        version = response.headers.get("ETag") or \
+                response.headers.get("Last-Modified") or ""
+        self.identity = (url, self._size, version)
+
+        if cache_dir is None:
+            import BioTK.config
+            cache_dir = os.path.join(BioTK.config.CACHE_DIR, "bbi")
+        key = hashlib.sha1(repr(self.identity).encode("utf-8")).hexdigest()
+        self._cache_dir = os.path.join(cache_dir, key)
+        os.makedirs(self._cache_dir, exist_ok=True)
+        self._store(0, data)
+
+    def __str__(self):
+        return self.url
+
+    def _request(self, start, end):
+        request = urllib.request.Request(self.url, 
+                headers={"Range": "bytes=%d-%d" % (start, end - 1)})
+        response = urllib.request.urlopen(request)
+        if response.status != 206:
+            response.close()
+            raise IOError("Server does not support range requests: %s" % 
+                          self.url)
+        return response
+
+    def _block_path(self, block):
+        return os.path.join(self._cache_dir, str(block))
+
+    def _store(self, block, data):
+        # Write to a temporary file first, so concurrent readers
+        # never see a partial block
+        path = self._block_path(block)
+        with tempfile.NamedTemporaryFile(dir=self._cache_dir, 
+                                         delete=False) as h:
+            h.write(data)
+        os.replace(h.name, path)
+        self._remember(block, data)
+
+    def _remember(self, block, data):
+        with self._lock:
+            self._memory[block] = data
+            self._memory.move_to_end(block)
+            while len(self._memory) > HTTP_MEMORY_BLOCKS:
+                self._memory.popitem(last=False)
+
+    def _load(self, block):
+        with self._lock:
+            data = self._memory.get(block)
+        if data is None:
+            try:
+                with open(self._block_path(block), "rb") as h:
+                    data = h.read()
+            except FileNotFoundError:
+                return None
+            self._remember(block, data)
+        return data
+
+    def _fetch(self, first, last):
+        # Fetch blocks first to last (inclusive) with a single request
+        bs = self._block_size
+        with self._request(first * bs, min((last + 1) * bs, self._size)) \
+                as response:
+            data = response.read()
+        for block in range(first, last + 1):
+            offset = (block - first) * bs
+            self._store(block, data[offset:offset + bs])
+
+    def _missing_runs(self, blocks):
+        # Group the uncached blocks into runs of consecutive blocks
+        runs = []
+        for block in sorted(blocks):
+            if os.path.exists(self._block_path(block)):
+                continue
+            if runs and runs[-1][1] == block - 1:
+                runs[-1][1] = block
+            else:
+                runs.append([block, block])
+        return runs
+
+    def _blocks(self, start, stop):
+        bs = self._block_size
+        return range(start // bs, (stop - 1) // bs + 1) if stop > start \
+                else range(0)
+
+    def prefetch(self, ranges):
+        """
+        Fetch any uncached blocks covering the given (offset, size)
+        byte ranges, with one request per run of consecutive blocks,
+        made in parallel.
+        """
+        blocks = set()
+        for offset, size in ranges:
+            blocks.update(self._blocks(offset, min(offset + size, self._size)))
+        runs = self._missing_runs(blocks)
+        for _ in self._executor.map(lambda run: self._fetch(*run), runs):
+            pass
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, ix):
+        start, stop, step = ix.indices(self._size)
+        assert(step == 1)
+        blocks = self._blocks(start, stop)
+        for first, last in self._missing_runs(blocks):
+            self._fetch(first, last)
+        data = b"".join(self._load(block) for block in blocks)
+        offset = start - (blocks[0] * self._block_size if blocks else 0)
+        return data[offset:offset + max(stop - start, 0)]
+
+    def close(self):
+        self._executor.shutdown()
+
+def open_source(path):
+    """
+    Return a byte source for a local path or HTTP(S) URL. Byte source
+    objects are returned unchanged.
+    """
+    if not isinstance(path, str):
+        return path
+    if path.startswith("http://") or path.startswith("https://"):
+        return HTTPSource(path)
+    return FileSource(path)
+
 class Tree(object):
     """
     Common superclass of BPTree and RTree, which share a similar structure.
@@ -122,7 +518,8 @@ class Tree(object):
     def _read(self, offset):
         node = read_struct(self._map, Node, offset=offset)
         cls = self.LeafItem if node.isLeaf else self.NonLeafItem
-        items = read_struct(self._map, cls, count=node.count)
+        items = read_struct(self._map, cls, count=node.count,
+                            offset=offset + Node._struct.size)
         if node.isLeaf:
             yield from items
         else:
@@ -134,21 +531,61 @@ class Tree(object):
     
 class BPTree(Tree):
     """
-    The chromosome index, which is stored in a B-Plus Tree.
+    The chromosome index, which is stored in a B-Plus Tree. BigBED
+    extra indices are stored in the same way, but with the (offset, size)
+    of a data section as the value of each key.
     """
     HeaderType = BPTreeHeader
 
-    def __init__(self, map, offset):
+    def __init__(self, map, offset, 
+                 value_format="II", value_fields="chromId chromSize"):
         super(BPTree, self).__init__(map, offset)
         assert(self.header.magic==0x78CA8C91)
-        self.LeafItem = defstruct("LeafItem", "=%ssII" % self.header.keySize, 
-                                  "key chromId chromSize")
+        self.LeafItem = defstruct("LeafItem", 
+                                  "=%ss%s" % (self.header.keySize, value_format),
+                                  "key " + value_fields)
         self.NonLeafItem = defstruct("NonLeafItem", "=%ssQ" % self.header.keySize, 
                                      "key childOffset")
 
+    def _find(self, offset, key):
+        node = read_struct(self._map, Node, offset=offset)
+        cls = self.LeafItem if node.isLeaf else self.NonLeafItem
+        items = read_struct(self._map, cls, count=node.count,
+                            offset=offset + Node._struct.size)
+        if node.isLeaf:
+            yield from (item for item in items if item.key == key)
+        else:
+            # Keys may be duplicated, so every child whose key range
+            # includes the key is searched
+            for i, item in enumerate(items):
+                if item.key > key:
+                    break
+                if (i + 1 == len(items)) or (key <= items[i+1].key):
+                    yield from self._find(item.childOffset, key)
+
+    def search(self, key):
+        """
+        Return the leaf items with the given key (as bytes).
+        """
+        if len(key) > self.header.keySize:
+            return []
+        key = key.ljust(self.header.keySize, b'\0')
+        return list(self._find(self._offset, key))
+
+def position_keys(chrom_ix, base):
+    """
+    Combine contig indices and positions into single sortable integers.
+    """
+    return (numpy.asarray(chrom_ix, dtype="u8") << 32) | \
+            numpy.asarray(base, dtype="u8")
+
 class RTree(Tree):
     """
     The interval index, which is stored in an R Tree.
+
+    The search methods descend the tree on disk, only reading the
+    nodes whose bounding boxes overlap the query, so no index needs
+    to be built before the first query.
     """
     HeaderType = RTreeHeader
     LeafItem = RLeafItem
@@ -156,55 +593,284 @@ class RTree(Tree):
     
     def __init__(self, map, offset):
         super(RTree, self).__init__(map, offset)
+
+    def _read_items(self, offset):
+        node = read_struct(self._map, Node, offset=offset)
+        dtype = RLeafDatum if node.isLeaf else RNonLeafDatum
+        offset += Node._struct.size
+        data = self._map[offset:offset + dtype.itemsize * node.count]
+        return node.isLeaf, numpy.frombuffer(data, dtype=dtype)
+
+    def _descend(self, offset, overlaps):
+        is_leaf, items = self._read_items(offset)
+        ix = overlaps(position_keys(items["startChromIx"], items["startBase"]),
+                      position_keys(items["endChromIx"], items["endBase"]))
+        if is_leaf:
+            for item in items[ix].tolist():
+                yield RLeafItem._make(item)
+        else:
+            for child in items["childOffset"][ix].tolist():
+                yield from self._descend(child, overlaps)
+
+    def search(self, contig_id, start, end):
+        """
+        Return the leaves overlapping the given region, in order.
+        """
+        q_start = position_keys(contig_id, start)
+        q_end = position_keys(contig_id, end)
+        overlaps = lambda starts, ends: (starts < q_end) & (ends > q_start)
+        return list(self._descend(self._offset, overlaps))
+
+    def search_many(self, contig_id, starts, ends):
+        """
+        Return the leaves overlapping any of the given regions, in order.
+        """
+        if not len(starts):
+            return []
+        order = numpy.argsort(starts, kind="mergesort")
+        q_start = position_keys(contig_id, numpy.asarray(starts)[order])
+        q_max_end = numpy.maximum.accumulate(
+                position_keys(contig_id, numpy.asarray(ends)[order]))
+
+        def overlaps(starts, ends):
+            # The number of queries starting before the end of each item
+            n = numpy.searchsorted(q_start, ends, side="left")
+            return (n > 0) & (q_max_end[numpy.maximum(n - 1, 0)] > starts)
+
+        return list(self._descend(self._offset, overlaps))
     
+class LeafIndex(object):
+    """
+    An in-memory index of the leaves of an RTree, stored as sorted
+    per-contig arrays of leaf start and end positions.
+    """
+    def __init__(self, leaves, contig_by_id):
+        items = defaultdict(list)
+        for leaf in leaves:
+            for contig_id in range(leaf.startChromIx, leaf.endChromIx+1):
+                start = leaf.startBase if (contig_id == leaf.startChromIx) else 0
+                end = leaf.endBase if (contig_id == leaf.endChromIx) \
+                      else contig_by_id[contig_id].size
+                items[contig_id].append((start, end, leaf))
+
+        self._index = {}
+        for contig_id, contig_items in items.items():
+            contig_items.sort(key=operator.itemgetter(0))
+            starts = numpy.array([item[0] for item in contig_items], dtype="i8")
+            ends = numpy.array([item[1] for item in contig_items], dtype="i8")
+            # Leaves are sorted by start, so the running maximum of the ends
+            # is monotonic and can be bisected to skip leaves ending too early
+            max_ends = numpy.maximum.accumulate(ends)
+            leaves = [item[2] for item in contig_items]
+            self._index[contig_id] = (starts, ends, max_ends, leaves)
+
+    def search(self, contig_id, start, end):
+        """
+        Return the leaves overlapping the given region, in order.
+        """
+        try:
+            starts, ends, max_ends, leaves = self._index[contig_id]
+        except KeyError:
+            return []
+        lo = numpy.searchsorted(max_ends, start, side="right")
+        hi = numpy.searchsorted(starts, end, side="left")
+        return [leaves[i] for i in range(lo, hi) if ends[i] > start]
+
+    def search_many(self, contig_id, starts, ends):
+        """
+        Return the leaves overlapping any of the given regions, in order.
+        """
+        try:
+            l_starts, l_ends, _, leaves = self._index[contig_id]
+        except KeyError:
+            return []
+        order = numpy.argsort(starts, kind="mergesort")
+        q_start = numpy.asarray(starts)[order]
+        q_max_end = numpy.maximum.accumulate(numpy.asarray(ends)[order])
+        # The number of queries starting before the end of each leaf
+        n = numpy.searchsorted(q_start, l_ends, side="left")
+        hit = (n > 0) & (q_max_end[numpy.maximum(n - 1, 0)] > l_starts)
+        return [leaves[i] for i in numpy.flatnonzero(hit)]
+
+CacheStats = namedtuple("CacheStats", "hits misses evictions size count")
+
+class SectionCache(object):
+    """
+    A thread-safe LRU cache of decoded data sections, bounded by the total
+    size (in bytes) of the cached arrays. Sections are keyed by the identity
+    of their file (device, inode, size and modification time) and their
+    offset, so one cache can be shared by any number of open BBI files, 
+    including several handles to the same file.
+
+    By default, all BBI files share the process-wide :py:data:`SECTION_CACHE`.
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, load):
+        """
+        Return the cached section for this key, or call load() to decode
+        it and cache the result.
+        """
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return value
+            self.misses += 1
+
+        value = load()
+        size = value.nbytes
+        if size > self.max_bytes:
+            return value
+        with self._lock:
+            if key not in self._items:
+                self._items[key] = value
+                self._size += size
+            while self._size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._size -= evicted.nbytes
+                self.evictions += 1
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+
+    def stats(self):
+        """
+        Return the hit, miss and eviction counts, and the current size
+        (in bytes) and number of cached sections.
+        """
+        with self._lock:
+            return CacheStats(self.hits, self.misses, self.evictions,
+                              self._size, len(self._items))
+
+# Decoded section cache shared by all BBI files by default
+SECTION_CACHE = SectionCache()
+
 class ContigNotFound(Exception):
     def __init__(self, name, path):
         msg = "Contig '%s' not found in '%s'" % (name, path)
         super(ContigNotFound, self).__init__(msg)
 
+class IndexNotFound(Exception):
+    def __init__(self, field, path):
+        msg = "No extra index on field '%s' in '%s'" % (field, path)
+        super(IndexNotFound, self).__init__(msg)
+
 class BBIFile(object):
     """
     Common superclass of BigWig and BigBed files.
+
+    By default, queries descend the on-disk R trees directly. If 
+    cache_index is True, all the leaves of each R tree are instead
+    read into memory on first use, which is faster for many repeated
+    queries against the same file.
+
+    Decoded data sections are cached in section_cache, which defaults to 
+    the process-wide :py:data:`SECTION_CACHE`.
+
+    The path can be a local path, an HTTP(S) URL (read with range requests
+    through an :py:class:`HTTPSource`), or a byte source object.
+
+    All reads are made at explicit offsets of a shared byte source (an 
+    mmap for local files), without seeking, so one open BBI file can 
+    serve concurrent queries from many threads. Section decompression
+    releases the GIL, so a thread pool querying a single file can make
+    use of multiple cores.
     """
-    def __init__(self, path):
+    def __init__(self, path, cache_index=False, section_cache=None):
         self._path = path
-        self._handle = open(path, "r+b")
-        self._map = mmap.mmap(self._handle.fileno(), 0)
+        self._cache_index = cache_index
+        self._section_cache = SECTION_CACHE if section_cache is None \
+                else section_cache
+        self._map = open_source(path)
+        self._file_id = self._map.identity
         self.header = read_struct(self._map, BBIHeader)
         self.summary = read_struct(self._map, TotalSummary,
                                    offset=self.header.totalSummaryOffset)
 
-        # Read contigs from B+ Tree
-        self._contig_by_id = {}
-        self._contig_by_name = {}
-        for leaf in BPTree(self._map, self.header.chromosomeTreeOffset):
-            contig = Contig(leaf.key.decode("ascii").rstrip('\x00'), 
-                            leaf.chromId, leaf.chromSize)
-            self._contig_by_id[contig.id] = contig
-            self._contig_by_name[contig.name] = contig
-
-        # Read dataCount (# sections for BigWig, # elements in BigBED)
-        self._map.seek(self.header.fullDataOffset)
-        self.dataCount = int.from_bytes(self._map.read(4), byteorder="little")
+        # The contig table and dataCount are read on first use, so that
+        # opening a file only reads the headers
+        self._contig_tree = None
+        self._contigs = None
+        self._contig_lookup = {}
+        self._data_count = None
+
+        # Zoom level headers immediately follow the main header, and are
+        # sorted by increasing reduction level
+        self.zoom_levels = read_struct(self._map, ZoomHeader,
+                                       count=self.header.zoomLevels,
+                                       offset=BBIHeader._struct.size)
+        self._zoom_leaves = {}
+        self._leaf_index = None
         
+    @property
+    def _contig_by_id(self):
+        if self._contigs is None:
+            contigs = {}
+            for leaf in self._contig_index:
+                contig = Contig(leaf.key.decode("ascii").rstrip('\x00'), 
+                                leaf.chromId, leaf.chromSize)
+                contigs[contig.id] = contig
+                self._contig_lookup[contig.name] = contig.id
+            self._contigs = contigs
+        return self._contigs
+
+    @property
+    def _contig_index(self):
+        if self._contig_tree is None:
+            self._contig_tree = BPTree(self._map, 
+                                       self.header.chromosomeTreeOffset)
+        return self._contig_tree
+
+    @property
+    def dataCount(self):
+        """
+        The number of data sections (BigWig) or elements (BigBED).
+        """
+        if self._data_count is None:
+            offset = self.header.fullDataOffset
+            self._data_count = int.from_bytes(self._map[offset:offset+4], 
+                                              byteorder="little")
+        return self._data_count
+
     @property
     def _leaves(self):
-        if not hasattr(self, "__leaves"):
-            # Read index sections from RTree and cache them in an Interval Tree
-            self.__leaves = GenomicRegionRAMIndex()
-            for leaf in RTree(self._map, self.header.fullIndexOffset):
-                for contig_id in range(leaf.startChromIx, leaf.endChromIx+1):
-                    start = leaf.startBase if (contig_id == leaf.startChromIx) else 0
-                    end = leaf.endBase if (contig_id == leaf.endChromIx) \
-                          else self._contig_by_id[contig_id].size
-                    self.__leaves.add(contig_id, start, end, leaf)
-            self.__leaves.build()
-        return self.__leaves
+        if self._leaf_index is None:
+            self._leaf_index = self._open_index(self.header.fullIndexOffset)
+        return self._leaf_index
+
+    def _open_index(self, offset):
+        index = RTree(self._map, offset)
+        if self._cache_index:
+            # Read index sections from RTree and cache them in a LeafIndex
+            index = LeafIndex(index, self._contig_by_id)
+        return index
+
+    def close(self):
+        """
+        Close the underlying byte source. Cached sections from this file
+        remain in the section cache.
+        """
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
     def __del__(self):
         try:
             self._map.close()
-            self._handle.close()
         except AttributeError:
             pass
     
@@ -213,8 +879,7 @@ class BBIFile(object):
     ########################
 
     def _decompress_section(self, leaf):
-        self._map.seek(leaf.dataOffset)
-        data = self._map.read(leaf.dataSize)
+        data = self._map[leaf.dataOffset:leaf.dataOffset + leaf.dataSize]
         if self.header.uncompressBufSize > 0:
             data = zlib.decompress(data, 15, self.header.uncompressBufSize)
         return data
@@ -228,16 +893,97 @@ class BBIFile(object):
     
     def _read_section_data(self, leaf, data):
         raise NotImplementedError
+
+    def _prefetch(self, leaves):
+        """
+        Let the byte source fetch the data sections under these leaves
+        together (for remote files), and return the leaves.
+        """
+        leaves = list(leaves)
+        self._map.prefetch([(leaf.dataOffset, leaf.dataSize) 
+                            for leaf in leaves])
+        return leaves
+
+    def _all_leaves(self):
+        """
+        Iterate through all the RTree leaves, in order.
+        """
+        leaves = RTree(self._map, self.header.fullIndexOffset)
+        for chunk in chunks(leaves, BATCH_SECTIONS):
+            yield from self._prefetch(chunk)
+
+    def _cached_section(self, leaf, decode):
+        return self._section_cache.get((self._file_id, leaf.dataOffset),
+                                       lambda: decode(leaf))
+
+    ###################
+    # Zoom level access
+    ###################
+
+    def _best_zoom(self, bases_per_bin):
+        """
+        Return the coarsest zoom level that still has at least two 
+        records per bin of the given size (as in the Kent utilities),
+        or None if the full resolution data must be used.
+        """
+        desired = bases_per_bin // 2
+        best = None
+        for zoom in self.zoom_levels:
+            if zoom.reductionLevel <= desired:
+                if (best is None) or (zoom.reductionLevel > best.reductionLevel):
+                    best = zoom
+        return best
+
+    def _read_zoom_section(self, leaf):
+        return self._cached_section(leaf, self._decode_zoom_section)
+
+    def _decode_zoom_section(self, leaf):
+        return numpy.frombuffer(self._decompress_section(leaf), dtype=ZoomDatum)
+
+    def _zoom_index(self, zoom):
+        index = self._zoom_leaves.get(zoom.indexOffset)
+        if index is None:
+            index = self._open_index(zoom.indexOffset)
+            self._zoom_leaves[zoom.indexOffset] = index
+        return index
+
+    def _search_zoom(self, zoom, contig_id, start, end):
+        """
+        Return an array of the zoom records from the given zoom level
+        which overlap the query region.
+        """
+        chunks = []
+        leaves = self._zoom_index(zoom).search(contig_id, start, end)
+        for leaf in self._prefetch(leaves):
+            records = self._read_zoom_section(leaf)
+            ix = (records["chromId"] == contig_id) & \
+                    (records["start"] < end) & (start < records["end"])
+            chunks.append(records[ix])
+        if not chunks:
+            return numpy.zeros(0, dtype=ZoomDatum)
+        return numpy.concatenate(chunks)
     
     ###################
     # Utility functions
     ###################
 
     def _get_contig_id(self, name):
-        contig = self._contig_by_name.get(name)
-        if contig is None:
-            raise ContigNotFound(name, self._path)
-        return contig.id
+        # Single lookups descend the B+ tree rather than reading the
+        # whole contig table, which may have many thousands of entries
+        id = self._contig_lookup.get(name)
+        if id is None:
+            leaves = []
+            if self._contigs is None:
+                try:
+                    key = name.encode("ascii")
+                except UnicodeEncodeError:
+                    key = None
+                if key is not None:
+                    leaves = self._contig_index.search(key)
+            if not leaves:
+                raise ContigNotFound(name, self._path)
+            id = self._contig_lookup[name] = leaves[0].chromId
+        return id
 
     #######################
     # Searching for regions
@@ -247,7 +993,7 @@ class BBIFile(object):
         """
         Search the RTree for RLeafItems overlapping the given region.
         """
-        yield from self._leaves.search(contig_id, start, end)
+        return self._prefetch(self._leaves.search(contig_id, start, end))
     
     def _search(self, contig_id, start, end):
         for leaf in self._search_index(contig_id, start, end):
@@ -267,7 +1013,7 @@ class BBIFile(object):
         """
         Iterate through the elements (BED or BEDGraph) in this BBI file.
         """
-        for leaf in self._leaves:
+        for leaf in self._all_leaves():
             yield from self._read_section(leaf)
     
     def search(self, contig, start, end):
@@ -307,13 +1053,15 @@ class BigWigFile(BBIFile):
     varStep = 2 
     fixedStep = 3
 
-    def __init__(self, path):
-        super(BigWigFile, self).__init__(path)
+    def __init__(self, path, cache_index=False, section_cache=None):
+        super(BigWigFile, self).__init__(path, cache_index=cache_index,
+                                         section_cache=section_cache)
         assert(self.header.magic==0x888FFC26)
-        cache = lru_cache(maxsize=16)
-        self._read_section_internal = cache(self._read_section_internal)
     
     def _read_section_internal(self, leaf):
+        return self._cached_section(leaf, self._decode_section)
+
+    def _decode_section(self, leaf):
         data = self._decompress_section(leaf)
         section_header_values = BigWigSectionHeader._struct.unpack_from(data)
         section_header = BigWigSectionHeader._make(section_header_values)
@@ -323,18 +1071,30 @@ class BigWigFile(BBIFile):
             return numpy.frombuffer(data, dtype=BedGraphDatum)
 
         elif section_header.type == BigWigFile.varStep:
-            elements = numpy.frombuffer(data, dtype=VarStepDatum)
-            end = numpy.zeros(len(elements), dtype="f4")
-            end[-1] = section_header.chromEnd
-            end[:-1] = elements["start"][1:]
-            columns = (elements["start"], end, elements["value"])
-            records = numpy.core.records.fromarrays(columns,
-                                                    dtype=BedGraphDatum)
+            elements = numpy.frombuffer(data, dtype=VarStepDatum,
+                                        count=section_header.itemCount)
+            records = numpy.empty(len(elements), dtype=BedGraphDatum)
+            records["start"] = elements["start"]
+            records["end"] = elements["start"] + section_header.itemSpan
+            records["value"] = elements["value"]
+            records.flags.writeable = False
             return records
+
         elif section_header.type == BigWigFile.fixedStep:
-            msg = "FixedStep BigWig not currently supported."
-            raise NotImplementedError(msg)
-        
+            # Only the values are stored; the positions are implied by
+            # the section start, step, and span. The records are built
+            # as a (read-only) copy in the same layout as the other
+            # section types, not as a view of the section.
+            values = numpy.frombuffer(data, dtype="f4",
+                                      count=section_header.itemCount)
+            records = numpy.empty(len(values), dtype=BedGraphDatum)
+            records["start"] = section_header.chromStart + \
+                    section_header.itemStep * numpy.arange(len(values))
+            records["end"] = records["start"] + section_header.itemSpan
+            records["value"] = values
+            records.flags.writeable = False
+            return records
+
         else:
             raise IOError("BigWig data section type '%s' not a recognized value (corrupted or invalid file?)." % section_header.type)
 
@@ -360,32 +1120,125 @@ class BigWigFile(BBIFile):
     # Public API (BigWig specific methods)
     ######################################
 
-    def _collapse_runs(self, elements):
-        # The Kent utilities collapse adjacent elements with the
-        # same value, so we do too for comparability
-        prev = next(elements)
-        for e in elements:
-            if (prev.chrom == e.chrom) and \
-               (prev.end == e.start) and \
-               (abs(prev.value - e.value) < 1e-3):
-                prev = BEDGraph(prev.chrom, prev.start, e.end, prev.value)
-            else:
-                yield prev
-                prev = e
-        yield prev
-    
+    def iter_chunks(self, chrom=None, start=None, end=None):
+        """
+        Iterate through the records of this file (or those overlapping the
+        given region) as (contig name, record array) pairs, with one 
+        array of BedGraphDatum records per data section. If only chrom is
+        given, the region is the whole contig.
+
+        As in the Kent utilities, adjacent records with (nearly) the same 
+        value are collapsed into one (see :py:func:`collapse_runs`), 
+        including runs which span data sections.
+        """
+        if chrom is None:
+            sections = ((leaf.startChromIx, self._read_section_internal(leaf))
+                        for leaf in self._all_leaves())
+        else:
+            contig_id = self._get_contig_id(chrom)
+            if start is None:
+                start = 0
+            if end is None:
+                end = self._contig_by_id[contig_id].size
+            sections = ((contig_id, self._search_leaf_internal(leaf, contig_id,
+                                                               start, end))
+                        for leaf in self._search_index(contig_id, start, end))
+
+        # The last run of each section is held back, since it may
+        # continue into the next section
+        carry, carry_id = None, None
+        for contig_id, records in sections:
+            if not len(records):
+                continue
+            if carry is not None:
+                if carry_id == contig_id:
+                    records = numpy.concatenate([carry, records])
+                else:
+                    yield self._contig_by_id[carry_id].name, carry
+            records = collapse_runs(records)
+            if len(records) > 1:
+                yield self._contig_by_id[contig_id].name, records[:-1]
+            carry, carry_id = records[-1:], contig_id
+        if carry is not None:
+            yield self._contig_by_id[carry_id].name, carry
+
+    def _iter_records(self, chunks):
+        for chrom, records in chunks:
+            columns = (records["start"].tolist(), records["end"].tolist(),
+                       records["value"].tolist())
+            for start, end, value in zip(*columns):
+                yield BEDGraph(chrom, start, end, value)
+
     def __iter__(self):
-        it = super(BigWigFile, self).__iter__()
-        return self._collapse_runs(it)
+        return self._iter_records(self.iter_chunks())
         
     def search(self, chrom, start, end):
-        it = super(BigWigFile, self).search(chrom, start, end)
-        return self._collapse_runs(it)
+        return self._iter_records(self.iter_chunks(chrom, start, end))
 
     def __len__(self):
-        return sum(1 for _ in self)
+        return sum(len(records) for _, records in self.iter_chunks())
+
+    def to_bedgraph(self, path):
+        """
+        Write the (run-collapsed) contents of this file to a bedGraph 
+        file path or handle.
+        """
+        handle = generic_open(path, "wt")
+        try:
+            for chrom, records in self.iter_chunks():
+                columns = (records["start"].tolist(), records["end"].tolist(),
+                           records["value"].tolist())
+                handle.write("".join("%s\t%d\t%d\t%g\n" % (chrom, start, end, value)
+                                     for start, end, value in zip(*columns)))
+        finally:
+            if handle is not path:
+                handle.close()
+
+    def values(self, chrom, start, end, out=None):
+        """
+        Return the value of each base in the given region as a float32
+        array, with NaN for bases without data.
 
-    def summarize_region(self, chrom, start, end):
+        If out is given, it must be a (writable) float array of length
+        end - start, such as a row of a preallocated matrix, and the
+        values are written into it directly.
+        """
+        length = end - start
+        assert(length > 0)
+        if out is None:
+            out = numpy.empty(length, dtype="f4")
+        assert(out.shape == (length,))
+        out.fill(numpy.nan)
+
+        try:
+            contig_id = self._get_contig_id(chrom)
+        except ContigNotFound:
+            return out
+
+        for leaf in self._search_index(contig_id, start, end):
+            regions = self._search_leaf_internal(leaf, contig_id, start, end)
+            if not len(regions):
+                continue
+            r_start = numpy.maximum(regions["start"] - start, 0)
+            r_end = numpy.minimum(regions["end"] - start, length)
+            lengths = r_end - r_start
+            # Offsets into the output of each base covered by a record
+            ix = numpy.arange(lengths.sum()) + \
+                    numpy.repeat(r_start - (numpy.cumsum(lengths) - lengths),
+                                 lengths)
+            out[ix] = numpy.repeat(regions["value"], lengths)
+        return out
+
+    def summarize_region(self, chrom, start, end, exact=False):
+        """
+        Summarize the values in the given region. 
+
+        Unless exact is True, the summary is computed from the coarsest 
+        zoom level that still has at least two records in the region,
+        rather than decompressing the full resolution data. Zoom records 
+        which overlap the region edges are weighted by the fraction of 
+        the record which overlaps, so such summaries are approximate.
+        """
         length = end - start
         assert(length > 0)
 
@@ -394,6 +1247,10 @@ class BigWigFile(BBIFile):
         except ContigNotFound:
             return RegionSummary(length, 0, 0, 0, 0)
 
+        zoom = None if exact else self._best_zoom(length)
+        if zoom is not None:
+            return self._summarize_zoom(zoom, contig_id, start, end)
+
         bases_covered = 0
         sum_values = 0
         for leaf in self._search_index(contig_id, start, end):
@@ -416,39 +1273,1094 @@ class BigWigFile(BBIFile):
             mean = sum_values / bases_covered
         return RegionSummary(length, bases_covered, sum_values, mean0, mean)
 
+    def summarize_regions(self, regions, exact=False):
+        """
+        Summarize the values in many regions at once.
+
+        The regions can be any input accepted by :py:func:`region_arrays`,
+        such as a DataFrame or a BED file path. Queries are grouped 
+        by contig, zoom level and data section, so each data section 
+        is decompressed at most once, and the summaries are computed 
+        with sorted array operations instead of per-query searches.
+        The choice of zoom level is made per query as in
+        :py:meth:`summarize_region`.
+
+        Returns a RegionSummary whose fields are numpy arrays, in the
+        same order as the input regions.
+        """
+        contigs, starts, ends = region_arrays(regions)
+        size = ends - starts
+        assert((size > 0).all())
+        covered = numpy.zeros(len(size))
+        sums = numpy.zeros(len(size))
+
+        zoom_ix = self._zoom_indices(size, exact)
+        for zoom, contig_id, q_ix in self._query_groups(contigs, zoom_ix):
+            self._summarize_many(zoom, contig_id, q_ix, 
+                                 starts, ends, covered, sums)
+
+        mean0 = sums / size
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            mean = sums / covered
+        empty = sums == 0
+        mean0[empty] = 0
+        mean[empty] = 0
+        return RegionSummary(size, covered, sums, mean0, mean)
+
+    def stats(self, chrom, start, end, nbins=1, stat="mean", exact=False):
+        """
+        Summarize the values in the given region, divided into nbins
+        equally sized bins, as in the Kent bigWigSummary utility. 
+
+        The statistic can be one of "mean", "min", "max", "coverage"
+        (the fraction of bases with data), or "std". Bins without data
+        are NaN (except for coverage, which is 0). Unless exact is True,
+        the statistics are computed from the coarsest zoom level with 
+        at least two records per bin, as in :py:meth:`summarize_region`.
+
+        Returns a float32 array of length nbins.
+        """
+        return self.stats_many(([chrom], [start], [end]), nbins=nbins,
+                               stat=stat, exact=exact)[0]
+
+    def stats_many(self, regions, nbins=1, stat="mean", exact=False):
+        """
+        Summarize the values in many regions at once, each divided into
+        nbins equally sized bins. The regions can be any input accepted
+        by :py:func:`region_arrays`, and the statistics are as described
+        in :py:meth:`stats`. As in :py:meth:`summarize_regions`, each data
+        section is decompressed at most once.
+
+        Returns a (regions x bins) float32 matrix, with rows in the 
+        same order as the input regions.
+        """
+        if stat not in STATS:
+            raise ValueError("Unknown statistic '%s' (must be one of: %s)" % \
+                             (stat, ", ".join(STATS)))
+        contigs, starts, ends = region_arrays(regions)
+        size = ends - starts
+        assert(nbins > 0)
+        assert((size >= nbins).all())
+
+        shape = (len(size), nbins)
+        acc = BinStats(numpy.zeros(shape), numpy.full(shape, numpy.inf),
+                       numpy.full(shape, -numpy.inf), 
+                       numpy.zeros(shape), numpy.zeros(shape))
+
+        zoom_ix = self._zoom_indices(size // nbins, exact)
+        for zoom, contig_id, q_ix in self._query_groups(contigs, zoom_ix):
+            self._stats_many(zoom, contig_id, q_ix, starts, ends, acc)
+
+        valid = acc.valid
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            if stat == "coverage":
+                # Bin sizes differ by at most one base
+                edges = starts[:,None] + \
+                        size[:,None] * numpy.arange(nbins + 1) // nbins
+                result = valid / numpy.diff(edges, axis=1)
+            elif stat == "mean":
+                result = acc.sum / valid
+            elif stat == "min":
+                result = acc.min
+            elif stat == "max":
+                result = acc.max
+            elif stat == "std":
+                variance = (acc.sumSquares - acc.sum ** 2 / valid) / (valid - 1)
+                result = numpy.sqrt(numpy.maximum(variance, 0))
+                result[valid <= 1] = 0
+        if stat != "coverage":
+            result[valid == 0] = numpy.nan
+        return result.astype("f4")
+
+    def _zoom_indices(self, bases_per_bin, exact=False):
+        """
+        Return the index of the zoom level to use for each bin size,
+        chosen as in :py:meth:`BBIFile._best_zoom` (-1 = full data).
+        """
+        levels = [zoom.reductionLevel for zoom in self.zoom_levels]
+        if exact or not levels:
+            return numpy.full(len(bases_per_bin), -1)
+        order = numpy.argsort(levels, kind="mergesort")
+        zoom_ix = numpy.searchsorted(numpy.array(levels)[order],
+                                     bases_per_bin // 2, side="right") - 1
+        return numpy.where(zoom_ix >= 0, order[zoom_ix], -1)
+
+    def _query_groups(self, contigs, zoom_ix):
+        """
+        Group query indices by contig and zoom level, skipping
+        contigs which are not in this file.
+
+        Yields (zoom, contig_id, query indices) tuples.
+        """
+        for contig in numpy.unique(contigs):
+            try:
+                contig_id = self._get_contig_id(contig)
+            except ContigNotFound:
+                continue
+            in_contig = contigs == contig
+            for level in numpy.unique(zoom_ix[in_contig]):
+                q_ix = numpy.flatnonzero(in_contig & (zoom_ix == level))
+                zoom = self.zoom_levels[level] if level >= 0 else None
+                yield zoom, contig_id, q_ix
+
+    def _summary_records(self, zoom, contig_id, leaf):
+        """
+        Return (start, end, valid, sum) arrays for the records in the
+        given full resolution or zoom data section.
+        """
+        if zoom is None:
+            records = self._read_section_internal(leaf)
+            start = records["start"].astype("i8")
+            end = records["end"].astype("i8")
+            valid = end - start
+            return start, end, valid, valid * records["value"].astype("f8")
+        else:
+            records = self._read_zoom_section(leaf)
+            records = records[records["chromId"] == contig_id]
+            return (records["start"].astype("i8"), records["end"].astype("i8"),
+                    records["validCount"].astype("f8"), 
+                    records["sumData"].astype("f8"))
+
+    def _stat_records(self, zoom, contig_id, leaf):
+        """
+        Return (start, end, valid, min, max, sum, sumSquares) arrays 
+        for the records in the given full resolution or zoom data section.
+        """
+        if zoom is None:
+            records = self._read_section_internal(leaf)
+            start = records["start"].astype("i8")
+            end = records["end"].astype("i8")
+            valid = (end - start).astype("f8")
+            value = records["value"].astype("f8")
+            return (start, end, valid, value, value, 
+                    valid * value, valid * value ** 2)
+        else:
+            records = self._read_zoom_section(leaf)
+            records = records[records["chromId"] == contig_id]
+            return (records["start"].astype("i8"), records["end"].astype("i8"),
+                    records["validCount"].astype("f8"), 
+                    records["minVal"].astype("f8"),
+                    records["maxVal"].astype("f8"),
+                    records["sumData"].astype("f8"),
+                    records["sumSquares"].astype("f8"))
+
+    def _stats_many(self, zoom, contig_id, q_ix, starts, ends, acc):
+        q_start, q_end = starts[q_ix], ends[q_ix]
+        nbins = acc.valid.shape[1]
+        index = self._leaves if zoom is None else self._zoom_index(zoom)
+
+        leaves = index.search_many(contig_id, q_start, q_end)
+        for chunk in chunks(leaves, BATCH_SECTIONS):
+            self._prefetch(chunk)
+            parts = [self._stat_records(zoom, contig_id, leaf) 
+                     for leaf in chunk]
+            records = [numpy.concatenate(column) for column in zip(*parts)]
+            r_start, r_end = records[:2]
+            if not len(r_start):
+                continue
+            lo = numpy.searchsorted(r_end, q_start, side="right")
+            hi = numpy.searchsorted(r_start, q_end, side="left")
+            for i in numpy.flatnonzero(hi > lo):
+                start, end = q_start[i], q_end[i]
+                edges = start + (end - start) * numpy.arange(nbins + 1) // nbins
+                bin, valid, min_val, max_val, sums, sum_squares = \
+                        bin_records([c[lo[i]:hi[i]] for c in records], edges)
+                row = q_ix[i]
+                acc.valid[row] += numpy.bincount(bin, valid, nbins)
+                acc.sum[row] += numpy.bincount(bin, sums, nbins)
+                acc.sumSquares[row] += numpy.bincount(bin, sum_squares, nbins)
+                numpy.minimum.at(acc.min[row], bin, min_val)
+                numpy.maximum.at(acc.max[row], bin, max_val)
+
+    def _summarize_many(self, zoom, contig_id, q_ix, 
+                        starts, ends, covered, sums):
+        q_start, q_end = starts[q_ix], ends[q_ix]
+        index = self._leaves if zoom is None else self._zoom_index(zoom)
+
+        leaves = index.search_many(contig_id, q_start, q_end)
+        for chunk in chunks(leaves, BATCH_SECTIONS):
+            self._prefetch(chunk)
+            parts = [self._summary_records(zoom, contig_id, leaf) 
+                     for leaf in chunk]
+            r_start, r_end, r_valid, r_sum = \
+                    [numpy.concatenate(column) for column in zip(*parts)]
+            if not len(r_start):
+                continue
+            ix = (q_start < r_end[-1]) & (q_end > r_start[0])
+            c, s = summarize_sorted(r_start, r_end, r_valid, r_sum,
+                                    q_start[ix], q_end[ix])
+            covered[q_ix[ix]] += c
+            sums[q_ix[ix]] += s
+
+    def _summarize_zoom(self, zoom, contig_id, start, end):
+        length = end - start
+        records = self._search_zoom(zoom, contig_id, start, end)
+        r_start = records["start"].astype("i8")
+        r_end = records["end"].astype("i8")
+        overlap = numpy.minimum(r_end, end) - numpy.maximum(r_start, start)
+        fraction = overlap / (r_end - r_start)
+
+        bases_covered = (records["validCount"] * fraction).sum()
+        sum_values = (records["sumData"] * fraction).sum()
+        if sum_values == 0:
+            mean0, mean = 0, 0
+        else:
+            mean0 = sum_values / length
+            mean = sum_values / bases_covered
+        return RegionSummary(length, bases_covered, sum_values, mean0, mean)
+
+class BEDBatch(object):
+    """
+    A batch of BigBED records, stored as parallel numpy arrays of 
+    contig IDs, starts, ends, names, scores and strands. The fields 
+    after the strand ("rest") are only split and decoded when first
+    accessed.
+    """
+    def __init__(self, contigs, chromId, start, end, name, score, strand,
+                 data, rest_start, rest_end):
+        self._contigs = contigs
+        self.chromId = chromId
+        self.start = start
+        self.end = end
+        self.name = name
+        self.score = score
+        self.strand = strand
+        self._data = data
+        self._rest_start = rest_start
+        self._rest_end = rest_end
+        self._rest = None
+
+    def __len__(self):
+        return len(self.start)
+
+    @property
+    def nbytes(self):
+        """
+        The approximate memory used by the batch, as counted by the 
+        :py:class:`SectionCache`: its arrays, the section text, and the
+        names split from it.
+        """
+        arrays = (self.chromId, self.start, self.end, self.name, self.score,
+                  self.strand, self._rest_start, self._rest_end)
+        return sum(a.nbytes for a in arrays) + 2 * len(self._data)
+
+    def __getitem__(self, ix):
+        """
+        Select a subset of the records with a slice, an index array,
+        or a boolean mask.
+        """
+        batch = BEDBatch(self._contigs, self.chromId[ix], 
+                         self.start[ix], self.end[ix], self.name[ix],
+                         self.score[ix], self.strand[ix], self._data,
+                         self._rest_start[ix], self._rest_end[ix])
+        if self._rest is not None:
+            batch._rest = self._rest[ix]
+        return batch
+
+    @property
+    def chrom(self):
+        """
+        The contig name of each record.
+        """
+        ids, inverse = numpy.unique(self.chromId, return_inverse=True)
+        names = numpy.array([self._contigs[id].name for id in ids.tolist()],
+                            dtype=object)
+        return names[inverse]
+
+    @property
+    def rest(self):
+        """
+        The tuple of fields after the strand for each record (or None
+        if there are no such fields).
+        """
+        if self._rest is None:
+            data = self._data
+            rest = numpy.empty(len(self), dtype=object)
+            spans = zip(self._rest_start.tolist(), self._rest_end.tolist())
+            for i, (start, end) in enumerate(spans):
+                if end > start:
+                    rest[i] = tuple(data[start:end].split(b'\t'))
+            self._rest = rest
+        return self._rest
+
+    def __iter__(self):
+        columns = (self.chrom, self.start.tolist(), self.end.tolist(), 
+                   self.name, self.score.tolist(), self.strand.tolist(), 
+                   self.rest)
+        for fields in zip(*columns):
+            yield BED(*fields)
+
+    def to_frame(self, rest=False):
+        """
+        Return the records as a :py:class:`pandas.DataFrame`, optionally
+        including the (decoded) rest field.
+        """
+        import pandas as pd
+        columns = [("chrom", self.chrom), ("start", self.start), 
+                   ("end", self.end), ("name", self.name), 
+                   ("score", self.score), ("strand", self.strand)]
+        if rest:
+            columns.append(("rest", self.rest))
+        return pd.DataFrame.from_dict(dict(columns))
+
+def read_bed_section(data, contigs):
+    """
+    Decode a decompressed BigBED data section into a :py:class:`BEDBatch`,
+    scanning the section once by offset.
+    """
+    chrom_ids, starts, ends, names, scores, strands = [], [], [], [], [], []
+    rest_starts, rest_ends = [], []
+    unpack_position = Struct("=III").unpack_from
+    offset = 0
+    while offset < len(data):
+        contig, start, end = unpack_position(data, offset)
+        text = offset + 12
+        null = data.index(b'\0', text)
+        fields = data[text:null].split(b'\t', 3)
+        chrom_ids.append(contig)
+        starts.append(start)
+        ends.append(end)
+        names.append(fields[0])
+        scores.append(float(fields[1]) if len(fields) > 1 else numpy.nan)
+        strands.append(fields[2] if len(fields) > 2 else b'.')
+        rest_starts.append(null - len(fields[3]) if len(fields) > 3 else null)
+        rest_ends.append(null)
+        offset = null + 1
+
+    return BEDBatch(contigs, 
+                    numpy.array(chrom_ids, dtype="u4"), 
+                    numpy.array(starts, dtype="u4"), 
+                    numpy.array(ends, dtype="u4"),
+                    numpy.array(names, dtype=object), 
+                    numpy.array(scores, dtype="f8"),
+                    numpy.array(strands, dtype="S1"), 
+                    data,
+                    numpy.array(rest_starts, dtype="i8"),
+                    numpy.array(rest_ends, dtype="i8"))
+
 class BigBEDFile(BBIFile):
     """
     A BigBED format file. This is essentially a BED file indexed by genomic
     region and containing various summary statistics. 
+
+    Besides iterating over BED records, the records can be read in 
+    columnar batches (one per data section) with :py:meth:`iter_batches`
+    and :py:meth:`search_batches`. If the file has an extra index on the
+    name field, records can also be found by name with 
+    :py:meth:`search_name` and :py:meth:`search_names`.
     """ 
 
-    def __init__(self, path):
-        super(BigBEDFile, self).__init__(path)
+    def __init__(self, path, cache_index=False, section_cache=None):
+        super(BigBEDFile, self).__init__(path, cache_index=cache_index,
+                                         section_cache=section_cache)
         assert(self.header.magic==0x8789F2EB)
+
+        # Offsets of the extra B+ tree indices, by BED column number
+        self._extra_index_offsets = {}
+        self._extra_indices = {}
+        if (self.header.version >= 4) and self.header.extensionOffset:
+            extension = read_struct(self._map, ExtensionHeader,
+                                    offset=self.header.extensionOffset)
+            offset = extension.extraIndexListOffset
+            for _ in range(extension.extraIndexCount):
+                index = read_struct(self._map, ExtraIndexHeader, offset=offset)
+                offset += ExtraIndexHeader._struct.size
+                fields = read_struct(self._map, ExtraIndexField, 
+                                     count=index.fieldCount, offset=offset)
+                offset += ExtraIndexField._struct.size * index.fieldCount
+                # Only single-field indices are defined by the format
+                if len(fields) == 1:
+                    self._extra_index_offsets[fields[0].fieldId] = \
+                            index.fileOffset
+
+    def _extra_index(self, field):
+        index = self._extra_indices.get(field)
+        if index is None:
+            offset = self._extra_index_offsets.get(field)
+            if offset is None:
+                raise IndexNotFound(field, self._path)
+            # Index values are the location of the data section, so
+            # the leaf items can be read like RTree leaves
+            index = BPTree(self._map, offset, value_format="QQ", 
+                           value_fields="dataOffset dataSize")
+            self._extra_indices[field] = index
+        return index
+
+    def _read_batch(self, leaf):
+        return self._cached_section(leaf, self._decode_batch)
+
+    def _decode_batch(self, leaf):
+        batch = read_bed_section(self._decompress_section(leaf), 
+                                 self._contig_by_id)
+        # Cached batches are shared, so their arrays are read-only
+        for a in (batch.chromId, batch.start, batch.end, batch.name,
+                  batch.score, batch.strand):
+            a.flags.writeable = False
+        return batch
+
+    def _search_batch(self, leaf, contig_id, start, end):
+        batch = self._read_batch(leaf)
+        ix = (batch.chromId == contig_id) & \
+                (batch.start < end) & (start < batch.end)
+        return batch[ix]
     
     def _search_leaf(self, leaf, contig_id, start, end):
-        contig_name = self._contig_by_id[contig_id].name
-        for bed in self._read_section(leaf):
-            if contig_name == bed.chrom:
-                if (bed.start < end) and (start < bed.end):
-                    yield bed
+        return iter(self._search_batch(leaf, contig_id, start, end))
+
+    def _read_section(self, leaf):
+        return iter(self._read_batch(leaf))
 
     def _read_section_data(self, leaf, data):
-        records = []
-        while data:
-            contig, start, end = unpack("=III", data[:12])
-            data = data[12:]
-            _null = data.find(b'\0')
-            fields = data[:_null].split(b'\t')
-            name = fields[0] if fields else sys.intern('.')
-            score = float(fields[1]) if len(fields) > 1 else numpy.nan
-            strand = fields[2] if len(fields) > 2 else sys.intern('.')
-            rest = tuple(fields[3:]) if len(fields) > 3 else None
-            record = BED(self._contig_by_id[contig].name, 
-                         start, end, name, score, strand, rest)
-            records.append(record)
-            data = data[(_null+1):]
-        return records
+        return list(read_bed_section(data, self._contig_by_id))
+
+    def iter_batches(self):
+        """
+        Iterate through the records in this file as :py:class:`BEDBatch`
+        objects, one per data section.
+        """
+        for leaf in self._all_leaves():
+            yield self._read_batch(leaf)
+
+    def search_name(self, name):
+        """
+        Return the records with the given name, using the extra index
+        on the name field (raises IndexNotFound if there is none).
+        """
+        yield from self.search_names([name])
+
+    def search_names(self, names):
+        """
+        Return the records with any of the given names, using the extra
+        index on the name field (raises IndexNotFound if there is none).
+        Each data section containing these names is read only once.
+        """
+        index = self._extra_index(NAME_FIELD)
+        names = set(name.encode("ascii") if isinstance(name, str) else name
+                    for name in names)
+        blocks = {}
+        for name in names:
+            blocks.update((item.dataOffset, item) for item in index.search(name))
+        blocks = self._prefetch(block for _, block in sorted(blocks.items()))
+        for block in blocks:
+            batch = self._read_batch(block)
+            ix = numpy.fromiter((name in names for name in batch.name),
+                                dtype=bool, count=len(batch))
+            yield from batch[ix]
+
+    def search_batches(self, contig, start, end):
+        """
+        Return the records overlapping the query region as 
+        :py:class:`BEDBatch` objects, one per data section.
+        """
+        contig_id = self._get_contig_id(contig)
+        for leaf in self._search_index(contig_id, start, end):
+            batch = self._search_batch(leaf, contig_id, start, end)
+            if len(batch):
+                yield batch
     
     def __len__(self):
         return self.dataCount
+
+####################
+# Opening many files
+####################
+
+BBI_MAGIC = {0x888FFC26: "BigWigFile", 0x8789F2EB: "BigBEDFile"}
+
+def open_bbi(path, **kwargs):
+    """
+    Open a BigWig or BigBED file (as determined by its magic number),
+    passing any keyword arguments to its constructor.
+    """
+    source = open_source(path)
+    magic, = unpack("=I", source[:4])
+    if magic not in BBI_MAGIC:
+        source.close()
+        raise ValueError("'%s' is not a BigWig or BigBED file" % source)
+    return getattr(sys.modules[__name__], BBI_MAGIC[magic])(source, **kwargs)
+
+class BBIPool(object):
+    """
+    A thread-safe pool of open BBI files, keyed by path, which keeps at
+    most max_open files open at once by dropping the least recently used.
+
+    Since opening a file only reads its headers, this is suitable for 
+    querying thousands of files in turn without exhausting file handles
+    or address space. Dropped files are not closed by the pool, but as 
+    soon as no caller holds a reference to them, so files in use by 
+    other threads remain valid. Keyword arguments are passed to
+    :py:func:`open_bbi`.
+    """
+    def __init__(self, max_open=128, **kwargs):
+        assert(max_open > 0)
+        self._max_open = max_open
+        self._kwargs = kwargs
+        self._files = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """
+        Return the open BBI file at path, opening it if necessary.
+        """
+        with self._lock:
+            file = self._files.get(path)
+            if file is not None:
+                self._files.move_to_end(path)
+                return file
+
+        # Open without holding the lock; if another thread opened the
+        # same file meanwhile, its copy is kept
+        file = open_bbi(path, **self._kwargs)
+        with self._lock:
+            file = self._files.setdefault(path, file)
+            self._files.move_to_end(path)
+            while len(self._files) > self._max_open:
+                self._files.popitem(last=False)
+        return file
+
+    def __len__(self):
+        return len(self._files)
+
+    def __contains__(self, path):
+        return path in self._files
+
+    def close(self):
+        """
+        Close all the files in the pool.
+        """
+        with self._lock:
+            files = list(self._files.values())
+            self._files.clear()
+        for file in files:
+            file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+##########################
+# Multi-file summarization
+##########################
+
+# Per-process state of summarize_files workers: the shared result
+# matrix, the query regions, and a pool of open BigWig files
+_worker = {}
+
+def _init_summarize_worker(matrix, shape, regions, stat, exact, max_open):
+    _worker["matrix"] = numpy.frombuffer(matrix, dtype="f8").reshape(shape)
+    _worker["regions"] = regions
+    _worker["stat"] = stat
+    _worker["exact"] = exact
+    _worker["files"] = BBIPool(max_open)
+
+def _summarize_shard(task):
+    column, path, rows = task
+    bw = _worker["files"].get(path)
+    assert(isinstance(bw, BigWigFile))
+    contigs, starts, ends = _worker["regions"]
+    summary = bw.summarize_regions(
+            (contigs[rows], starts[rows], ends[rows]), exact=_worker["exact"])
+    _worker["matrix"][rows, column] = getattr(summary, _worker["stat"])
+
+def summarize_files(paths, regions, stat="mean", exact=False, 
+                    processes=None, max_open=128):
+    """
+    Summarize the given regions in each of many BigWig files, returning a
+    (regions x files) matrix of the given :py:class:`RegionSummary` field
+    ("mean", "mean0", "covered", or "sum").
+
+    The regions can be any input accepted by :py:func:`region_arrays`. 
+    Work is divided into (file, contig) shards over a pool of processes,
+    each of which keeps up to max_open files open across shards (in a
+    :py:class:`BBIPool`), and the results are written directly into a 
+    matrix in shared memory. With 
+    processes=1, everything is done in the current process.
+    """
+    assert(stat in ("mean", "mean0", "covered", "sum"))
+    regions = region_arrays(regions)
+    contigs = regions[0]
+    shape = (len(contigs), len(paths))
+    matrix = multiprocessing.RawArray("d", shape[0] * shape[1])
+
+    groups = [numpy.flatnonzero(contigs == contig) 
+              for contig in numpy.unique(contigs)]
+    tasks = [(column, path, rows) for column, path in enumerate(paths)
+             for rows in groups]
+
+    args = (matrix, shape, regions, stat, exact, max_open)
+    if processes == 1:
+        _init_summarize_worker(*args)
+        try:
+            for task in tasks:
+                _summarize_shard(task)
+        finally:
+            _worker.clear()
+    else:
+        with multiprocessing.Pool(processes, _init_summarize_worker, 
+                                  args) as pool:
+            for _ in pool.imap_unordered(_summarize_shard, tasks):
+                pass
+    return numpy.frombuffer(matrix, dtype="f8").reshape(shape)
+
+###############
+# BigWig writer
+###############
+
+def write_tree(handle, items, block_size, leaf_struct, non_leaf_struct, 
+               parent_item):
+    """
+    Write the nodes of a B+ tree or R tree at the current position of
+    the handle. The (sorted) leaf items are tuples for leaf_struct, and
+    parent_item(leaves, offset) returns the non-leaf item tuple for the
+    subtree containing the given leaf items, written at offset.
+    """
+    # Group the leaf items into nodes, and nodes into parent nodes,
+    # until a single root remains. The levels are ordered from the root.
+    levels = [[items[i:i+block_size] 
+               for i in range(0, len(items), block_size)] or [[]]]
+    while len(levels[0]) > 1:
+        nodes = levels[0]
+        levels.insert(0, [nodes[i:i+block_size] 
+                          for i in range(0, len(nodes), block_size)])
+
+    def flatten(node, depth):
+        if depth == 0:
+            return node
+        return [item for child in node for item in flatten(child, depth-1)]
+
+    # Nodes are written level by level, so offsets can be computed ahead
+    offsets = []
+    offset = handle.tell()
+    for depth, level in enumerate(levels):
+        is_leaf = depth == len(levels) - 1
+        item_size = (leaf_struct if is_leaf else non_leaf_struct).size
+        offsets.append([])
+        for node in level:
+            offsets[-1].append(offset)
+            offset += Node._struct.size + item_size * len(node)
+
+    for depth, level in enumerate(levels):
+        is_leaf = depth == len(levels) - 1
+        children = iter(offsets[depth+1]) if not is_leaf else None
+        for node in level:
+            handle.write(Node._struct.pack(is_leaf, False, len(node)))
+            for item in node:
+                if is_leaf:
+                    handle.write(leaf_struct.pack(*item))
+                else:
+                    leaves = flatten(item, len(levels) - depth - 2)
+                    item = parent_item(leaves, next(children))
+                    handle.write(non_leaf_struct.pack(*item))
+
+def write_rtree(handle, leaves, block_size, items_per_slot):
+    """
+    Write an R tree index over the given (sorted) RLeafItem tuples at the
+    current position of the handle, returning the index offset. The data
+    sections under the leaves hold at most items_per_slot items each.
+    """
+    offset = handle.tell()
+    first = leaves[0] if leaves else (0, 0, 0, 0)
+    last = max((leaf[2], leaf[3]) for leaf in leaves) if leaves else (0, 0)
+    handle.write(RTreeHeader._struct.pack(0x2468ACE0, block_size,
+                                          len(leaves), first[0], first[1],
+                                          last[0], last[1], offset,
+                                          items_per_slot, 0))
+    def parent_item(leaves, child_offset):
+        end = max((leaf[2], leaf[3]) for leaf in leaves)
+        return (leaves[0][0], leaves[0][1]) + end + (child_offset,)
+    write_tree(handle, leaves, block_size, RLeafItem._struct,
+               RNonLeafItem._struct, parent_item)
+    return offset
+
+class SectionWriter(object):
+    """
+    Compresses data sections in a thread pool and writes them, in order,
+    to a file handle, recording an R tree leaf item for each section.
+    """
+    def __init__(self, handle, executor, compress=True, max_pending=16):
+        self.leaves = []
+        self.max_size = 0
+        self._handle = handle
+        self._executor = executor
+        self._compress = compress
+        self._max_pending = max_pending
+        self._pending = deque()
+
+    def add(self, contig_id, start, end, data):
+        self.max_size = max(self.max_size, len(data))
+        if self._compress:
+            data = self._executor.submit(zlib.compress, data)
+        self._pending.append((contig_id, start, end, data))
+        while len(self._pending) > self._max_pending:
+            self._write_next()
+
+    def _write_next(self):
+        contig_id, start, end, data = self._pending.popleft()
+        if self._compress:
+            data = data.result()
+        offset = self._handle.tell()
+        self._handle.write(data)
+        self.leaves.append((contig_id, start, contig_id, end, 
+                            offset, len(data)))
+
+    def flush(self):
+        while self._pending:
+            self._write_next()
+
+class ZoomLevelWriter(object):
+    """
+    Accumulates the zoom records of one zoom level, whose bins are 
+    aligned to multiples of the reduction level, and writes them as 
+    sections to a temporary file.
+    """
+    def __init__(self, reduction, executor, compress, items_per_slot):
+        self.reduction = reduction
+        self.count = 0
+        self.handle = tempfile.TemporaryFile()
+        self.sections = SectionWriter(self.handle, executor, 
+                                      compress=compress)
+        self._items_per_slot = items_per_slot
+        self._pending = []
+        self._pending_count = 0
+        self._open = None
+
+    def add(self, records):
+        """
+        Add the zoom records for a chunk of one contig. The last record
+        is kept open, since the next chunk may continue its bin.
+        """
+        if self._open is not None:
+            if self._open["start"][0] == records["start"][0]:
+                first = records[:1].copy()
+                for field in ("validCount", "sumData", "sumSquares"):
+                    first[field] += self._open[field]
+                first["minVal"] = numpy.minimum(first["minVal"], 
+                                                self._open["minVal"])
+                first["maxVal"] = numpy.maximum(first["maxVal"], 
+                                                self._open["maxVal"])
+                records = numpy.concatenate([first, records[1:]])
+            else:
+                self._append(self._open)
+        self._append(records[:-1])
+        self._open = records[-1:].copy()
+
+    def _append(self, records):
+        self._pending.append(records)
+        self._pending_count += len(records)
+        self.count += len(records)
+        if self._pending_count >= self._items_per_slot:
+            self._write_sections(flush=False)
+
+    def _write_sections(self, flush):
+        records = numpy.concatenate(self._pending)
+        n = self._items_per_slot
+        end = len(records) if flush else len(records) - (len(records) % n)
+        for i in range(0, end, n):
+            section = records[i:i+n]
+            self.sections.add(int(section["chromId"][0]), 
+                              int(section["start"][0]),
+                              int(section["end"][-1]), section.tobytes())
+        self._pending = [records[end:]]
+        self._pending_count = len(records) - end
+
+    def end_contig(self):
+        """
+        Write any remaining records of the current contig.
+        """
+        if self._open is not None:
+            self._append(self._open)
+            self._open = None
+        if self._pending_count:
+            self._write_sections(flush=True)
+
+def reduce_bins(bin, valid, min_val, max_val, sums, sum_squares):
+    """
+    Combine the (sorted) bin pieces with the same bin number.
+    """
+    ix = numpy.concatenate([[0], numpy.flatnonzero(numpy.diff(bin)) + 1])
+    return (bin[ix], numpy.add.reduceat(valid, ix), 
+            numpy.minimum.reduceat(min_val, ix), 
+            numpy.maximum.reduceat(max_val, ix),
+            numpy.add.reduceat(sums, ix), 
+            numpy.add.reduceat(sum_squares, ix))
+
+class BigWigWriter(object):
+    """
+    Writes a BigWig file in a single streaming pass, using memory 
+    bounded by the number of data sections rather than the number of
+    records. Use as a context manager, or call :py:meth:`close` to 
+    finish writing the file.
+
+    The contigs are a sequence of (name, size) pairs (or a dict), and
+    the records must be written sorted by contig, in the same order as
+    the contigs, and then by position, without overlaps. Data sections
+    and zoom records are compressed in a pool of threads.
+
+    Zoom levels are computed with bins aligned to multiples of each 
+    reduction level, and only the levels which at least halve the 
+    number of records of the previous level are written.
+    """
+    def __init__(self, path, contigs, items_per_slot=ITEMS_PER_SLOT,
+                 block_size=BLOCK_SIZE, reductions=ZOOM_REDUCTIONS,
+                 compress=True, threads=None):
+        if hasattr(contigs, "items"):
+            contigs = contigs.items()
+        self._path = path
+        self._contigs = [Contig(name, id, size) 
+                         for id, (name, size) in enumerate(contigs)]
+        self._contig_by_name = dict((c.name, c) for c in self._contigs)
+        self._items_per_slot = items_per_slot
+        self._block_size = block_size
+        self._compress = compress
+        for coarse, fine in zip(reductions[1:], reductions):
+            assert(coarse % fine == 0)
+
+        threads = threads or os.cpu_count() or 1
+        self._executor = ThreadPoolExecutor(threads)
+        self._handle = open(path, "w+b")
+
+        # Reserve space for the header, zoom headers, and total summary
+        self._summary_offset = BBIHeader._struct.size + \
+                ZoomHeader._struct.size * len(reductions)
+        self._handle.write(bytes(self._summary_offset + 
+                                 TotalSummary._struct.size))
+        self._contig_tree_offset = self._handle.tell()
+        self._write_contig_tree()
+
+        self._data_offset = self._handle.tell()
+        self._handle.write(bytes(4))
+        self._sections = SectionWriter(self._handle, self._executor,
+                                       compress=compress, 
+                                       max_pending=4*threads)
+        self._zoom_levels = [ZoomLevelWriter(r, self._executor, compress,
+                                             items_per_slot) 
+                             for r in reductions]
+
+        self._buffer = numpy.zeros(0, dtype=BedGraphDatum)
+        self._contig = None
+        self._position = (-1, 0)
+        self._count = 0
+        self._summary = [0, numpy.inf, -numpy.inf, 0.0, 0.0]
+        self._closed = False
+
+    def _write_contig_tree(self):
+        key_size = max([len(c.name.encode("ascii")) for c in self._contigs] 
+                       or [1])
+        items = sorted((c.name.encode("ascii").ljust(key_size, b'\0'), 
+                        c.id, c.size) for c in self._contigs)
+        block_size = max(1, min(self._block_size, len(items)))
+        self._handle.write(BPTreeHeader._struct.pack(
+            0x78CA8C91, block_size, key_size, 8, len(items), 0))
+        write_tree(self._handle, items, block_size, 
+                   Struct("=%dsII" % key_size), Struct("=%dsQ" % key_size),
+                   lambda leaves, offset: (leaves[0][0], offset))
+
+    ##########
+    # Writing
+    ##########
+
+    def write(self, records):
+        """
+        Write an iterable of (contig, start, end, value) records, such as
+        :py:class:`BEDGraph` tuples.
+        """
+        for chunk in chunks(records, WRITE_CHUNK_SIZE):
+            self.write_arrays(*zip(*chunk))
+
+    def write_arrays(self, contigs, starts, ends, values):
+        """
+        Write a chunk of records given as arrays. The contigs can be
+        a single contig name for the whole chunk, or a sequence.
+        """
+        starts = numpy.asarray(starts, dtype="i8")
+        ends = numpy.asarray(ends, dtype="i8")
+        values = numpy.asarray(values, dtype="f4")
+        assert(len(starts) == len(ends) == len(values))
+        if not len(starts):
+            return
+
+        if isinstance(contigs, str):
+            bounds = [0, len(starts)]
+            names = [contigs]
+        else:
+            contigs = numpy.asarray(contigs, dtype=object)
+            change = numpy.flatnonzero(contigs[1:] != contigs[:-1]) + 1
+            bounds = [0] + change.tolist() + [len(starts)]
+            names = contigs[bounds[:-1]]
+
+        for name, lo, hi in zip(names, bounds[:-1], bounds[1:]):
+            contig = self._contig_by_name.get(name)
+            if contig is None:
+                raise ContigNotFound(name, self._path)
+            self._write_contig_chunk(contig, starts[lo:hi], 
+                                     ends[lo:hi], values[lo:hi])
+
+    def _write_contig_chunk(self, contig, starts, ends, values):
+        assert(not self._closed)
+        if (contig.id, starts[0]) < self._position or \
+                (starts[1:] < ends[:-1]).any():
+            raise ValueError("BigWig records must be sorted and non-overlapping")
+        if (ends <= starts).any() or (starts < 0).any() or \
+                (ends > contig.size).any():
+            raise ValueError("Invalid BigWig record coordinates for contig '%s'" % 
+                             contig.name)
+        if contig.id != self._contig:
+            self._end_contig()
+            self._contig = contig.id
+        self._position = (contig.id, int(ends[-1]))
+        self._count += len(starts)
+
+        lengths = (ends - starts).astype("f8")
+        summary = self._summary
+        summary[0] += int(lengths.sum())
+        summary[1] = min(summary[1], float(values.min()))
+        summary[2] = max(summary[2], float(values.max()))
+        summary[3] += float((lengths * values).sum())
+        summary[4] += float((lengths * values.astype("f8") ** 2).sum())
+
+        records = numpy.empty(len(starts), dtype=BedGraphDatum)
+        records["start"] = starts
+        records["end"] = ends
+        records["value"] = values
+        self._buffer = numpy.concatenate([self._buffer, records])
+        self._write_sections(flush=False)
+        self._write_zoom(contig, starts, ends, values)
+
+    def _write_sections(self, flush):
+        n = self._items_per_slot
+        size = len(self._buffer)
+        end = size if flush else size - (size % n)
+        for i in range(0, end, n):
+            records = self._buffer[i:i+n]
+            first = int(records["start"][0])
+            last = int(records["end"][-1])
+            header = BigWigSectionHeader._struct.pack(
+                self._contig, first, last, 0, 0, BigWigFile.bedGraph, 0,
+                len(records))
+            self._sections.add(self._contig, first, last, 
+                               header + records.tobytes())
+        self._buffer = self._buffer[end:]
+
+    def _write_zoom(self, contig, starts, ends, values):
+        if not self._zoom_levels:
+            return
+        # Split the records into pieces at the bins of the finest level
+        r = self._zoom_levels[0].reduction
+        first, last = starts // r, (ends - 1) // r
+        counts = last - first + 1
+        rec = numpy.repeat(numpy.arange(len(starts)), counts)
+        bin = first[rec] + numpy.arange(len(rec)) - \
+                numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        valid = (numpy.minimum(ends[rec], (bin + 1) * r) - \
+                 numpy.maximum(starts[rec], bin * r)).astype("f8")
+        value = values[rec].astype("f8")
+        bins = reduce_bins(bin, valid, value, value, 
+                           valid * value, valid * value ** 2)
+
+        previous = r
+        for level in self._zoom_levels:
+            if level.reduction != previous:
+                bins = reduce_bins(bins[0] // (level.reduction // previous),
+                                   *bins[1:])
+                previous = level.reduction
+            bin, valid, min_val, max_val, sums, sum_squares = bins
+            records = numpy.empty(len(bin), dtype=ZoomDatum)
+            records["chromId"] = contig.id
+            records["start"] = bin * level.reduction
+            records["end"] = numpy.minimum((bin + 1) * level.reduction, 
+                                           contig.size)
+            records["validCount"] = valid
+            records["minVal"] = min_val
+            records["maxVal"] = max_val
+            records["sumData"] = sums
+            records["sumSquares"] = sum_squares
+            level.add(records)
+
+    def _end_contig(self):
+        if self._contig is None:
+            return
+        self._write_sections(flush=True)
+        for level in self._zoom_levels:
+            level.end_contig()
+
+    #############
+    # Finalizing
+    #############
+
+    def close(self):
+        """
+        Write the indices, zoom levels and header, and close the file.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._finish()
+        finally:
+            self._release()
+
+    def _release(self):
+        self._executor.shutdown()
+        self._handle.close()
+        for level in self._zoom_levels:
+            level.handle.close()
+
+    def _finish(self):
+        handle = self._handle
+        self._end_contig()
+        self._sections.flush()
+        leaves = self._sections.leaves
+        handle.seek(self._data_offset)
+        handle.write(len(leaves).to_bytes(4, byteorder="little"))
+        handle.seek(0, os.SEEK_END)
+        index_offset = write_rtree(handle, leaves, self._block_size,
+                                   self._items_per_slot)
+
+        # Only keep zoom levels which reduce the data enough to be useful
+        zoom_headers = []
+        buffer_size = self._sections.max_size
+        previous = self._count
+        for level in self._zoom_levels:
+            level.sections.flush()
+            if not (0 < level.count <= previous // 2):
+                continue
+            previous = level.count
+            buffer_size = max(buffer_size, level.sections.max_size)
+
+            data_offset = handle.tell()
+            handle.write(level.count.to_bytes(4, byteorder="little"))
+            base = handle.tell()
+            level.handle.seek(0)
+            shutil.copyfileobj(level.handle, handle)
+            leaves = [leaf[:4] + (leaf[4] + base, leaf[5]) 
+                      for leaf in level.sections.leaves]
+            index = write_rtree(handle, leaves, self._block_size,
+                                self._items_per_slot)
+            zoom_headers.append(ZoomHeader(level.reduction, 0, 
+                                           data_offset, index))
+
+        handle.seek(0)
+        handle.write(BBIHeader._struct.pack(
+            0x888FFC26, 4, len(zoom_headers), self._contig_tree_offset,
+            self._data_offset, index_offset, 0, 0, 0, self._summary_offset,
+            buffer_size if self._compress else 0, 0))
+        for zoom in zoom_headers:
+            handle.write(ZoomHeader._struct.pack(*zoom))
+        summary = self._summary
+        if not self._count:
+            summary[1:3] = [0, 0]
+        handle.seek(self._summary_offset)
+        handle.write(TotalSummary._struct.pack(*summary))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        elif not self._closed:
+            # Don't write a valid-looking header for an incomplete file
+            self._closed = True
+            self._release()
@@ -1,28 +1,298 @@
-from BioTK.genome import Region
+import re
+
+import numpy
+
+from BioTK.genome import RegionSet
 
 from .common import generic_open
 
+# BED columns and the dtypes they are read as
+BED_COLUMNS = [
+    ("contig", object), ("start", "i8"), ("end", "i8"), ("name", object),
+    ("score", "f8"), ("strand", object), ("thickStart", "i8"),
+    ("thickEnd", "i8"), ("itemRgb", object), ("blockCount", "i4"),
+    ("blockSizes", object), ("blockStarts", object)
+]
+
+# Lines with these prefixes are not records
+HEADER_PREFIXES = (b"#", b"track", b"browser")
+HEADER_LINE_STARTS = HEADER_PREFIXES + (b"\n", b" ", b"\t")
+
+HEADER_PATTERN = re.compile(rb"^(?:(?:#|track|browser)[^\n]*|[ \t]*)\n",
+                            re.MULTILINE)
+
+# The first bytes of lines which may be headers or blank
+HEADER_BYTES = numpy.frombuffer(b"#tb\n \t", dtype="u1")
+
+POWERS = 10 ** numpy.arange(19, dtype="i8")
+
+def strip_headers(block):
+    """
+    Remove comment, "track", "browser", and blank lines from a block of
+    complete lines, only falling back to a regular expression when some
+    line starts with a character that could begin one.
+    """
+    if not block:
+        return block
+    buf = numpy.frombuffer(block, dtype="u1")
+    line_starts = numpy.flatnonzero(buf[:-1] == 10) + 1
+    if numpy.isin(buf[line_starts], HEADER_BYTES).any() or \
+            block.startswith(HEADER_LINE_STARTS):
+        return HEADER_PATTERN.sub(b"", block)
+    return block
+
+def record_blocks(handle, block_size=1 << 22):
+    """
+    Read a text or binary handle in large blocks of complete lines, as
+    bytes, dropping comment, "track", "browser", and blank lines.
+    """
+    partial = b""
+    eof = False
+    while not eof:
+        block = handle.read(block_size)
+        if isinstance(block, str):
+            block = block.encode("utf-8")
+        if not block:
+            eof = True
+            block, partial = partial, b""
+            if block and not block.endswith(b"\n"):
+                block += b"\n"
+        else:
+            block = partial + block
+            split = block.rfind(b"\n") + 1
+            block, partial = block[:split], block[split:]
+        if b"\r" in block:
+            block = block.replace(b"\r", b"")
+        block = strip_headers(block)
+        if block:
+            yield block
+
+def gather(buf, starts, ends, width):
+    # A (records, width) array of the bytes of each field, left-aligned and
+    # padded with zeros
+    columns = numpy.arange(width)
+    index = starts[:,None] + columns
+    chars = buf[numpy.minimum(index, len(buf) - 1)]
+    chars[columns >= (ends - starts)[:,None]] = 0
+    return chars
+
+def field_bounds(buf, n):
+    """
+    Return the start and end offsets of the first n tab-separated fields of
+    each line in an array of bytes ending with a newline, as two arrays of
+    shape (n, lines).
+    """
+    newlines = numpy.flatnonzero(buf == 10)
+    line_starts = numpy.concatenate([[0], newlines[:-1] + 1])
+    tabs = numpy.flatnonzero(buf == 9)
+    first = numpy.searchsorted(tabs, line_starts)
+    count = numpy.searchsorted(tabs, newlines) - first
+    if (count < n - 1).any():
+        start = line_starts[numpy.argmax(count < n - 1)]
+        line = buf[start:].tobytes().split(b"\n", 1)[0]
+        raise ValueError("BED record with fewer than %s fields: %r" %
+                         (n, line))
+
+    tabs = numpy.append(tabs, len(buf))
+    starts = numpy.empty((n, len(line_starts)), dtype="i8")
+    ends = numpy.empty((n, len(line_starts)), dtype="i8")
+    starts[0] = line_starts
+    for k in range(1, n):
+        starts[k] = tabs[first + k - 1] + 1
+    for k in range(n):
+        ends[k] = numpy.where(count > k, tabs[first + k], newlines)
+    return starts, ends
+
+def parse_ints(buf, starts, ends):
+    lengths = ends - starts
+    if not len(lengths):
+        return numpy.zeros(0, dtype="i8")
+    width = int(lengths.max())
+    if (lengths.min() < 1) or (width > 18):
+        raise ValueError("Invalid integer field in BED record")
+    # Right-align the digits so that each column has a fixed power of 10
+    columns = numpy.arange(width)
+    index = (ends - width)[:,None] + columns
+    chars = buf[numpy.maximum(index, 0)]
+    chars[columns < (width - lengths)[:,None]] = 48
+    digits = chars - numpy.uint8(48)
+    if (digits > 9).any():
+        raise ValueError("Invalid integer field in BED record")
+    return digits.astype("i8") @ POWERS[width-1::-1]
+
+def parse_strings(buf, starts, ends):
+    lengths = ends - starts
+    width = max(int(lengths.max()) if len(lengths) else 0, 1)
+    return gather(buf, starts, ends, width).view("S%s" % width).reshape(-1)
+
+def parse_floats(buf, starts, ends):
+    try:
+        return parse_ints(buf, starts, ends).astype("f8")
+    except ValueError:
+        fields = parse_strings(buf, starts, ends)
+        return numpy.where(fields == b".", b"0", fields).astype("f8")
+
+def parse_block(block, n):
+    """
+    Parse the first n columns of the BED records in a block of complete
+    lines into a dict of arrays, keyed by column name. String columns are
+    returned as fixed-width bytes arrays.
+    """
+    buf = numpy.frombuffer(block, dtype="u1")
+    starts, ends = field_bounds(buf, n)
+    columns = {}
+    for k, (name, dtype) in enumerate(BED_COLUMNS[:n]):
+        if dtype is object:
+            columns[name] = parse_strings(buf, starts[k], ends[k])
+        elif dtype == "f8":
+            columns[name] = parse_floats(buf, starts[k], ends[k])
+        else:
+            columns[name] = parse_ints(buf, starts[k], ends[k]).astype(dtype)
+    return columns
+
+def concatenate_columns(chunks):
+    if len(chunks) == 1:
+        return chunks[0]
+    return dict((k, numpy.concatenate([c[k] for c in chunks]))
+                for k in chunks[0])
+
+def decode(strings):
+    # Fixed-width bytes to an object array of str
+    return strings.astype(str).astype(object)
+
+def to_region_set(columns):
+    contig_names, codes = numpy.unique(columns["contig"], return_inverse=True)
+    strand_codes = None
+    if "strand" in columns:
+        strands = columns["strand"]
+        strand_codes = numpy.zeros(len(strands), dtype="i1")
+        strand_codes[strands == b"+"] = 1
+        strand_codes[strands == b"-"] = 2
+    names = columns.get("name")
+    return RegionSet._new([c.decode("utf-8") for c in contig_names],
+                          codes.reshape(-1).astype("i4"), columns["start"],
+                          columns["end"],
+                          names=None if names is None else names.astype(str),
+                          scores=columns.get("score"),
+                          strand_codes=strand_codes)
+
+def to_frame(columns):
+    import pandas
+    return pandas.DataFrame(dict(
+        (name, pandas.Series(decode(columns[name]), dtype=object)
+         if dtype is object else columns[name])
+        for name, dtype in BED_COLUMNS if name in columns),
+        columns=[c for c, _ in BED_COLUMNS if c in columns])
+
+def column_count(line):
+    # The number of BED columns in a record line
+    n = min(line.count(b"\t") + 1, len(BED_COLUMNS))
+    if n < 3:
+        raise ValueError("BED record with fewer than 3 fields: %r" % line)
+    return n
+
 class BEDFile(object):
     def __init__(self, handle_or_path):
-        self._handle = generic_open(handle_or_path)
+        self._handle = generic_open(handle_or_path, "rb")
+        self._path = None if hasattr(handle_or_path, "read") else \
+                handle_or_path
+        self._tabix = None
 
     def __enter__(self):
         return self
 
     def __iter__(self):
-        keys = ["contig", "start", "end", "name", "score", "strand"]
+        for chunk in self.iter_chunks():
+            yield from chunk
 
-        for line in self._handle:
-            fields = line.strip().split("\t")
-            attrs = dict(zip(keys, fields))
-            attrs["start"] = int(attrs["start"])
-            attrs["end"] = int(attrs["end"])
-            if "score" in attrs:
-                attrs["score"] = float(attrs["score"])
-            yield Region(**attrs)
+    def iter_columns(self, chunk_size=100000):
+        """
+        Iterate over the records in chunks of (at most) chunk_size records,
+        as dicts mapping the name of each BED3-BED12 column in the file
+        (see BED_COLUMNS) to an array of its values.
 
-    def __exit__(self, *args):
+        The file is read in large blocks, each of which is split into
+        fields and parsed with vectorized numpy operations, rather than
+        line by line.
+        """
+        n = None
+        pending, size = [], 0
+        for block in record_blocks(self._handle):
+            if n is None:
+                n = column_count(block.split(b"\n", 1)[0])
+            columns = parse_block(block, n)
+            pending.append(columns)
+            size += len(columns["start"])
+            while size >= chunk_size:
+                columns = concatenate_columns(pending)
+                yield dict((k, v[:chunk_size]) for k, v in columns.items())
+                pending = [dict((k, v[chunk_size:])
+                                for k, v in columns.items())]
+                size -= chunk_size
+        if size:
+            yield concatenate_columns(pending)
+
+    def iter_chunks(self, chunk_size=100000, as_frame=False):
+        """
+        Iterate over the records in chunks of (at most) chunk_size records.
+
+        By default, each chunk is a :py:class:`RegionSet` of the contig,
+        start, end, name, score, and strand columns (those present), with
+        the names in a fixed-width numpy string array rather than as one
+        Python str per record. Such chunks can be passed directly to
+        :py:meth:`RegionSet.index`, the :py:mod:`BioTK.genome.algebra`
+        operations, and BigWig batch queries. If as_frame is True, each
+        chunk is instead a :py:class:`pandas.DataFrame` with all the
+        BED3-BED12 columns in the file (see BED_COLUMNS for the names and
+        dtypes).
+        """
+        for columns in self.iter_columns(chunk_size=chunk_size):
+            yield to_frame(columns) if as_frame else to_region_set(columns)
+
+    def read(self):
+        """
+        Read all the records into a single :py:class:`RegionSet`.
+        """
+        return RegionSet.concatenate(self.iter_chunks())
+
+    def fetch(self, contig, start, end, as_frame=False):
+        """
+        Return the records on a contig overlapping the 0-based, half-open
+        interval [start, end), as a :py:class:`RegionSet` (or a
+        :py:class:`pandas.DataFrame` if as_frame is True).
+
+        The file must have been opened by path, and be sorted,
+        BGZF-compressed (see :py:func:`BioTK.io.BGZF.bgzip`), and indexed
+        with a .tbi or .csi index (see
+        :py:func:`BioTK.io.tabix.build_index`). Only the compressed blocks
+        which may contain overlapping records are read.
+        """
+        if self._tabix is None:
+            if self._path is None:
+                raise ValueError("Random access requires a BEDFile opened "
+                                 "from a path")
+            from BioTK.io.tabix import TabixFile
+            self._tabix = TabixFile(self._path)
+        block = strip_headers(b"".join(
+            self._tabix.read_chunks(contig, start, end)))
+        if not block:
+            columns = dict((name, numpy.zeros(0, dtype="S1"
+                                              if dtype is object else dtype))
+                           for name, dtype in BED_COLUMNS[:3])
+        else:
+            columns = parse_block(block, column_count(block.split(b"\n")[0]))
+            overlap = (columns["contig"] == contig.encode("utf-8")) & \
+                    (columns["start"] < end) & (columns["end"] > start)
+            columns = dict((k, v[overlap]) for k, v in columns.items())
+        return to_frame(columns) if as_frame else to_region_set(columns)
+
+    def close(self):
         self._handle.close()
+        if self._tabix is not None:
+            self._tabix.close()
+
+    def __exit__(self, *args):
+        self.close()
 
 def parse(handle):
     return BEDFile(handle)
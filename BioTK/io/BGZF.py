@@ -0,0 +1,257 @@
+"""
+Reading and writing BGZF (blocked gzip) files, with random access by
+virtual offset.
+
+A BGZF file is a series of gzip members ("blocks"), each holding at most
+64 KB of uncompressed data and recording its own compressed size in an
+extra header field, so any block can be located and inflated without
+reading those before it. Positions in the uncompressed stream are
+addressed by "virtual offsets", which pack the offset of the start of a
+block in the compressed file (the upper 48 bits) with an offset into its
+uncompressed data (the lower 16 bits).
+
+The format is specified in the SAM/BAM specification:
+
+https://samtools.github.io/hts-specs/SAMv1.pdf
+"""
+
+import zlib
+
+from collections import OrderedDict
+from struct import Struct
+
+__all__ = ["BGZFReader", "BGZFWriter", "bgzip", "is_bgzf",
+           "make_virtual_offset", "split_virtual_offset"]
+
+# The fixed part of a block header, including the BC extra subfield
+BlockHeader = Struct("<4sI2sH2sHH")
+BLOCK_MAGIC = b"\x1f\x8b\x08\x04"
+BlockFooter = Struct("<II")
+
+# A block without data, marking the end of the file
+EOF_BLOCK = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000"
+                          "000000")
+
+MAX_BLOCK_SIZE = 1 << 16
+# Uncompressed data per block written, leaving room for incompressible data
+MAX_DATA_SIZE = 0xff00
+
+def make_virtual_offset(block_offset, data_offset):
+    assert(0 <= data_offset < MAX_BLOCK_SIZE)
+    return (block_offset << 16) | data_offset
+
+def split_virtual_offset(offset):
+    """
+    Return the (compressed) block offset and the offset within the block
+    of a virtual offset.
+    """
+    return offset >> 16, offset & 0xffff
+
+def is_bgzf(path):
+    """
+    Return True if the file at the given path starts with a BGZF block.
+    """
+    with open(path, "rb") as h:
+        header = h.read(BlockHeader.size)
+    if len(header) < BlockHeader.size:
+        return False
+    magic, _, _, _, subfield, _, _ = BlockHeader.unpack(header)
+    return magic == BLOCK_MAGIC and subfield == b"BC"
+
+def read_block(handle, offset):
+    """
+    Read and inflate the block starting at the given compressed offset of a
+    binary handle, returning its data and the offset of the next block.
+    Returns (b"", offset) at the end of the file.
+    """
+    handle.seek(offset)
+    header = handle.read(BlockHeader.size)
+    if not header:
+        return b"", offset
+    if len(header) < BlockHeader.size:
+        raise IOError("Truncated BGZF block header at offset %s" % offset)
+    magic, _, _, xlen, subfield, slen, bsize = BlockHeader.unpack(header)
+    if magic != BLOCK_MAGIC or subfield != b"BC" or slen != 2:
+        raise IOError("Invalid BGZF block at offset %s" % offset)
+    size = bsize + 1
+    # Skip any other extra subfields
+    rest = handle.read(size - BlockHeader.size)
+    if len(rest) < size - BlockHeader.size:
+        raise IOError("Truncated BGZF block at offset %s" % offset)
+    cdata = rest[xlen - 6:-BlockFooter.size]
+    crc, isize = BlockFooter.unpack(rest[-BlockFooter.size:])
+    data = zlib.decompress(cdata, -15)
+    if len(data) != isize or zlib.crc32(data) != crc:
+        raise IOError("Corrupt BGZF block at offset %s" % offset)
+    return data, offset + size
+
+def compress_block(data, level=6):
+    """
+    Return a complete BGZF block containing the given data.
+    """
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = c.compress(data) + c.flush()
+    size = BlockHeader.size + len(cdata) + BlockFooter.size
+    if size > MAX_BLOCK_SIZE:
+        raise ValueError("Data does not fit in a BGZF block")
+    return BlockHeader.pack(BLOCK_MAGIC, 0, b"\x00\xff", 6, b"BC", 2,
+                            size - 1) + cdata + \
+            BlockFooter.pack(zlib.crc32(data), len(data))
+
+class BGZFReader(object):
+    """
+    A binary, read-only file-like object over the uncompressed contents of
+    a BGZF file, which can seek to and report virtual offsets.
+    """
+    def __init__(self, handle_or_path, cache_size=16):
+        if hasattr(handle_or_path, "read"):
+            self._handle = handle_or_path
+        else:
+            self._handle = open(handle_or_path, "rb")
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+        self._load(0)
+
+    def _load(self, offset):
+        # Make the block at the given compressed offset current
+        if offset in self._cache:
+            self._cache.move_to_end(offset)
+            block = self._cache[offset]
+        else:
+            block = read_block(self._handle, offset)
+            self._cache[offset] = block
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        self._block_offset = offset
+        self._data, self._next_offset = block
+        self._position = 0
+
+    def _advance(self):
+        # Move to the next non-empty block, returning False at EOF
+        while self._position >= len(self._data):
+            if self._next_offset == self._block_offset:
+                return False
+            self._load(self._next_offset)
+        return True
+
+    def seek(self, virtual_offset):
+        block_offset, position = split_virtual_offset(virtual_offset)
+        if block_offset != self._block_offset:
+            self._load(block_offset)
+        if position > len(self._data):
+            raise ValueError("Invalid virtual offset: %s" % virtual_offset)
+        self._position = position
+
+    def tell(self):
+        """
+        Return the virtual offset of the current position.
+        """
+        if self._position == len(self._data) and \
+                self._next_offset != self._block_offset:
+            return make_virtual_offset(self._next_offset, 0)
+        return make_virtual_offset(self._block_offset, self._position)
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0 and self._advance():
+            end = len(self._data) if size < 0 else \
+                    min(len(self._data), self._position + size)
+            parts.append(self._data[self._position:end])
+            size -= end - self._position
+            self._position = end
+        return b"".join(parts)
+
+    def readline(self):
+        parts = []
+        while self._advance():
+            end = self._data.find(b"\n", self._position)
+            if end >= 0:
+                parts.append(self._data[self._position:end + 1])
+                self._position = end + 1
+                break
+            parts.append(self._data[self._position:])
+            self._position = len(self._data)
+        return b"".join(parts)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                break
+            yield line
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._handle.close()
+
+class BGZFWriter(object):
+    """
+    A binary, write-only file-like object which compresses its input into
+    BGZF blocks, ending the file with an empty EOF block when closed.
+    """
+    def __init__(self, handle_or_path, level=6):
+        if hasattr(handle_or_path, "write"):
+            self._handle = handle_or_path
+        else:
+            self._handle = open(handle_or_path, "wb")
+        self._level = level
+        self._buffer = bytearray()
+        self._offset = 0
+
+    def _write_block(self, data):
+        block = compress_block(data, level=self._level)
+        self._handle.write(block)
+        self._offset += len(block)
+
+    def write(self, data):
+        self._buffer.extend(data)
+        while len(self._buffer) >= MAX_DATA_SIZE:
+            self._write_block(bytes(self._buffer[:MAX_DATA_SIZE]))
+            del self._buffer[:MAX_DATA_SIZE]
+        return len(data)
+
+    def flush(self):
+        """
+        Write any buffered data as a block, so that the next write starts a
+        new block.
+        """
+        if self._buffer:
+            self._write_block(bytes(self._buffer))
+            self._buffer = bytearray()
+        self._handle.flush()
+
+    def tell(self):
+        """
+        Return the virtual offset at which the next data will be written.
+        """
+        return make_virtual_offset(self._offset, len(self._buffer))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.flush()
+        self._handle.write(EOF_BLOCK)
+        self._handle.close()
+
+def bgzip(path, output_path=None, level=6, block_size=1 << 20):
+    """
+    Compress a file with BGZF, by default to its path with ".gz" appended,
+    returning the output path.
+    """
+    output_path = output_path or path + ".gz"
+    with open(path, "rb") as h, BGZFWriter(output_path, level=level) as out:
+        while True:
+            data = h.read(block_size)
+            if not data:
+                break
+            out.write(data)
+    return output_path
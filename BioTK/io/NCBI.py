@@ -1,11 +1,11 @@
 import base64
-import gzip
 import os
 import shutil
 import urllib.parse
 import urllib.request
 
 import BioTK.io.Aspera as Aspera
+from BioTK.io.common import generic_open
 
 def copy_handle(src, dest):
     n = 0
@@ -59,6 +59,6 @@ def download(relative_url, cache_directory="/tmp/BioTK/NCBI",
         if not decompress:
             return open(path, "rt")
         elif decompress == "gzip":
-            return gzip.open(path, "rt")
+            return generic_open(path)
         else:
             raise IOError("Invalid 'decompress' option.")
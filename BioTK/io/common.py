@@ -1,37 +1,379 @@
-import mimetypes
-import gzip
 import bz2
+import gzip
+import io
+import itertools
+import mimetypes
+import os
+import queue
+import re
+import threading
+import zlib
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from struct import Struct
+
+# Compression formats, detected by magic number
+GZIP_MAGIC = b"\x1f\x8b"
+BZIP2_MAGIC = b"BZh"
+
+# A gzip member header (deflate method) and a bzip2 stream header followed
+# by the magic number of its first block, which may begin a new member
+# or stream in the middle of a file
+MEMBER_PATTERNS = {
+    "gzip": re.compile(b"\x1f\x8b\x08"),
+    "bzip2": re.compile(rb"BZh[1-9]1AY&SY")
+}
+
+GzipHeader = Struct("<4sI2sH")
+FEXTRA = 4
+
+# Reserved bits of the gzip FLG byte, and the defined XFL and OS values
+FRESERVED = 0xe0
+GZIP_XFL = (0, 2, 4)
+GZIP_OS = tuple(range(14)) + (255,)
+
+# The amount of data inflated to check that a possible gzip member start
+# is followed by valid deflate data
+PROBE_SIZE = 1 << 12
+
+def detect_compression(path):
+    """
+    Return the compression format of a file, as "bgzf", "gzip", "bzip2",
+    or None if it is not compressed, from its magic number.
+    """
+    with open(path, "rb") as h:
+        header = h.read(GzipHeader.size)
+        if header.startswith(GZIP_MAGIC):
+            if len(header) == GzipHeader.size:
+                _, _, _, xlen = GzipHeader.unpack(header)
+                if header[3] & FEXTRA and b"BC\x02\x00" in h.read(xlen):
+                    return "bgzf"
+            return "gzip"
+        elif header.startswith(BZIP2_MAGIC) and header[3:4].isdigit():
+            return "bzip2"
+
+def new_decompressor(compression):
+    if compression == "bzip2":
+        return bz2.BZ2Decompressor()
+    return zlib.decompressobj(31)
+
+def inflate(data, compression):
+    """
+    Decompress a buffer holding a series of complete gzip members or
+    bzip2 streams, returning None if it does not end on a member boundary
+    (or is not valid).
+    """
+    output = []
+    try:
+        while data:
+            d = new_decompressor(compression)
+            output.append(d.decompress(data))
+            if not d.eof:
+                return None
+            data = d.unused_data
+    except (OSError, EOFError, zlib.error):
+        return None
+    return b"".join(output)
+
+def is_member_start(data, position, compression):
+    """
+    Whether a match of the member pattern at this position of data is
+    likely to be the start of a gzip member (or bzip2 stream), rather than
+    a chance occurrence inside compressed data.
+
+    The bzip2 pattern is long enough to be reliable. Gzip headers must
+    have no reserved flags set, valid XFL and OS bytes, and be followed by
+    data which starts to inflate without error.
+    """
+    if compression != "gzip":
+        return True
+    header = data[position:position + 10]
+    if len(header) < 10 or header[3] & FRESERVED or \
+            header[8] not in GZIP_XFL or header[9] not in GZIP_OS:
+        return False
+    try:
+        zlib.decompressobj(31).decompress(
+            data[position:position + PROBE_SIZE], PROBE_SIZE)
+    except zlib.error:
+        return False
+    return True
+
+def read_chunks(handle, size):
+    while True:
+        chunk = handle.read(size)
+        if not chunk:
+            break
+        yield chunk
+
+def stream_members(chunks, compression):
+    # Decompress a series of gzip members or bzip2 streams sequentially,
+    # raising EOFError if the last one is truncated
+    d = new_decompressor(compression)
+    started = False
+    for chunk in chunks:
+        while chunk:
+            started = True
+            yield d.decompress(chunk)
+            if d.eof:
+                chunk = d.unused_data
+                d = new_decompressor(compression)
+                started = False
+            else:
+                chunk = b""
+    if started:
+        raise EOFError("Compressed file ended before the end-of-stream "
+                       "marker was reached")
 
-def generic_open(path, mode="rt"):
+class Remainder(bytes):
     """
-    Open a file path, bzip2- or gzip-compressed file path, 
+    The start of a member too large to split off, after which the rest of
+    the file must be decompressed sequentially.
+    """
+
+def bgzf_segments(handle, segment_size):
+    # Split a BGZF file into runs of whole blocks of about segment_size
+    # bytes, using the block sizes stored in the block headers
+    carry = b""
+    for chunk in read_chunks(handle, segment_size):
+        data = carry + chunk
+        position = 0
+        while position + GzipHeader.size <= len(data):
+            if data[position:position + 2] != GZIP_MAGIC:
+                raise IOError("Invalid BGZF block header")
+            _, _, _, xlen = GzipHeader.unpack_from(data, position)
+            extra = data[position + GzipHeader.size:
+                         position + GzipHeader.size + xlen]
+            if len(extra) < xlen:
+                break
+            i = extra.find(b"BC\x02\x00")
+            if i < 0:
+                raise IOError("Invalid BGZF block header")
+            size = int.from_bytes(extra[i + 4:i + 6], "little") + 1
+            if position + size > len(data):
+                break
+            position += size
+        yield data[:position]
+        carry = data[position:]
+    if carry:
+        yield carry
+
+def member_segments(handle, compression, segment_size, max_segments=16):
+    # Split a multi-member gzip or multi-stream bzip2 file at the last
+    # likely member start in each chunk of about segment_size bytes.
+    # Candidate starts may still be false positives inside a member, which
+    # are detected when the preceding segment does not inflate completely.
+    pattern = MEMBER_PATTERNS[compression]
+    carry = b""
+    for chunk in read_chunks(handle, segment_size):
+        data = carry + chunk
+        candidates = [m.start() for m in
+                      pattern.finditer(data, max(len(carry) - 16, 1))]
+        start = next((s for s in reversed(candidates)
+                      if is_member_start(data, s, compression)), None)
+        if start is not None:
+            yield data[:start]
+            carry = data[start:]
+        elif len(data) > max_segments * segment_size:
+            yield Remainder(data)
+            return
+        else:
+            carry = data
+    if carry:
+        yield carry
+
+def has_members(path, compression, probe_size):
+    # Whether a gzip or bzip2 file seems to have several members (or
+    # streams) within its first probe_size bytes
+    with open(path, "rb") as h:
+        data = h.read(probe_size)
+    return any(is_member_start(data, m.start(), compression)
+               for m in MEMBER_PATTERNS[compression].finditer(data, 1))
+
+class DecompressingReader(io.RawIOBase):
+    """
+    A raw, read-only binary stream of the decompressed contents of a gzip,
+    BGZF, or bzip2 file, which decompresses ahead of the reader in worker
+    threads while preserving the order of the output.
+
+    BGZF files are split into runs of blocks, and multi-member gzip and
+    multi-stream bzip2 files (such as the output of bgzip, pigz -i, or
+    pbzip2) into runs of members, which are inflated in parallel. Files
+    with a single member are decompressed sequentially, in one background
+    thread.
+    """
+    def __init__(self, path, compression=None, threads=None,
+                 segment_size=1 << 22, read_ahead=None):
+        super(DecompressingReader, self).__init__()
+        self.path = path
+        self.compression = compression or detect_compression(path)
+        assert(self.compression is not None)
+        self._threads = threads or os.cpu_count() or 1
+        self._segment_size = segment_size
+        self._read_ahead = read_ahead or 2 * self._threads
+        self._handle = open(path, "rb")
+        self._stop = threading.Event()
+        if self.compression == "bgzf":
+            self._blocks = self._parallel(bgzf_segments(self._handle,
+                                                        segment_size))
+        elif has_members(path, self.compression, 2 * segment_size):
+            self._blocks = self._parallel(member_segments(
+                self._handle, self.compression, segment_size))
+        else:
+            self._blocks = self._sequential()
+        self._buffer = b""
+        self._position = 0
+
+    def _parallel(self, segments):
+        # Inflate segments in a thread pool, yielding the output in order
+        compression = "gzip" if self.compression == "bgzf" else \
+                self.compression
+        segments = iter(segments)
+        with ThreadPoolExecutor(self._threads) as executor:
+            pending = deque()
+            while True:
+                while len(pending) < self._read_ahead:
+                    segment = next(segments, None)
+                    if segment is None:
+                        break
+                    pending.append((segment, None
+                                    if isinstance(segment, Remainder) else
+                                    executor.submit(inflate, segment,
+                                                    compression)))
+                if not pending:
+                    break
+                segment, future = pending.popleft()
+                data = None if future is None else future.result()
+                # A segment ending at a false member start is joined to the
+                # next one
+                while data is None and not isinstance(segment, Remainder):
+                    if pending:
+                        following, next_future = pending.popleft()
+                        if next_future is not None:
+                            next_future.cancel()
+                    else:
+                        following = next(segments, None)
+                    if following is None:
+                        raise IOError("Invalid or truncated %s data in %s" %
+                                      (self.compression, self.path))
+                    segment += following
+                    if isinstance(following, Remainder) or \
+                            len(segment) > 16 * self._segment_size:
+                        segment = Remainder(segment)
+                    else:
+                        data = inflate(segment, compression)
+                if data is None:
+                    # Decompress everything left sequentially
+                    for _, future in pending:
+                        if future is not None:
+                            future.cancel()
+                    yield from stream_members(itertools.chain(
+                        [segment], (s for s, _ in pending), segments,
+                        read_chunks(self._handle, self._segment_size)),
+                        compression)
+                    break
+                yield data
+
+    def _sequential(self):
+        # Decompress in a background thread, through a bounded queue
+        output = queue.Queue(self._read_ahead)
+
+        def put(item):
+            while not self._stop.is_set():
+                try:
+                    output.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def run():
+            try:
+                for data in stream_members(read_chunks(
+                        self._handle, self._segment_size), self.compression):
+                    if not put(data):
+                        return
+                put(None)
+            except Exception as e:
+                put(e)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        while True:
+            item = output.get()
+            if item is None:
+                break
+            elif isinstance(item, Exception):
+                raise item
+            yield item
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self._position >= len(self._buffer):
+            data = next(self._blocks, None)
+            if data is None:
+                return 0
+            self._buffer = memoryview(data)
+            self._position = 0
+        n = min(len(b), len(self._buffer) - self._position)
+        b[:n] = self._buffer[self._position:self._position + n]
+        self._position += n
+        return n
+
+    def readall(self):
+        parts = [bytes(self._buffer[self._position:])]
+        parts.extend(self._blocks)
+        self._buffer, self._position = b"", 0
+        return b"".join(parts)
+
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            self._blocks.close()
+            self._handle.close()
+        super(DecompressingReader, self).close()
+
+def generic_open(path, mode="rt", threads=None):
+    """
+    Open a file path, bzip2-, gzip-, or BGZF-compressed file path,
     or URL in the specified mode.
 
+    Compressed files opened for reading are detected by magic number, and
+    decompressed ahead of the reader, using the given number of threads
+    (by default, one per CPU) for files made of many independent members
+    (see :py:class:`DecompressingReader`). Compressed files opened for
+    writing are detected by extension.
+
     Not all path types support all modes. For example, a URL is not
-    considered to be writable. 
-    
+    considered to be writable.
+
     :param path: Path
     :type path: str
     :throws IOError: If the file cannot be opened in the given mode
     :throws FileNotFoundError: If the file cannot be found
-    :rtype: :py:class:`io.IOBase` or :py:class:`io.TextIOBase`, 
+    :rtype: :py:class:`io.IOBase` or :py:class:`io.TextIOBase`,
       depending on the mode
     """
 
-    # FIXME: detect zipped file based on magic number, not extension
-    # FIXME: enable opening zipped file in text mode
-    # FIXME: detect URLs and detect and unzip a zipped URL 
+    # FIXME: detect URLs and detect and unzip a zipped URL
     # FIXME: allow caching of downloads
 
     if hasattr(path, "read"):
         return path
 
+    if mode.strip("bt") == "r" and detect_compression(path):
+        h = io.BufferedReader(DecompressingReader(path, threads=threads),
+                              buffer_size=1 << 20)
+        return h if "b" in mode else io.TextIOWrapper(h)
+
     type, compression = mimetypes.guess_type(path)
 
     if compression == "gzip":
         h = gzip.open(path, mode=mode)
     elif compression == "bzip2":
-        h = bz2.BZ2File(h, mode=mode)
+        h = bz2.open(path, mode=mode)
     else:
         h = open(path, mode=mode)
     return h
@@ -0,0 +1,482 @@
+"""
+Tabix (.tbi) and CSI indexes of sorted, BGZF-compressed, tab-delimited
+files (BED, bedGraph, GFF, VCF, ...), for reading the records overlapping a
+region without decompressing the whole file.
+
+Both index types assign each record to the smallest bin of a hierarchical
+binning scheme which contains it, and store, for each bin, the ranges
+("chunks") of virtual offsets (see :py:mod:`BioTK.io.BGZF`) holding its
+records. A query reads the chunks of the bins which overlap it, skipping
+those that end before the first record that could overlap it (found from
+the linear index of a .tbi, or the per-bin offsets of a .csi).
+
+The formats are specified at:
+
+https://samtools.github.io/hts-specs/tabix.pdf
+https://samtools.github.io/hts-specs/CSIv1.pdf
+"""
+
+import os
+import zlib
+
+from collections import namedtuple
+from struct import Struct
+
+import numpy
+
+from BioTK.io.BGZF import BGZFReader, BGZFWriter
+
+__all__ = ["TabixConfig", "TabixIndex", "TabixFile", "build_index",
+           "PRESETS"]
+
+# Column numbers are 1-based. Bit 16 of format indicates 0-based,
+# half-open coordinates (as in BED) rather than 1-based, closed ones.
+TabixConfig = namedtuple("TabixConfig",
+                         "format col_seq col_beg col_end meta skip")
+
+FORMAT_GENERIC, FORMAT_SAM, FORMAT_VCF = 0, 1, 2
+FORMAT_ZERO_BASED = 0x10000
+
+PRESETS = {
+    "bed": TabixConfig(FORMAT_GENERIC | FORMAT_ZERO_BASED, 1, 2, 3, "#", 0),
+    "bedgraph": TabixConfig(FORMAT_GENERIC | FORMAT_ZERO_BASED,
+                            1, 2, 3, "#", 0),
+    "gff": TabixConfig(FORMAT_GENERIC, 1, 4, 5, "#", 0),
+    "vcf": TabixConfig(FORMAT_VCF, 1, 2, 0, "#", 0),
+    "sam": TabixConfig(FORMAT_SAM, 3, 4, 0, "@", 0)
+}
+
+# Lines which are not records in UCSC-style (0-based) files, as well
+# as those starting with the meta character
+UCSC_HEADERS = (b"track", b"browser")
+
+TBI_MAGIC = b"TBI\x01"
+CSI_MAGIC = b"CSI\x01"
+ConfigStruct = Struct("<7i")
+CSIHeader = Struct("<4s3i")
+Int32 = Struct("<i")
+BinHeader = Struct("<Ii")
+CSIBinHeader = Struct("<IQi")
+
+# The .tbi binning scheme and linear index resolution
+TBI_MIN_SHIFT = 14
+TBI_DEPTH = 5
+
+def bin_first(level):
+    # The first bin at a level of the binning scheme
+    return ((1 << (level * 3)) - 1) // 7
+
+def bin_parent(bin):
+    return (bin - 1) >> 3
+
+def bin_level(bin):
+    level = 0
+    while bin >= bin_first(level + 1):
+        level += 1
+    return level
+
+def reg2bin(start, end, min_shift, depth):
+    """
+    Return the smallest bin containing the 0-based, half-open interval
+    [start, end).
+    """
+    end -= 1
+    shift = min_shift
+    for level in range(depth, 0, -1):
+        if start >> shift == end >> shift:
+            return bin_first(level) + (start >> shift)
+        shift += 3
+    return 0
+
+def reg2bins(start, end, min_shift, depth):
+    """
+    Return all the bins overlapping the 0-based, half-open interval
+    [start, end).
+    """
+    end -= 1
+    bins = []
+    shift = min_shift + depth * 3
+    for level in range(depth + 1):
+        first = bin_first(level)
+        bins.extend(range(first + (start >> shift), first + (end >> shift) + 1))
+        shift -= 3
+    return bins
+
+def parse_config(data, offset):
+    # The tabix configuration and sequence names starting at the given offset
+    fields = ConfigStruct.unpack_from(data, offset)
+    offset += ConfigStruct.size
+    config = TabixConfig(fields[0], fields[1], fields[2], fields[3],
+                         chr(fields[4]), fields[5])
+    names = bytes(data[offset:offset + fields[6]]).split(b"\x00")
+    return config, [n.decode("utf-8") for n in names if n], \
+            offset + fields[6]
+
+def pack_config(config, names):
+    names = b"".join(n.encode("utf-8") + b"\x00" for n in names)
+    return ConfigStruct.pack(config.format, config.col_seq, config.col_beg,
+                             config.col_end, ord(config.meta), config.skip,
+                             len(names)) + names
+
+def is_header(line, config):
+    """
+    Whether a line is a header (or blank) rather than a record.
+    """
+    return line.startswith(config.meta.encode("utf-8")) or \
+            not line.strip() or (bool(config.format & FORMAT_ZERO_BASED) and
+                                 line.startswith(UCSC_HEADERS))
+
+def record_interval(fields, config):
+    """
+    Return the contig and 0-based, half-open interval of a record split
+    into (bytes) fields, according to an index configuration.
+    """
+    contig = fields[config.col_seq - 1].decode("utf-8")
+    start = int(fields[config.col_beg - 1])
+    if not config.format & FORMAT_ZERO_BASED:
+        start -= 1
+    if config.col_end:
+        end = int(fields[config.col_end - 1])
+    elif config.format & 0xffff == FORMAT_VCF:
+        end = start + len(fields[3])
+    else:
+        end = start + 1
+    return contig, start, max(end, start + 1)
+
+class TabixIndex(object):
+    """
+    A tabix (.tbi) or CSI index.
+
+    For each contig, the index holds a dict mapping bin numbers to arrays
+    of (start, end) virtual offset pairs, and a linear index of the
+    smallest virtual offset of a record overlapping each 2 ** min_shift
+    bp window (only stored in .tbi files). CSI files instead store such an
+    offset (the "loffset") for each bin.
+    """
+    def __init__(self, config, names, bins, linear=None,
+                 min_shift=TBI_MIN_SHIFT, depth=TBI_DEPTH, csi=False):
+        self.config = config
+        self.names = names
+        self.min_shift = min_shift
+        self.depth = depth
+        self.csi = csi
+        self._bins = bins
+        self._linear = linear or [numpy.zeros(0, dtype="u8")
+                                  for _ in names]
+        self._loffsets = [{} for _ in names]
+        self._ids = dict((name, i) for i, name in enumerate(names))
+
+    @staticmethod
+    def read(path):
+        """
+        Read a .tbi or .csi index file (detected by its magic number).
+        """
+        data = memoryview(decompress_members(path))
+        magic = bytes(data[:4])
+        if magic == TBI_MAGIC:
+            return TabixIndex._read_tbi(data)
+        elif magic == CSI_MAGIC:
+            return TabixIndex._read_csi(data)
+        raise ValueError("%s is not a tabix or CSI index" % path)
+
+    @staticmethod
+    def _read_tbi(data):
+        n_ref, = Int32.unpack_from(data, 4)
+        config, names, offset = parse_config(data, 8)
+        assert(len(names) == n_ref)
+        bins, linear = [], []
+        for _ in range(n_ref):
+            ref_bins, offset = read_bins(data, offset, False)
+            n_intv, = Int32.unpack_from(data, offset)
+            offset += 4
+            linear.append(numpy.frombuffer(data, dtype="<u8", count=n_intv,
+                                           offset=offset))
+            offset += 8 * n_intv
+            bins.append(ref_bins)
+        return TabixIndex(config, names, bins, linear=linear)
+
+    @staticmethod
+    def _read_csi(data):
+        _, min_shift, depth, l_aux = CSIHeader.unpack_from(data, 0)
+        offset = CSIHeader.size
+        if l_aux < ConfigStruct.size:
+            raise ValueError("CSI index without a tabix configuration")
+        config, names, _ = parse_config(data, offset)
+        offset += l_aux
+        n_ref, = Int32.unpack_from(data, offset)
+        offset += 4
+        assert(len(names) == n_ref)
+        bins, loffsets = [], []
+        for _ in range(n_ref):
+            ref_bins, offset = read_bins(data, offset, True)
+            bins.append(dict((b, chunks) for b, (_, chunks)
+                             in ref_bins.items()))
+            loffsets.append(dict((b, loffset) for b, (loffset, _)
+                                 in ref_bins.items()))
+        index = TabixIndex(config, names, bins, min_shift=min_shift,
+                           depth=depth, csi=True)
+        index._loffsets = loffsets
+        return index
+
+    def write(self, path):
+        """
+        Write this index to a .tbi or .csi file.
+        """
+        with BGZFWriter(path) as h:
+            config = pack_config(self.config, self.names)
+            if self.csi:
+                h.write(CSIHeader.pack(CSI_MAGIC, self.min_shift,
+                                       self.depth, len(config)))
+                h.write(config)
+                h.write(Int32.pack(len(self.names)))
+            else:
+                h.write(TBI_MAGIC + Int32.pack(len(self.names)) + config)
+            for i in range(len(self.names)):
+                bins = self._bins[i]
+                h.write(Int32.pack(len(bins)))
+                for bin in sorted(bins):
+                    chunks = numpy.asarray(bins[bin], dtype="<u8")
+                    if self.csi:
+                        h.write(CSIBinHeader.pack(bin, self._loffsets[i][bin],
+                                                  len(chunks)))
+                    else:
+                        h.write(BinHeader.pack(bin, len(chunks)))
+                    h.write(chunks.tobytes())
+                if not self.csi:
+                    linear = numpy.asarray(self._linear[i], dtype="<u8")
+                    h.write(Int32.pack(len(linear)))
+                    h.write(linear.tobytes())
+
+    def _min_offset(self, i, start):
+        # A lower bound on the virtual offset of any record on contig i
+        # overlapping positions >= start
+        if self.csi:
+            loffsets = self._loffsets[i]
+            bin = bin_first(self.depth) + (start >> self.min_shift)
+            while bin > 0 and bin not in loffsets:
+                bin = bin_parent(bin)
+            return loffsets.get(bin, 0)
+        linear = self._linear[i]
+        if not len(linear):
+            return 0
+        return int(linear[min(start >> self.min_shift, len(linear) - 1)])
+
+    def chunks(self, contig, start, end):
+        """
+        Return the sorted, merged (start, end) virtual offset ranges which
+        contain all the records on a contig overlapping the 0-based,
+        half-open interval [start, end).
+        """
+        i = self._ids.get(contig)
+        start = max(start, 0)
+        if i is None or end <= start:
+            return []
+        min_offset = self._min_offset(i, start)
+        bins = self._bins[i]
+        chunks = sorted((int(b), int(e))
+                        for bin in reg2bins(start, end, self.min_shift,
+                                            self.depth)
+                        if bin in bins
+                        for b, e in bins[bin] if e > min_offset)
+        merged = []
+        for b, e in chunks:
+            if merged and b <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], e)
+            else:
+                merged.append([b, e])
+        return [tuple(c) for c in merged]
+
+def decompress_members(path):
+    # Inflate a multi-member gzip file, such as a BGZF-compressed index
+    with open(path, "rb") as h:
+        data = h.read()
+    parts = []
+    while data:
+        d = zlib.decompressobj(31)
+        parts.append(d.decompress(data))
+        data = d.unused_data
+    return b"".join(parts)
+
+def read_bins(data, offset, csi):
+    # Read the bins of one contig, returning a dict mapping bin number to
+    # chunk arrays (or, for CSI, to (loffset, chunks) pairs)
+    n_bin, = Int32.unpack_from(data, offset)
+    offset += 4
+    bins = {}
+    for _ in range(n_bin):
+        if csi:
+            bin, loffset, n_chunk = CSIBinHeader.unpack_from(data, offset)
+            offset += CSIBinHeader.size
+        else:
+            bin, n_chunk = BinHeader.unpack_from(data, offset)
+            offset += BinHeader.size
+        chunks = numpy.frombuffer(data, dtype="<u8", count=2 * n_chunk,
+                                  offset=offset).reshape((-1, 2))
+        offset += 16 * n_chunk
+        bins[bin] = (loffset, chunks) if csi else chunks
+    return bins, offset
+
+def find_index(path):
+    """
+    Return the path of the .tbi or .csi index of a file, or None.
+    """
+    for suffix in (".tbi", ".csi"):
+        if os.path.exists(path + suffix):
+            return path + suffix
+
+def build_index(path, preset="bed", config=None, csi=False,
+                min_shift=TBI_MIN_SHIFT, depth=TBI_DEPTH, index_path=None):
+    """
+    Index a sorted, BGZF-compressed file (see :py:func:`BioTK.io.BGZF.bgzip`
+    and :py:class:`BioTK.io.BGZF.BGZFWriter`), writing a .tbi index (or a
+    .csi index if csi is True) next to it, and return the index path.
+
+    The column layout is given by a preset name (see PRESETS), or by a
+    :py:class:`TabixConfig`. Records must be grouped by contig and sorted
+    by start within each contig. Blank lines, lines starting with the meta
+    character, and, for 0-based formats such as BED, "track" and "browser"
+    lines are skipped (as by tabix -p bed). A .tbi index only supports positions
+    below 2 ** 29; larger contigs require a CSI index, for which min_shift
+    and depth set the resolution and extent of the binning scheme.
+    """
+    config = config or PRESETS[preset]
+    if not csi:
+        min_shift, depth = TBI_MIN_SHIFT, TBI_DEPTH
+    max_end = 1 << (min_shift + depth * 3)
+
+    names, bins, linear = [], [], []
+    last_start = None
+    with BGZFReader(path) as h:
+        skip = config.skip
+        while True:
+            offset = h.tell()
+            line = h.readline()
+            if not line:
+                break
+            if skip > 0:
+                skip -= 1
+                continue
+            if is_header(line, config):
+                continue
+            fields = line.rstrip(b"\r\n").split(b"\t")
+            contig, start, end = record_interval(fields, config)
+            if end > max_end:
+                raise ValueError("Position %s on %s is too large for a %s "
+                                 "index" % (end, contig,
+                                            "CSI" if csi else ".tbi"))
+            if not names or contig != names[-1]:
+                if contig in names:
+                    raise ValueError("%s is not grouped by contig (%s)" %
+                                     (path, contig))
+                names.append(contig)
+                bins.append({})
+                linear.append([])
+                last_start = start
+            elif start < last_start:
+                raise ValueError("%s is not sorted by start (%s:%s)" %
+                                 (path, contig, start))
+            last_start = start
+            end_offset = h.tell()
+
+            chunks = bins[-1].setdefault(
+                reg2bin(start, end, min_shift, depth), [])
+            if chunks and chunks[-1][1] == offset:
+                chunks[-1][1] = end_offset
+            else:
+                chunks.append([offset, end_offset])
+
+            windows = linear[-1]
+            last_window = (end - 1) >> min_shift
+            if len(windows) <= last_window:
+                windows.extend([None] * (last_window + 1 - len(windows)))
+            for w in range(start >> min_shift, last_window + 1):
+                if windows[w] is None:
+                    windows[w] = offset
+
+    # Empty windows take the offset of the previous window
+    linear = [fill_linear(windows) for windows in linear]
+    index = TabixIndex(config, names, bins, linear=linear,
+                       min_shift=min_shift, depth=depth, csi=csi)
+    if csi:
+        for i, ref_bins in enumerate(bins):
+            for bin in ref_bins:
+                level = bin_level(bin)
+                window = (bin - bin_first(level)) << (3 * (depth - level))
+                index._loffsets[i][bin] = \
+                        int(linear[i][min(window, len(linear[i]) - 1)])
+    index_path = index_path or path + (".csi" if csi else ".tbi")
+    index.write(index_path)
+    return index_path
+
+def fill_linear(windows):
+    linear = numpy.zeros(len(windows), dtype="u8")
+    previous = 0
+    for i, offset in enumerate(windows):
+        previous = previous if offset is None else offset
+        linear[i] = previous
+    return linear
+
+class TabixFile(object):
+    """
+    Random access to the records of a sorted, BGZF-compressed, and tabix-
+    or CSI-indexed file.
+    """
+    def __init__(self, path, index_path=None):
+        index_path = index_path or find_index(path)
+        if index_path is None:
+            raise IOError("No .tbi or .csi index found for %s" % path)
+        self.path = path
+        self.index = TabixIndex.read(index_path)
+        self._handle = BGZFReader(path)
+
+    @property
+    def contigs(self):
+        return list(self.index.names)
+
+    def read_chunks(self, contig, start, end):
+        """
+        Iterate over the lines (as bytes) in the index chunks for a region,
+        which include all the records overlapping it, but may also include
+        others.
+        """
+        for chunk_start, chunk_end in self.index.chunks(contig, start, end):
+            self._handle.seek(chunk_start)
+            while self._handle.tell() < chunk_end:
+                line = self._handle.readline()
+                if not line:
+                    break
+                yield line
+
+    def fetch_lines(self, contig, start, end):
+        """
+        Iterate over the lines (as bytes, including the newline) of the
+        records on a contig overlapping the 0-based, half-open interval
+        [start, end).
+        """
+        config = self.index.config
+        for line in self.read_chunks(contig, start, end):
+            if is_header(line, config):
+                continue
+            fields = line.rstrip(b"\r\n").split(b"\t")
+            c, s, e = record_interval(fields, config)
+            if s >= end:
+                break
+            if c == contig and e > start:
+                yield line
+
+    def fetch(self, contig, start, end):
+        """
+        Iterate over the records on a contig overlapping the 0-based,
+        half-open interval [start, end), as lists of (str) fields.
+        """
+        for line in self.fetch_lines(contig, start, end):
+            yield line.decode("utf-8").rstrip("\r\n").split("\t")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._handle.close()
@@ -0,0 +1,73 @@
+import numpy
+
+from BioTK.genome import RegionSet, merge, intersect, subtract, complement, \
+        closest, coverage, coverage_histogram
+
+def regions(*items):
+    contigs, starts, ends = zip(*items)
+    return RegionSet(contigs, starts, ends, names=list(map(str, starts)))
+
+def coordinates(result):
+    return [(r.contig, r.start, r.end) for r in result]
+
+A = regions(("chr1", 10, 50), ("chr1", 40, 60), ("chr1", 60, 70), 
+            ("chr1", 100, 120), ("chr2", 0, 30))
+B = regions(("chr1", 20, 30), ("chr1", 45, 65), ("chr2", 50, 60))
+
+def test_merge():
+    merged = merge(A)
+    assert(coordinates(merged) == [("chr1", 10, 70), ("chr1", 100, 120),
+                                   ("chr2", 0, 30)])
+    assert(list(merged.scores) == [3, 1, 1])
+    assert(len(merge(A, distance=30)) == 2)
+
+def test_intersect_subtract():
+    assert(coordinates(intersect(A, B)) == 
+           [("chr1", 20, 30), ("chr1", 45, 50), ("chr1", 45, 60), 
+            ("chr1", 60, 65)])
+    assert(coordinates(subtract(A, B)) == 
+           [("chr1", 10, 20), ("chr1", 30, 45), ("chr1", 40, 45), 
+            ("chr1", 65, 70), ("chr1", 100, 120), ("chr2", 0, 30)])
+    assert(list(subtract(A, B).names) == ["10", "10", "40", "60", "100", "0"])
+
+def test_complement():
+    sizes = {"chr1": 150, "chr2": 30, "chr3": 10}
+    assert(coordinates(complement(A, sizes)) == 
+           [("chr1", 0, 10), ("chr1", 70, 100), ("chr1", 120, 150),
+            ("chr3", 0, 10)])
+
+def test_closest():
+    a_idx, b_idx, distance = closest(A, B)
+    assert(list(a_idx) == [0, 1, 2, 3, 4])
+    assert(list(b_idx) == [1, 1, 1, 1, 2])
+    assert(list(distance) == [0, 0, 0, 35, 20])
+
+    # Indices are positions in the (unsorted) inputs
+    order = numpy.array([3, 0, 4, 2, 1])
+    a_idx, b_idx, distance = closest(A[order], B[::-1], threads=2)
+    assert(list(order[a_idx]) == [0, 1, 2, 3, 4])
+    assert(list(b_idx) == [1, 1, 1, 1, 0])
+    assert(list(distance) == [0, 0, 0, 35, 20])
+    assert([len(x) for x in closest(A, B[:2])] == [4, 4, 4])
+
+def test_coverage():
+    covered = coverage(A)
+    assert(coordinates(covered)[:3] == [("chr1", 10, 40), ("chr1", 40, 50),
+                                        ("chr1", 50, 70)])
+    assert(list(covered.scores[:3]) == [1, 2, 1])
+    histogram = coverage_histogram(A, {"chr1": 150, "chr2": 30})
+    assert(list(histogram) == [70, 100, 10])
+
+def test_streaming():
+    chunks = [A.sort()[i:i+2] for i in range(0, len(A), 2)]
+    results = list(merge(iter(chunks), threads=2))
+    assert([len(r) for r in results] == [2, 1])
+    assert(coordinates(RegionSet.concatenate(results)) == 
+           coordinates(merge(A)))
+
+    # Closest regions for each contig, with positions in the streams
+    chunks = [A.sort()[i:i+2] for i in range(0, len(A), 2)]
+    results = list(closest(iter(chunks), iter([B[:1], B[1:]]), threads=2))
+    assert(len(results) == 2)
+    for column, expected in zip(zip(*results), closest(A.sort(), B)):
+        assert(list(numpy.concatenate(column)) == list(expected))
@@ -1,7 +1,18 @@
 import gzip
+import os
+
+import numpy
 
 from BioTK.io import BEDFile, download
-from BioTK.genome.index import RAMIndex
+from BioTK.genome.index import ArrayIndex, DiskIndex, RAMIndex
+from BioTK.genome.region import Region
+
+def random_intervals(n, seed=0):
+    rng = numpy.random.RandomState(seed)
+    contigs = rng.choice(["chr1", "chr2", "chrX"], n)
+    starts = rng.randint(0, 10000, n)
+    ends = starts + rng.randint(0, 500, n)
+    return contigs, starts, ends
 
 def test():
     url = "http://github.com/arq5x/chrom_sweep/blob/master/knownGene.bed.gz?raw=true"
@@ -15,3 +26,112 @@ def test():
 
     result = index.search("chr1", 0, 1000000)
     assert(len(result) == 83)
+
+def test_array_index():
+    contigs, starts, ends = random_intervals(5000)
+    index = ArrayIndex(contigs, starts, ends)
+    assert(len(index) == 5000)
+    rng = numpy.random.RandomState(1)
+    for contig in ["chr1", "chrX", "chrY"]:
+        for _ in range(100):
+            start = rng.randint(-100, 11000)
+            end = start + rng.randint(0, 1000)
+            hits = index.search(contig, start, end)
+            expected = numpy.flatnonzero((contigs == contig) & 
+                                         (starts < end) & (ends > start))
+            assert(sorted(hits) == list(expected))
+            assert((numpy.diff(starts[hits]) >= 0).all())
+
+def test_ram_index():
+    index = RAMIndex()
+    for contig, start, end in zip(*random_intervals(1000)):
+        index.add(Region(str(contig), int(start), int(end)))
+    index.build()
+    regions = list(index)
+    assert(regions == sorted(regions))
+    hits = index.search("chr2", 5000, 5100)
+    assert(hits == [r for r in regions if r.contig == "chr2" and 
+                    r.start < 5100 and r.end > 5000])
+
+def test_search_many():
+    contigs, starts, ends = random_intervals(2000)
+    index = ArrayIndex(contigs, starts, ends)
+    q_contigs, q_starts, q_ends = random_intervals(300, seed=2)
+    q_contigs[:10] = "chrY"
+
+    query_idx, hit_idx = index.search_many(q_contigs, q_starts, q_ends)
+    expected = [(i, j) for i in range(300) for j in range(2000)
+                if contigs[j] == q_contigs[i] and starts[j] < q_ends[i]
+                and ends[j] > q_starts[i]]
+    assert(sorted(zip(query_idx, hit_idx)) == expected)
+
+    counts = index.count_many(q_contigs, q_starts, q_ends)
+    assert((counts == numpy.bincount(query_idx, minlength=300)).all())
+    assert((index.any_overlap(q_contigs, q_starts, q_ends) == 
+            (counts > 0)).all())
+
+def test_disk_index(tmpdir):
+    path = os.path.join(str(tmpdir), "regions.idx")
+    contigs, starts, ends = random_intervals(2000)
+    index = ArrayIndex(contigs, starts, ends)
+    assert(index.save(path) == 0)
+    disk = DiskIndex(path)
+    assert(len(disk) == 2000)
+    queries = random_intervals(300, seed=2)
+    for expected, result in zip(index.search_many(*queries),
+                                disk.search_many(*queries)):
+        assert((expected == result).all())
+
+    # Appending a version leaves the earlier ones readable
+    assert(ArrayIndex(["chrM"], [5], [10]).save(path, append=True) == 1)
+    assert(DiskIndex(path).versions == 2)
+    assert(list(DiskIndex(path).search("chrM", 0, 6)) == [0])
+    assert(list(DiskIndex(path, version=0).search("chr1", 0, 10000)) == 
+           list(index.search("chr1", 0, 10000)))
+
+def test_incremental_index():
+    index = RAMIndex(incremental=True)
+    regions = []
+    for contig, start, end in zip(*random_intervals(1000)):
+        region = Region(str(contig), int(start), int(end))
+        index.add(region)
+        regions.append(region)
+    for region in regions[::3]:
+        index.remove(region)
+    regions = [r for i, r in enumerate(regions) if i % 3]
+    assert(len(index) == len(regions))
+    assert(list(index) == sorted(regions))
+
+    hits = index.search("chr1", 2000, 2500)
+    assert(hits == [r for r in sorted(regions) if r.contig == "chr1" and 
+                    r.start < 2500 and r.end > 2000])
+    query_idx, hit_idx = index.search_many(["chr1"], [2000], [2500])
+    assert(len(hit_idx) == len(hits))
+    assert(list(index.count_many(["chr1"], [2000], [2500])) == [len(hits)])
+
+def test_nearest():
+    index = ArrayIndex(["chr1"] * 4 + ["chr2"], [10, 50, 100, 120, 0], 
+                       [20, 60, 110, 130, 10])
+    hits, distances = index.nearest("chr1", 70, 80, k=2)
+    assert(list(hits) == [1, 2])
+    assert(list(distances) == [-10, 20])
+    hits, distances = index.nearest("chr1", 70, 80, k=2, strand="-")
+    assert(list(distances) == [10, -20])
+    hits, distances = index.nearest("chr1", 55, 105, k=3)
+    assert(list(hits) == [1, 2, 3])
+    assert(list(distances) == [0, 0, 15])
+
+    # Upstream is relative to the strand of each query
+    query_idx, hit_idx, distance = index.nearest_many(
+        ["chr1", "chr1", "chrX"], [70, 70, 0], [80, 80, 10], k=1,
+        strands=["+", "-", "+"], direction="upstream")
+    assert(list(query_idx) == [0, 1])
+    assert(list(hit_idx) == [1, 2])
+    assert(list(distance) == [-10, -20])
+
+    ram = RAMIndex(incremental=True)
+    regions = [Region("chr1", s, s + 10) for s in (10, 50, 100)]
+    for region in regions:
+        ram.add(region)
+    ram.remove(regions[1])
+    assert(ram.nearest("chr1", 70, 80) == [(regions[2], 20)])
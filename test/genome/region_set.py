@@ -0,0 +1,46 @@
+import numpy
+
+from BioTK.genome import Region, RegionSet
+
+def example():
+    return RegionSet(["chr2", "chr1", "chr1", "chrX"], [50, 300, 100, 0],
+                     [80, 400, 200, 10], names=["a", "b", "c", "d"],
+                     strands=["+", "-", ".", "+"])
+
+def test_region_set_sort():
+    regions = example()
+    assert(regions.contig_names == ["chr1", "chr2", "chrX"])
+    assert(not regions.is_sorted())
+    regions = regions.sort()
+    assert(regions.is_sorted())
+    assert(list(regions.names) == ["c", "b", "a", "d"])
+    assert(list(regions.contigs) == ["chr1", "chr1", "chr2", "chrX"])
+
+def test_region_set_select():
+    regions = example()
+    assert(len(regions[1:]) == 3)
+    subset = regions[regions.lengths() > 50]
+    assert(list(subset.starts) == [300, 100])
+    assert(list(regions.contig("chr1").names) == ["b", "c"])
+    assert(len(regions.contig("chrY")) == 0)
+
+    region = regions[1]
+    assert(isinstance(region, Region))
+    assert((region.contig, region.start, region.end, region.strand) ==
+           ("chr1", 300, 400, "-"))
+
+def test_region_set_convert():
+    regions = example()
+    copy = RegionSet.from_regions(regions.to_regions())
+    assert(list(copy.strands) == list(regions.strands))
+    assert(list(copy.names) == list(regions.names))
+    assert(list(RegionSet.from_frame(regions.to_frame()).ends) == 
+           list(regions.ends))
+
+    both = RegionSet.concatenate([regions, RegionSet(["chrM"], [0], [5])])
+    assert(len(both) == 5)
+    assert(both.names is None)
+    assert(list(both.contigs[-2:]) == ["chrX", "chrM"])
+
+    index = regions.index()
+    assert(list(index.search("chr1", 150, 350)) == [2, 1])
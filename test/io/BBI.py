@@ -0,0 +1,672 @@
+import functools
+import http.server
+import os
+import threading
+import zlib
+
+from struct import Struct, pack
+
+import numpy
+import pytest
+
+from BioTK.io.BBI import BigWigFile, BigWigWriter, BEDGraph, HTTPSource, \
+        SectionCache, summarize_files, BBIPool, ContigNotFound, open_bbi, \
+        BigBEDFile, BED, read_bed_section, write_tree, write_rtree, \
+        BBIHeader, TotalSummary, BPTreeHeader, ExtensionHeader, \
+        ExtraIndexHeader, ExtraIndexField, Contig, IndexNotFound, NAME_FIELD, \
+        BigWigSectionHeader, STATS, RTree, LeafIndex
+
+CONTIGS = [("chr1", 200000), ("chr2", 50000)]
+
+def random_records(contig, size, n, seed=0):
+    rng = numpy.random.RandomState(seed)
+    starts = numpy.sort(rng.choice(size - 100, n, replace=False))
+    ends = numpy.minimum(starts + rng.randint(1, 50, n),
+                         numpy.append(starts[1:], size))
+    values = rng.uniform(0, 10, n).astype("f4")
+    return starts, ends, values
+
+@pytest.fixture
+def bigwig(tmpdir):
+    path = os.path.join(str(tmpdir), "test.bw")
+    data = {}
+    with BigWigWriter(path, CONTIGS, items_per_slot=100) as writer:
+        for i, (contig, size) in enumerate(CONTIGS):
+            starts, ends, values = random_records(contig, size, 5000, seed=i)
+            data[contig] = (starts, ends, values)
+            # Mix array chunks and record iterators
+            writer.write_arrays(contig, starts[:2000], ends[:2000],
+                                values[:2000])
+            writer.write(zip([contig] * 3000, starts[2000:],
+                             ends[2000:], values[2000:]))
+    return path, data
+
+def dense(data, contig, size):
+    starts, ends, values = data[contig]
+    result = numpy.full(size, numpy.nan, dtype="f4")
+    for start, end, value in zip(starts, ends, values):
+        result[start:end] = value
+    return result
+
+def write_bbi(path, magic, sections, data_count, items_per_slot,
+              field_count=0, extra_index=None, block_size=4):
+    """
+    Write a BBI file without zoom levels, with the given (contig ID, start,
+    end, uncompressed data) sections of at most items_per_slot items and,
+    optionally, an extra index on the name field given as (name, section
+    number) pairs.
+    """
+    with open(path, "wb") as h:
+        summary_offset = BBIHeader._struct.size
+        h.write(bytes(summary_offset + TotalSummary._struct.size))
+
+        contig_tree_offset = h.tell()
+        key_size = max(len(name) for name, _ in CONTIGS)
+        items = sorted((name.encode("ascii").ljust(key_size, b"\0"), id, size)
+                       for id, (name, size) in enumerate(CONTIGS))
+        h.write(BPTreeHeader._struct.pack(0x78CA8C91, block_size, key_size,
+                                          8, len(items), 0))
+        write_tree(h, items, block_size, Struct("=%dsII" % key_size),
+                   Struct("=%dsQ" % key_size),
+                   lambda leaves, offset: (leaves[0][0], offset))
+
+        data_offset = h.tell()
+        h.write(pack("=I", data_count))
+        leaves = []
+        for contig_id, start, end, data in sections:
+            data = zlib.compress(data)
+            leaves.append((contig_id, start, contig_id, end, h.tell(),
+                           len(data)))
+            h.write(data)
+        index_offset = write_rtree(h, leaves, block_size, items_per_slot)
+
+        extension_offset = 0
+        if extra_index is not None:
+            extension_offset = h.tell()
+            list_offset = extension_offset + ExtensionHeader._struct.size
+            tree_offset = list_offset + ExtraIndexHeader._struct.size + \
+                    ExtraIndexField._struct.size
+            h.write(ExtensionHeader._struct.pack(
+                ExtensionHeader._struct.size, 1, list_offset))
+            h.write(ExtraIndexHeader._struct.pack(0, 1, tree_offset, 0))
+            h.write(ExtraIndexField._struct.pack(NAME_FIELD, 0))
+            key_size = max(len(name) for name, _ in extra_index)
+            items = sorted(set((name.ljust(key_size, b"\0"),) + leaves[i][4:]
+                               for name, i in extra_index))
+            h.write(BPTreeHeader._struct.pack(0x78CA8C91, block_size, 
+                                              key_size, 16, len(items), 0))
+            write_tree(h, items, block_size, Struct("=%dsQQ" % key_size),
+                       Struct("=%dsQ" % key_size),
+                       lambda leaves, offset: (leaves[0][0], offset))
+
+        h.seek(0)
+        h.write(BBIHeader._struct.pack(
+            magic, 4, 0, contig_tree_offset, data_offset, index_offset,
+            field_count, min(field_count, 6), 0, summary_offset,
+            max(len(data) for _, _, _, data in sections), extension_offset))
+
+def bed_records(n=1000, seed=0):
+    # BED6+3 records, sorted by contig and start, where each run of three
+    # records shares a name (so some names span two sections)
+    rng = numpy.random.RandomState(seed)
+    records = []
+    for contig, size in CONTIGS:
+        starts = numpy.sort(rng.randint(0, size - 1000, n))
+        ends = starts + rng.randint(1, 1000, n)
+        for i, (start, end) in enumerate(zip(starts.tolist(), ends.tolist())):
+            records.append(BED(contig, start, end, 
+                               ("%s_%d" % (contig, i // 3)).encode("ascii"),
+                               float(rng.randint(0, 1000)),
+                               rng.choice([b"+", b"-", b"."]),
+                               (str(start).encode("ascii"), 
+                                str(end).encode("ascii"), b"0,0,0")))
+    return records
+
+def write_bigbed(path, records, name_index=True):
+    # Sections of 100 records, each on a single contig
+    contig_ids = dict((name, id) for id, (name, _) in enumerate(CONTIGS))
+    sections, names = [], []
+    for i in range(0, len(records), 100):
+        section = records[i:i+100]
+        contig_id = contig_ids[section[0].chrom]
+        data = b"".join(
+            pack("=III", contig_id, r.start, r.end) + 
+            b"\t".join((r.name, b"%d" % r.score, r.strand) + r.rest) + b"\0"
+            for r in section)
+        sections.append((contig_id, section[0].start, 
+                         max(r.end for r in section), data))
+        names.extend((r.name, len(sections) - 1) for r in section)
+    write_bbi(path, 0x8789F2EB, sections, len(records), 100, field_count=9,
+              extra_index=names if name_index else None)
+
+@pytest.fixture
+def bigbed(tmpdir):
+    path = os.path.join(str(tmpdir), "test.bb")
+    records = bed_records()
+    write_bigbed(path, records)
+    return path, records
+
+@pytest.fixture(params=[False, True], ids=["rtree", "cache_index"])
+def cache_index(request):
+    # Whether BBI files are opened with their R tree leaves cached in a
+    # LeafIndex
+    return request.param
+
+def test_write_contigs(bigwig):
+    path, data = bigwig
+    bw = BigWigFile(path)
+    assert(sorted((c.name, c.size) for c in bw.contigs) == sorted(CONTIGS))
+    assert(bw._leaves.header.itemsPerSlot == 100)
+
+def test_write_records(bigwig, cache_index):
+    path, data = bigwig
+    bw = BigWigFile(path, cache_index=cache_index)
+    records = list(bw.search("chr2", 0, 50000))
+    starts, ends, values = data["chr2"]
+    assert(len(records) == len(starts))
+    assert(records[10] == BEDGraph("chr2", starts[10], ends[10], values[10]))
+
+def test_write_values(bigwig, cache_index):
+    path, data = bigwig
+    bw = BigWigFile(path, cache_index=cache_index)
+    for contig, size in CONTIGS:
+        expected = dense(data, contig, size)
+        assert(numpy.array_equal(bw.values(contig, 0, size), expected,
+                                 equal_nan=True))
+        assert(numpy.array_equal(bw.values(contig, 1234, 5678),
+                                 expected[1234:5678], equal_nan=True))
+
+def test_write_summary(bigwig, cache_index):
+    path, data = bigwig
+    bw = BigWigFile(path, cache_index=cache_index)
+    expected = dense(data, "chr1", 200000)[1000:150000]
+    exact = bw.summarize_region("chr1", 1000, 150000, exact=True)
+    assert(exact.covered == (~numpy.isnan(expected)).sum())
+    assert(numpy.isclose(exact.mean, numpy.nanmean(expected), rtol=1e-5))
+
+    # Zoom summaries are approximate at the region edges
+    assert(len(bw.zoom_levels) > 0)
+    zoom = bw.summarize_region("chr1", 1000, 150000)
+    assert(numpy.isclose(zoom.mean, exact.mean, rtol=1e-2))
+
+    total = sum((ends - starts).sum() for starts, ends, _ in data.values())
+    assert(bw.summary.basesCovered == total)
+
+def test_summarize_regions_exact(bigwig, cache_index):
+    path, data = bigwig
+    bw = BigWigFile(path, cache_index=cache_index)
+    rng = numpy.random.RandomState(4)
+    contigs, starts, ends = ["chrX", "chr1", "chr2"], [0, 0, 0], \
+            [1000, 200000, 50000]
+    for contig, size in CONTIGS:
+        record_starts = data[contig][0]
+        # 1 bp queries on and between records, and queries spanning 
+        # several sections (of 100 records each)
+        for start in rng.choice(record_starts, 20).tolist() + \
+                rng.randint(0, size, 20).tolist():
+            contigs.append(contig)
+            starts.append(start)
+            ends.append(start + 1)
+        for start in rng.randint(0, size - 20000, 20).tolist():
+            contigs.append(contig)
+            starts.append(start)
+            ends.append(start + rng.choice([100, 5000, 20000]))
+    summary = bw.summarize_regions((contigs, starts, ends), exact=True)
+    assert(summary.covered[0] == summary.sum[0] == summary.mean[0] == 0)
+    assert((summary.covered[3:23] == 1).all())
+
+    for i, (contig, start, end) in enumerate(zip(contigs, starts, ends)):
+        single = bw.summarize_region(contig, start, end, exact=True)
+        values = bw.values(contig, start, end)
+        covered = ~numpy.isnan(values)
+        total = values[covered].astype("f8").sum()
+        assert(summary.size[i] == single.size == end - start)
+        assert(summary.covered[i] == single.covered == covered.sum())
+        assert(numpy.isclose(summary.sum[i], single.sum, rtol=1e-6))
+        assert(numpy.isclose(summary.sum[i], total, rtol=1e-5))
+        assert(numpy.isclose(summary.mean0[i], single.mean0, rtol=1e-6))
+        assert(numpy.isclose(summary.mean[i], single.mean, rtol=1e-6))
+        assert(numpy.isclose(summary.mean[i], 
+                             total / covered.sum() if covered.any() else 0,
+                             rtol=1e-5))
+
+def expected_stats(values, nbins):
+    # Each statistic over the bins of a per-base values array
+    size = len(values)
+    edges = size * numpy.arange(nbins + 1) // nbins
+    result = dict((stat, numpy.full(nbins, numpy.nan)) for stat in STATS)
+    for i, (lo, hi) in enumerate(zip(edges[:-1], edges[1:])):
+        v = values[lo:hi][~numpy.isnan(values[lo:hi])].astype("f8")
+        result["coverage"][i] = len(v) / (hi - lo)
+        if len(v):
+            result["mean"][i] = v.mean()
+            result["min"][i] = v.min()
+            result["max"][i] = v.max()
+            result["std"][i] = v.std(ddof=1) if len(v) > 1 else 0
+    return result
+
+@pytest.mark.parametrize("nbins", [1, 7, 100])
+def test_stats_exact(bigwig, nbins, cache_index):
+    path, data = bigwig
+    bw = BigWigFile(path, cache_index=cache_index)
+    regions = (["chr1", "chr2", "chr1", "chrX", "chr2"],
+               [0, 1234, 150000, 0, 49900], [200000, 40000, 150700, 1000,
+                                             50000])
+    for stat in STATS:
+        matrix = bw.stats_many(regions, nbins=nbins, stat=stat, exact=True)
+        assert(matrix.shape == (5, nbins) and matrix.dtype == "f4")
+        for row, (contig, start, end) in enumerate(zip(*regions)):
+            if contig == "chrX":
+                expected = numpy.full(nbins, 0 if stat == "coverage" 
+                                      else numpy.nan)
+            else:
+                values = bw.values(contig, start, end)
+                expected = expected_stats(values, nbins)[stat]
+            assert(numpy.allclose(matrix[row], expected, rtol=1e-4, 
+                                  atol=1e-5, equal_nan=True))
+            assert(numpy.array_equal(
+                bw.stats(contig, start, end, nbins=nbins, stat=stat, 
+                         exact=True), matrix[row], equal_nan=True))
+    with pytest.raises(ValueError):
+        bw.stats("chr1", 0, 1000, stat="median")
+
+def test_stats_zoom(bigwig, cache_index):
+    path, data = bigwig
+    bw = BigWigFile(path, cache_index=cache_index)
+    # Bins aligned to the records of the zoom level they are read from
+    zoom = max((z for z in bw.zoom_levels if 20 * z.reductionLevel < 200000),
+               key=lambda z: z.reductionLevel)
+    reduction = zoom.reductionLevel
+    nbins = (200000 - reduction) // (2 * reduction)
+    start, end = reduction, reduction + 2 * reduction * nbins
+    assert(nbins > 1)
+    assert(bw._best_zoom(2 * reduction) == zoom)
+
+    values = bw.values("chr1", start, end)
+    expected = expected_stats(values, nbins)
+    for stat in STATS:
+        result = bw.stats("chr1", start, end, nbins=nbins, stat=stat)
+        assert(numpy.allclose(result, expected[stat], rtol=1e-3, 
+                              equal_nan=True))
+        assert(numpy.allclose(result, 
+                              bw.stats("chr1", start, end, nbins=nbins, 
+                                       stat=stat, exact=True),
+                              rtol=1e-3, equal_nan=True))
+
+    # Unaligned bins are approximate at the zoom record boundaries
+    exact = bw.stats("chr1", 1000, 151000, nbins=3, exact=True)
+    assert(numpy.allclose(bw.stats("chr1", 1000, 151000, nbins=3), exact,
+                          rtol=1e-2))
+
+def test_write_unsorted(tmpdir):
+    path = os.path.join(str(tmpdir), "unsorted.bw")
+    writer = BigWigWriter(path, CONTIGS)
+    writer.write_arrays("chr1", [100], [200], [1.0])
+    with pytest.raises(ValueError):
+        writer.write_arrays("chr1", [150], [300], [1.0])
+    with pytest.raises(ValueError):
+        writer.write_arrays("chr2", [10, 5], [20, 15], [1.0, 2.0])
+    writer.close()
+
+def test_summarize_files(bigwig, tmpdir):
+    path, data = bigwig
+    other = os.path.join(str(tmpdir), "other.bw")
+    with BigWigWriter(other, CONTIGS) as writer:
+        writer.write_arrays("chr1", [0, 500], [100, 1000], [1.0, 3.0])
+
+    regions = (["chr1", "chr2", "chr1", "chrX"],
+               [0, 100, 5000, 0], [1000, 20000, 90000, 10])
+    expected = numpy.column_stack([
+        BigWigFile(p).summarize_regions(regions).mean for p in (path, other)])
+    for processes in (1, 2):
+        matrix = summarize_files([path, other], regions, processes=processes)
+        assert(matrix.shape == (4, 2))
+        assert(numpy.allclose(matrix, expected))
+    assert(numpy.isclose(matrix[0,1], (100 + 1500) / 600))
+
+def test_collapse_runs(tmpdir):
+    path = os.path.join(str(tmpdir), "runs.bw")
+    starts = numpy.arange(0, 100, 10)
+    values = [1, 1, 1.0005, 2, 2, 2, 3, 3, 3, 3]
+    with BigWigWriter(path, CONTIGS, items_per_slot=4) as writer:
+        writer.write_arrays("chr1", starts, starts + 10, values)
+        writer.write_arrays("chr1", [100, 120], [110, 130], [3, 3])
+
+    bw = BigWigFile(path)
+    expected = [("chr1", 0, 30, 1), ("chr1", 30, 60, 2), 
+                ("chr1", 60, 110, 3), ("chr1", 120, 130, 3)]
+    assert([tuple(r) for r in bw] == expected)
+    assert(len(bw) == 4)
+    # Only the records overlapping the query are collapsed
+    assert([tuple(r) for r in bw.search("chr1", 45, 125)] == 
+           [("chr1", 40, 60, 2)] + expected[2:])
+
+    bedgraph = os.path.join(str(tmpdir), "runs.bedGraph")
+    bw.to_bedgraph(bedgraph)
+    with open(bedgraph) as h:
+        assert(h.readline() == "chr1\t0\t30\t1\n")
+
+def test_fixed_step(tmpdir):
+    path = os.path.join(str(tmpdir), "fixed.bw")
+    # (contig ID, start, step, span, values) of each fixedStep section
+    steps = [(0, 1000, 10, 5, numpy.arange(50, dtype="f4") + 1),
+             (0, 2000, 1, 1, numpy.arange(300, dtype="f4") / 2),
+             (1, 0, 100, 100, -numpy.arange(1, 11, dtype="f4"))]
+    sections, expected = [], []
+    for contig_id, start, step, span, values in steps:
+        starts = start + step * numpy.arange(len(values))
+        end = int(starts[-1]) + span
+        header = BigWigSectionHeader._struct.pack(
+            contig_id, start, end, step, span, BigWigFile.fixedStep, 0,
+            len(values))
+        sections.append((contig_id, start, end, header + values.tobytes()))
+        expected.extend(BEDGraph(CONTIGS[contig_id][0], s, s + span, v)
+                        for s, v in zip(starts.tolist(), values.tolist()))
+    write_bbi(path, 0x888FFC26, sections, len(sections), 300)
+
+    bw = BigWigFile(path)
+    assert(list(bw) == expected)
+    assert(list(bw.search("chr1", 1012, 2003)) == expected[1:53])
+    assert(list(bw.search("chr2", 250, 350)) == expected[-8:-6])
+
+    expected_values = numpy.full(1410, numpy.nan, dtype="f4")
+    for r in expected[:350]:
+        expected_values[r.start - 990:r.end - 990] = r.value
+    assert(numpy.array_equal(bw.values("chr1", 990, 2400), 
+                             expected_values, equal_nan=True))
+    assert(numpy.isclose(bw.summarize_region("chr2", 0, 1000, 
+                                             exact=True).mean, -5.5))
+    section = bw._read_section_internal(next(bw._all_leaves()))
+    assert(not section.flags.writeable)
+
+def test_leaf_index(bigwig, bigbed):
+    # The in-memory leaf index finds the same sections as the R tree
+    rng = numpy.random.RandomState(3)
+    for path, cls in ((bigwig[0], BigWigFile), (bigbed[0], BigBEDFile)):
+        files = cls(path), cls(path, cache_index=True)
+        rtree, leaf_index = [f._leaves for f in files]
+        assert(isinstance(rtree, RTree))
+        assert(isinstance(leaf_index, LeafIndex))
+        for contig_id, (contig, size) in enumerate(CONTIGS):
+            starts = rng.randint(0, size, 50)
+            ends = starts + rng.choice([1, 100, 10000], 50)
+            for start, end in zip(starts.tolist(), ends.tolist()):
+                assert(leaf_index.search(contig_id, start, end) == 
+                       rtree.search(contig_id, start, end))
+            for n in (1, 5, 50):
+                assert(leaf_index.search_many(contig_id, starts[:n], 
+                                              ends[:n]) ==
+                       rtree.search_many(contig_id, starts[:n], ends[:n]))
+        assert(leaf_index.search(len(CONTIGS), 0, 1000) == [])
+        assert(leaf_index.search_many(len(CONTIGS), [0], [1000]) == [])
+
+def test_iter_chunks(bigwig, cache_index):
+    path, data = bigwig
+    bw = BigWigFile(path, cache_index=cache_index)
+    # A whole contig, a region, and the whole file
+    chunks = list(bw.iter_chunks("chr2"))
+    assert(all(chrom == "chr2" for chrom, _ in chunks))
+    records = numpy.concatenate([records for _, records in chunks])
+    assert(numpy.array_equal(records, numpy.concatenate(
+        [records for _, records in bw.iter_chunks("chr2", 0, 50000)])))
+    assert(numpy.array_equal(records, numpy.concatenate(
+        [records for chrom, records in bw.iter_chunks() 
+         if chrom == "chr2"])))
+    assert(len(records) == len(list(bw.search("chr2", 0, 50000))))
+    assert(records["start"][0] == data["chr2"][0][0])
+    assert(records["end"][-1] == data["chr2"][1][-1])
+    assert(list(bw.iter_chunks("chr2", end=0)) == [])
+
+def test_section_cache():
+    cache = SectionCache(max_bytes=250)
+    loads = []
+
+    def get(key):
+        def load():
+            loads.append(key)
+            return numpy.zeros(100, dtype="u1")
+        return cache.get(key, load)
+
+    a = get("a")
+    assert(get("a") is a)
+    get("b")
+    # "a" was used more recently than "b", so "b" is evicted first
+    get("a")
+    get("c")
+    assert(cache.stats() == (2, 3, 1, 200, 2))
+    get("a")
+    get("b")
+    assert(loads == ["a", "b", "c", "b"])
+    stats = cache.stats()
+    assert((stats.hits, stats.misses, stats.evictions) == (3, 4, 2))
+    assert((stats.size, stats.count) == (200, 2))
+
+    # Sections larger than the cache are returned but not cached
+    big = cache.get("big", lambda: numpy.zeros(1000, dtype="u1"))
+    assert(len(big) == 1000)
+    assert(cache.stats().size == 200)
+    cache.clear()
+    assert(cache.stats()[3:] == (0, 0))
+
+def test_section_cache_files(bigwig):
+    path, data = bigwig
+    cache = SectionCache()
+    bw = BigWigFile(path, section_cache=cache)
+    expected = bw.values("chr1", 0, 200000)
+    stats = cache.stats()
+    assert(stats.hits == 0 and stats.misses == stats.count > 0)
+    assert(stats.size == sum(len(bw._read_section_internal(leaf)) * 12
+                             for leaf in bw._all_leaves() 
+                             if leaf.startChromIx == 0))
+    # Another handle to the same file shares the cached sections
+    other = BigWigFile(path, section_cache=cache)
+    assert(numpy.array_equal(other.values("chr1", 0, 200000), expected,
+                             equal_nan=True))
+    assert(cache.stats().misses == stats.misses)
+
+def test_concurrent_reads(bigwig, bigbed, cache_index):
+    from concurrent.futures import ThreadPoolExecutor
+    rng = numpy.random.RandomState(2)
+    queries = []
+    for _ in range(100):
+        contig, size = CONTIGS[rng.randint(len(CONTIGS))]
+        start = rng.randint(0, size - 1)
+        queries.append((contig, start, min(start + rng.randint(1, 20000), 
+                                           size)))
+
+    # Without a section cache, every query reads and decompresses
+    bw = BigWigFile(bigwig[0], cache_index=cache_index, 
+                    section_cache=SectionCache(0))
+    bb = BigBEDFile(bigbed[0], cache_index=cache_index, 
+                    section_cache=SectionCache(0))
+
+    def read(query):
+        return (bw.values(*query), list(bw.search(*query)),
+                list(bb.search(*query)))
+
+    expected = [read(query) for query in queries]
+    with ThreadPoolExecutor(8) as executor:
+        for _ in range(2):
+            results = list(executor.map(read, queries))
+            for result, serial in zip(results, expected):
+                assert(numpy.array_equal(result[0], serial[0], 
+                                         equal_nan=True))
+                assert(result[1:] == serial[1:])
+
+class RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    A minimal static file handler supporting single range requests.
+    """
+    requests = 0
+
+    def do_GET(self):
+        RangeRequestHandler.requests += 1
+        path = self.translate_path(self.path)
+        with open(path, "rb") as h:
+            data = h.read()
+        start, end = self.headers["Range"].split("=")[1].split("-")
+        start, end = int(start), min(int(end), len(data) - 1)
+        self.send_response(206)
+        self.send_header("Content-Range", 
+                         "bytes %d-%d/%d" % (start, end, len(data)))
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        self.wfile.write(data[start:end+1])
+
+    def log_message(self, *args):
+        pass
+
+def test_http_source(bigwig, tmpdir):
+    path, data = bigwig
+    directory = os.path.dirname(path)
+    handler = functools.partial(RangeRequestHandler, directory=directory)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        url = "http://127.0.0.1:%d/%s" % (server.server_port, 
+                                          os.path.basename(path))
+        cache_dir = os.path.join(str(tmpdir), "cache")
+        source = HTTPSource(url, block_size=4096, cache_dir=cache_dir)
+        remote = BigWigFile(source, section_cache=SectionCache(0))
+        local = BigWigFile(path)
+        assert(numpy.array_equal(remote.values("chr1", 0, 200000),
+                                 local.values("chr1", 0, 200000), 
+                                 equal_nan=True))
+        assert(list(remote.search("chr2", 100, 5000)) == 
+               list(local.search("chr2", 100, 5000)))
+
+        # Everything read so far is served from the block cache
+        requests = RangeRequestHandler.requests
+        remote.values("chr1", 0, 200000)
+        assert(RangeRequestHandler.requests == requests)
+        source.close()
+    finally:
+        server.shutdown()
+
+def test_pool(bigwig, tmpdir):
+    path, data = bigwig
+    paths = [path]
+    for i in range(3):
+        other = os.path.join(str(tmpdir), "pool%d.bw" % i)
+        with BigWigWriter(other, CONTIGS) as writer:
+            writer.write_arrays("chr1", [0], [100], [float(i)])
+        paths.append(other)
+
+    with BBIPool(max_open=2) as pool:
+        for i, p in enumerate(paths[1:]):
+            bw = pool.get(p)
+            assert(isinstance(bw, BigWigFile))
+            assert(bw.summarize_region("chr1", 0, 100).mean == i)
+            assert(pool.get(p) is bw)
+        assert(len(pool) == 2)
+        assert(paths[1] not in pool)
+
+    # The contig table is only read in full when it is listed
+    bw = open_bbi(path)
+    assert(bw.dataCount > 0)
+    with pytest.raises(ContigNotFound):
+        list(bw.search("chrX", 0, 10))
+    assert(bw._contigs is None)
+    assert(len(bw.contigs) == 2)
+    bw.close()
+    with pytest.raises(ValueError):
+        open_bbi(os.path.join(os.path.dirname(__file__), "BBI.py"))
+
+def test_bigbed_batches(bigbed, cache_index):
+    path, records = bigbed
+    bb = BigBEDFile(path, cache_index=cache_index, 
+                    section_cache=SectionCache())
+    assert(len(bb) == len(records))
+    assert(list(bb) == records)
+
+    batches = list(bb.iter_batches())
+    assert(len(batches) == len(records) // 100)
+    assert(sum(len(batch) for batch in batches) == len(records))
+    batch = batches[12]
+    expected = records[1200:1300]
+    assert(batch.chrom.tolist() == [r.chrom for r in expected])
+    assert(batch.start.tolist() == [r.start for r in expected])
+    assert(batch.end.tolist() == [r.end for r in expected])
+    assert(batch.name.tolist() == [r.name for r in expected])
+    assert(batch.score.tolist() == [r.score for r in expected])
+    assert(batch.strand.tolist() == [r.strand for r in expected])
+    assert(batch.rest.tolist() == [r.rest for r in expected])
+    assert(list(batch[::7]) == expected[::7])
+
+    # Sections are decoded once, and then served from the cache
+    misses = bb._section_cache.stats().misses
+    assert(misses == len(batches))
+    assert(list(bb.iter_batches())[12] is batch)
+    assert(bb._section_cache.stats().misses == misses)
+
+def test_bigbed_search_batches(bigbed, cache_index):
+    import pandas
+    path, records = bigbed
+    bb = BigBEDFile(path, cache_index=cache_index)
+    rng = numpy.random.RandomState(1)
+    for _ in range(20):
+        contig, size = CONTIGS[rng.randint(len(CONTIGS))]
+        start = rng.randint(0, size)
+        end = start + rng.choice([1, 1000, 20000])
+        expected = [r for r in records if r.chrom == contig and 
+                    r.start < end and start < r.end]
+        assert(list(bb.search(contig, start, end)) == expected)
+        batches = list(bb.search_batches(contig, start, end))
+        assert(all(len(batch) for batch in batches))
+        if not expected:
+            assert(batches == [])
+            continue
+        frame = pandas.concat([batch.to_frame(rest=True) 
+                               for batch in batches], ignore_index=True)
+        pandas.testing.assert_frame_equal(frame, pandas.DataFrame(
+            expected, columns=BED._fields), check_dtype=False)
+
+def test_read_bed_section():
+    # Records without the optional fields
+    data = pack("=III", 0, 10, 20) + b"a\0" + \
+            pack("=III", 1, 5, 15) + b"b\t7\0" + \
+            pack("=III", 1, 30, 40) + b"c\t8\t-\tx\ty\0"
+    contigs = dict((id, Contig(name, id, size)) 
+                   for id, (name, size) in enumerate(CONTIGS))
+    batch = read_bed_section(data, contigs)
+    assert(batch.chrom.tolist() == ["chr1", "chr2", "chr2"])
+    assert(batch.start.tolist() == [10, 5, 30])
+    assert(batch.name.tolist() == [b"a", b"b", b"c"])
+    assert(numpy.isnan(batch.score[0]) and batch.score[1:].tolist() == [7, 8])
+    assert(batch.strand.tolist() == [b".", b".", b"-"])
+    assert(batch.rest.tolist() == [None, None, (b"x", b"y")])
+
+def test_bigbed_search_name(bigbed, tmpdir, cache_index):
+    path, records = bigbed
+    cache = SectionCache()
+    bb = BigBEDFile(path, cache_index=cache_index, section_cache=cache)
+    by_name = {}
+    for r in records:
+        by_name.setdefault(r.name, []).append(r)
+
+    assert(list(bb.search_name("chr1_5")) == by_name[b"chr1_5"])
+    assert(cache.stats().misses == 1)
+    # Records 99-101 of chr2 are in two sections
+    assert(list(bb.search_name(b"chr2_33")) == by_name[b"chr2_33"])
+    assert(len(by_name[b"chr2_33"]) == 3)
+    assert(cache.stats().misses == 3)
+    for name in ("chr1_1000", "chr3_1", "chr1_", "x" * 100):
+        assert(list(bb.search_name(name)) == [])
+
+    names = ["chr2_300", "chr1_0", b"chr1_333", "missing", "chr1_0"]
+    expected = by_name[b"chr1_0"] + by_name[b"chr1_333"] + \
+            by_name[b"chr2_300"]
+    assert(list(bb.search_names(names)) == expected)
+    assert(list(bb.search_names([])) == [])
+
+    # Only the sections containing the names are read
+    cache = SectionCache()
+    bb = BigBEDFile(path, cache_index=cache_index, section_cache=cache)
+    list(bb.search_names(["chr1_0", "chr1_1", "chr1_333", "chr2_333"]))
+    assert(cache.stats().misses == 3)
+
+    other = os.path.join(str(tmpdir), "no_index.bb")
+    write_bigbed(other, records, name_index=False)
+    with pytest.raises(IndexNotFound):
+        list(BigBEDFile(other).search_name("chr1_5"))
@@ -0,0 +1,53 @@
+import io
+
+import numpy
+
+from BioTK.io.BED import BEDFile
+
+BED6 = "\n".join([
+    "track name=test",
+    "browser position chr1:1-1000",
+    "# comment",
+    "chr2\t10\t20\ta\t5\t+",
+    "",
+    "chr1\t0\t100\tb\t.\t-",
+    "track name=second",
+    "chr1\t50\t60\tc\t1.5\t.",
+])
+
+def test_regions():
+    regions = BEDFile(io.StringIO(BED6)).read()
+    assert(len(regions) == 3)
+    assert(regions.contig_names == ["chr1", "chr2"])
+    assert(list(regions.contigs) == ["chr2", "chr1", "chr1"])
+    assert(list(regions.starts) == [10, 0, 50])
+    assert(list(regions.ends) == [20, 100, 60])
+    assert(list(regions.names) == ["a", "b", "c"])
+    assert(regions.names.dtype.kind == "U")
+    assert(list(regions.scores) == [5, 0, 1.5])
+    assert(list(regions.strands) == ["+", "-", "."])
+
+    r = list(BEDFile(io.BytesIO(BED6.encode())))[0]
+    assert((r.contig, r.start, r.end, r.name) == ("chr2", 10, 20, "a"))
+    assert(type(r.name) is str)
+
+def test_chunks():
+    rng = numpy.random.RandomState(0)
+    starts = rng.randint(0, 10 ** 9, 2500)
+    handle = io.StringIO("".join("chr%s\t%s\t%s\r\n" % (i % 5, s, s + i)
+                                 for i, s in enumerate(starts)))
+    chunks = list(BEDFile(handle).iter_chunks(chunk_size=1000))
+    assert([len(c) for c in chunks] == [1000, 1000, 500])
+    assert(chunks[0].names is None)
+    regions = chunks[0].concatenate(chunks)
+    assert((regions.starts == starts).all())
+    assert((regions.lengths() == numpy.arange(2500)).all())
+
+def test_frame():
+    handle = io.StringIO("chr1\t1\t5\tx\t0\t+\t2\t4\t255,0,0\t2\t1,2,\t0,2,\n")
+    df, = BEDFile(handle).iter_chunks(as_frame=True)
+    assert(list(df.columns)[-3:] == ["blockCount", "blockSizes",
+                                     "blockStarts"])
+    assert(df["thickEnd"].dtype == "i8")
+    assert(df["blockCount"].dtype == "i4")
+    assert(df["itemRgb"][0] == "255,0,0")
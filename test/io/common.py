@@ -0,0 +1,111 @@
+import bz2
+import gzip
+import io
+import os
+
+import pytest
+
+from BioTK.io.BGZF import bgzip
+from BioTK.io.common import DecompressingReader, detect_compression, \
+        generic_open, has_members, member_segments
+
+DATA = b"".join(b"line %d\t%d\n" % (i, i * 7919 % 1000003)
+                for i in range(200000))
+
+@pytest.fixture(scope="module")
+def files(tmpdir_factory):
+    tmpdir = tmpdir_factory.mktemp("common")
+
+    def path(name):
+        return os.path.join(str(tmpdir), name)
+
+    with open(path("plain"), "wb") as h:
+        h.write(DATA)
+    with open(path("gzip"), "wb") as h:
+        h.write(gzip.compress(DATA))
+    with open(path("members"), "wb") as h:
+        for i in range(0, len(DATA), 100000):
+            h.write(gzip.compress(DATA[i:i + 100000]))
+    with open(path("streams"), "wb") as h:
+        for i in range(0, len(DATA), 100000):
+            h.write(bz2.compress(DATA[i:i + 100000]))
+    bgzip(path("plain"), path("bgzf"))
+    return path
+
+def test_detect(files):
+    # Extensions are ignored
+    assert(detect_compression(files("plain")) is None)
+    assert(detect_compression(files("gzip")) == "gzip")
+    assert(detect_compression(files("members")) == "gzip")
+    assert(detect_compression(files("streams")) == "bzip2")
+    assert(detect_compression(files("bgzf")) == "bgzf")
+
+@pytest.mark.parametrize("name", ["plain", "gzip", "members", "streams",
+                                  "bgzf"])
+def test_generic_open(files, name):
+    with generic_open(files(name), "rb") as h:
+        assert(h.read() == DATA)
+    with generic_open(files(name)) as h:
+        assert(h.readline() == "line 0\t0\n")
+        assert(sum(1 for _ in h) == 199999)
+
+@pytest.mark.parametrize("name", ["members", "streams", "bgzf"])
+def test_segments(files, name):
+    # Small segments split members at many (possibly false) member starts
+    h = io.BufferedReader(DecompressingReader(files(name), threads=3,
+                                              segment_size=10000))
+    assert(h.read() == DATA)
+    h.close()
+
+def test_large_member(files):
+    # A member too large to split off is decompressed sequentially
+    path = files("large")
+    with open(path, "wb") as h:
+        h.write(gzip.compress(b"first\n"))
+        h.write(gzip.compress(DATA))
+    h = io.BufferedReader(DecompressingReader(path, segment_size=1 << 12))
+    assert(h.read() == b"first\n" + DATA)
+    h.close()
+
+def test_false_member(files):
+    # A single member containing a valid-looking gzip header (stored, so
+    # the header appears verbatim), and one with reserved flags set
+    path = files("false_member")
+    header = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\x03"
+    data = DATA[:5000] + header + DATA[5000:10000] + b"\x1f\x8b\x08\xe0" + \
+            DATA[10000:]
+    with open(path, "wb") as h:
+        h.write(gzip.compress(data, compresslevel=0))
+    with open(path, "rb") as h:
+        assert(h.read().count(b"\x1f\x8b\x08") == 3)
+
+    assert(not has_members(path, "gzip", 1 << 22))
+    with open(path, "rb") as h:
+        segments = list(member_segments(h, "gzip", 1 << 12, 1 << 16))
+    assert(len(segments) == 1)
+    reader = DecompressingReader(path, threads=2)
+    assert(reader._blocks.__name__ == "_sequential")
+    h = io.BufferedReader(reader)
+    assert(h.read() == data)
+    h.close()
+
+@pytest.mark.parametrize("name", ["gzip", "members", "streams", "bgzf"])
+def test_truncated(files, name):
+    path = files(name + ".truncated")
+    with open(files(name), "rb") as h:
+        data = h.read()
+    with open(path, "wb") as h:
+        h.write(data[:len(data) // 2])
+    with pytest.raises((EOFError, IOError)):
+        with generic_open(path, "rb") as h:
+            h.read()
+
+def test_truncated_stream(files):
+    # A single bzip2 stream, decompressed sequentially
+    path = files("stream.truncated")
+    data = bz2.compress(DATA)
+    with open(path, "wb") as h:
+        h.write(data[:len(data) // 2])
+    with pytest.raises(EOFError):
+        with generic_open(path, "rb") as h:
+            h.read()
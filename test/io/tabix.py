@@ -0,0 +1,104 @@
+import gzip
+import os
+
+import numpy
+import pytest
+
+from BioTK.io.BED import BEDFile
+from BioTK.io.BGZF import BGZFReader, bgzip, is_bgzf
+from BioTK.io.tabix import TabixFile, build_index, reg2bin, reg2bins
+
+CONTIGS = ["chr1", "chr2", "chrX"]
+
+@pytest.fixture
+def bed(tmpdir):
+    rng = numpy.random.RandomState(0)
+    data = {}
+    path = os.path.join(str(tmpdir), "test.bed")
+    with open(path, "w") as h:
+        h.write("# comment\n")
+        for contig in CONTIGS:
+            starts = numpy.sort(rng.randint(0, 10 ** 7, 5000))
+            # Some long records, to populate the larger bins
+            ends = starts + numpy.where(rng.rand(5000) < 0.02,
+                                        rng.randint(1, 10 ** 6, 5000),
+                                        rng.randint(1, 1000, 5000))
+            data[contig] = starts, ends
+            for s, e in zip(starts, ends):
+                h.write("%s\t%s\t%s\tx\n" % (contig, s, e))
+    return bgzip(path), data
+
+def test_bgzf(tmpdir):
+    path = os.path.join(str(tmpdir), "test.txt")
+    data = b"".join(b"line %d\n" % i for i in range(100000))
+    with open(path, "wb") as h:
+        h.write(data)
+    bgzip(path)
+    assert(is_bgzf(path + ".gz"))
+    assert(not is_bgzf(path))
+    assert(gzip.open(path + ".gz").read() == data)
+
+    with BGZFReader(path + ".gz") as h:
+        offsets = []
+        while True:
+            offset = h.tell()
+            line = h.readline()
+            if not line:
+                break
+            offsets.append((offset, line))
+        assert(len(offsets) == 100000)
+        for offset, line in offsets[::-997]:
+            h.seek(offset)
+            assert(h.readline() == line)
+
+def test_bins():
+    assert(reg2bin(0, 1, 14, 5) == 4681)
+    assert(reg2bin(0, 1 << 29, 14, 5) == 0)
+    bins = reg2bins(100000, 200000, 14, 5)
+    assert(bins[0] == 0)
+    assert(reg2bin(100000, 100001, 14, 5) in bins)
+
+@pytest.mark.parametrize("csi", [False, True])
+def test_fetch(bed, csi):
+    path, data = bed
+    index_path = build_index(path, csi=csi)
+    assert(index_path.endswith(".csi" if csi else ".tbi"))
+
+    rng = numpy.random.RandomState(1)
+    with BEDFile(path) as h:
+        for _ in range(100):
+            contig = CONTIGS[rng.randint(len(CONTIGS))]
+            start = rng.randint(0, 10 ** 7)
+            end = start + rng.choice([1, 1000, 100000])
+            starts, ends = data[contig]
+            expected = (starts < end) & (ends > start)
+            regions = h.fetch(contig, start, end)
+            assert(len(regions) == expected.sum())
+            assert((regions.starts == starts[expected]).all())
+            assert((regions.ends == ends[expected]).all())
+        assert(len(h.fetch("chrY", 0, 10 ** 7)) == 0)
+
+    with TabixFile(path) as h:
+        assert(h.contigs == CONTIGS)
+        records = list(h.fetch("chr2", 0, 10 ** 5))
+        assert(len(records) == ((data["chr2"][0] < 10 ** 5).sum()))
+        assert(records[0][0] == "chr2")
+
+def test_track_lines(tmpdir):
+    path = os.path.join(str(tmpdir), "track.bed")
+    with open(path, "w") as h:
+        h.write("browser position chr1:1-1000\n")
+        h.write('track name="first" description="x"\n')
+        h.write("chr1\t10\t20\ta\n")
+        h.write("chr1\t15\t30\tb\n")
+        h.write("track name=second\n")
+        h.write("chr2\t0\t100\tc\n")
+    path = bgzip(path)
+    build_index(path)
+
+    with TabixFile(path) as h:
+        assert(h.contigs == ["chr1", "chr2"])
+        assert([r[3] for r in h.fetch("chr1", 0, 1000)] == ["a", "b"])
+        assert([r[3] for r in h.fetch("chr2", 0, 1000)] == ["c"])
+    with BEDFile(path) as h:
+        assert(len(h.fetch("chr1", 18, 19)) == 2)